@@ -1,13 +1,29 @@
+import io
 import os
+import sys
 import json
+import marshal
+import http.server
 import base64
 import logging
 import gspread
 import datetime
 import re
+import time
 import asyncio
+import threading
+import contextvars
+import collections
+import functools
+import concurrent.futures
+import gzip
+import zlib
+import heapq
+import zoneinfo
+import tracemalloc
 
 from decimal import Decimal, ROUND_HALF_UP
+from urllib.parse import unquote
 
 DATE_FMT = "%d.%m.%Y %H:%M"  # как пишем в листы
 
@@ -36,7 +52,7 @@ WORKSHOP_UNIFIED_HEADERS = [
 def ws_get_limited(ws, cols="A:H", limit=50):
     # cols="A:H" -> возьмём A1:H50
     left, right = cols.split(":")
-    return ws.get(f"{left}1:{right}{limit}")
+    return read_values(ws, f"{left}1:{right}{limit}")
 
 def _ws_norm_source(raw: str) -> str:
     """
@@ -74,13 +90,14 @@ def add_workshop_record(
     amount: Decimal = Decimal("0"),
     desc: str = "-",
 ):
-    """Универсальная запись строки в единый лист мастерской."""
+    """Универсальная запись строки в единый лист мастерской. Вернёт ID записи."""
     ws = _ensure_workshop_unified_ws(client)
     if not date:
         date = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
-    ws.append_row([
+    record_id = new_workshop_record_id()
+    resp = ws.append_row([
         kind,
-        car_id,   # в ID можно класть car_id, если не ведёшь отдельные ID
+        record_id,
         car_id,
         name or "",
         vin or "",
@@ -90,6 +107,119 @@ def add_workshop_record(
         desc or "-",
     ], value_input_option="USER_ENTERED")
 
+    # номер новой строки берём из ответа: "'Мастерская_Данные'!A15:I15" -> 15
+    updated = ((resp or {}).get("updates") or {}).get("updatedRange", "")
+    m = re.search(r"!\D*(\d+)", updated)
+    if m:
+        with _WS_RECORD_LOCK:
+            if _WS_RECORD_ROWS:
+                _WS_RECORD_ROWS[record_id] = int(m.group(1))
+    return record_id
+
+
+# ---------- ID записей Мастерская_Данные ----------
+# У каждой записи свой ID (колонка B); кнопки ссылаются на ID, а не на номер строки.
+# Индекс ID -> номер строки обновляем сами при вставке/удалении и сверяем
+# с листом перед использованием: если строка уехала — перестраиваем.
+
+_WS_RECORD_ROWS = {}     # ID записи -> номер строки (1-based)
+_WS_RECORD_LOCK = threading.Lock()
+_LAST_RECORD_ID = 0
+
+
+def new_workshop_record_id() -> str:
+    global _LAST_RECORD_ID
+    with _WS_RECORD_LOCK:
+        n = max(time.time_ns() // 1000, _LAST_RECORD_ID + 1)
+        _LAST_RECORD_ID = n
+    return f"w{n}"
+
+
+def _ws_record_index_rebuild(rows) -> None:
+    index = {}
+    seen = collections.Counter((r[1] or "").strip() for r in rows[1:] if len(r) > 1)
+    for i, r in enumerate(rows[1:], start=2):
+        rid = (r[1] or "").strip() if len(r) > 1 else ""
+        if rid and seen[rid] == 1:
+            index[rid] = i
+    with _WS_RECORD_LOCK:
+        _WS_RECORD_ROWS.clear()
+        _WS_RECORD_ROWS.update(index)
+
+
+def ws_record_index_deleted(row_numbers) -> None:
+    """Строки удалены из Мастерская_Данные — сдвигаем индекс."""
+    deleted = sorted(set(row_numbers))
+    if not deleted:
+        return
+    with _WS_RECORD_LOCK:
+        for rid, row in list(_WS_RECORD_ROWS.items()):
+            if row in deleted:
+                del _WS_RECORD_ROWS[rid]
+            else:
+                _WS_RECORD_ROWS[rid] = row - sum(1 for d in deleted if d < row)
+
+
+def workshop_car_cleanup(client, car_id: str) -> int:
+    """
+    Убрать машину из мастерской: её Услуги/Заморозку из Мастерская_Данные и строку
+    из «Мастерская». Номера строк берём из свежего чтения прямо перед удалением —
+    снимку до SHEET_CACHE_TTL лет, а лист могли отсортировать руками.
+    """
+    data_ws = get_ws(client, WORKSHOP_UNIFIED_SHEET)
+    rows_to_delete = [
+        i for i, r in enumerate(read_fresh(data_ws, "A:C")[1:], start=2)
+        if len(r) > 2 and (r[0] or "").strip() in ("Услуга", "Заморозка") and (r[2] or "").strip() == car_id
+    ]
+    car_rows = [
+        i for i, r in enumerate(read_fresh(get_ws(client, WORKSHOP_SHEET), "A:A")[1:], start=2)
+        if r and r[0] == car_id
+    ][:1]
+    deleted = delete_rows_batched(client, [
+        (WORKSHOP_UNIFIED_SHEET, rows_to_delete),
+        (WORKSHOP_SHEET, car_rows),
+    ])
+    ws_record_index_deleted(rows_to_delete)
+    logger.info(f"Удалено {len(rows_to_delete)} строк из Мастерская_Данные для CarID={car_id}")
+    return deleted
+
+
+def ensure_workshop_record_ids(client) -> None:
+    """
+    Старые записи хранили в ID тот же car_id (или ничего) — выдаём им
+    уникальные ID одним batch_update. Новые записи ID получают сразу.
+    """
+    ws = _ensure_workshop_unified_ws(client)
+    rows = read_values(ws)
+    seen = collections.Counter((r[1] or "").strip() for r in rows[1:] if len(r) > 1)
+    with SheetWriteBatch(ws, rows[0] if rows else []) as wb:
+        for i, r in enumerate(rows[1:], start=2):
+            if len(r) < 3 or (r[0] or "").strip() not in ("Услуга", "Заморозка"):
+                continue
+            rid = (r[1] or "").strip()
+            if not rid or seen[rid] > 1 or rid == (r[2] or "").strip():
+                wb.set_cell(i, 2, new_workshop_record_id())
+
+
+def find_workshop_record(client, record_id: str):
+    """
+    (номер строки, значения строки) записи по ID или (None, None).
+    Строка из индекса сверяется с листом; не совпала — индекс строится заново по свежему листу.
+    """
+    ws = get_ws(client, WORKSHOP_UNIFIED_SHEET)
+    for attempt in range(2):
+        if attempt:
+            note_sheet_write(WORKSHOP_UNIFIED_SHEET)   # снимок мог устареть вместе с индексом
+        if attempt or not _WS_RECORD_ROWS:
+            _ws_record_index_rebuild(read_values(ws))
+        row = _WS_RECORD_ROWS.get(record_id)
+        if row is None:
+            continue
+        values = ws.row_values(row)
+        if len(values) > 1 and values[1].strip() == record_id:
+            return row, values
+    return None, None
+
 # ---------- УСЛУГИ ----------
 
 def get_services_for_car(client, car_id: str):
@@ -97,7 +227,7 @@ def get_services_for_car(client, car_id: str):
     Вернёт список (amount, desc) для всех услуг по машине.
     """
     ws = _ensure_workshop_unified_ws(client)
-    rows = ws.get_all_values()[1:]
+    rows = read_values(ws)[1:]
     items = []
     for r in rows:
         if not r or len(r) < 8:
@@ -117,7 +247,7 @@ def get_services_recent_for_car(client, car_id: str, limit: int = 5):
     Формат: (date_str, amount, desc)
     """
     ws = _ensure_workshop_unified_ws(client)
-    rows = ws.get_all_values()[1:]
+    rows = read_values(ws)[1:]
     items = []
     for r in rows:
         if not r or len(r) < 8:
@@ -137,10 +267,10 @@ def get_workshop_records_for_car(client, car_id: str):
     """
     Все записи по машине из Мастерская_Данные:
     и услуги, и заморозка (купленные запчасти).
-    Возвращает список словарей с row_index, kind, date, source, amount, desc.
+    Возвращает список словарей с id, row_index, kind, date, source, amount, desc.
     """
     ws = _ensure_workshop_unified_ws(client)
-    rows = ws.get_all_values()
+    rows = read_values(ws)
     items = []
 
     # rows[0] — шапка, данные с 2-й строки
@@ -160,6 +290,7 @@ def get_workshop_records_for_car(client, car_id: str):
         desc   = (r[8] if len(r) > 8 else "-") or "-"
 
         items.append({
+            "id":        (r[1] or "").strip(),
             "row_index": i,   # реальный номер строки в листе
             "kind":      kind,
             "date":      date,
@@ -170,72 +301,84 @@ def get_workshop_records_for_car(client, car_id: str):
 
     return items
 
-def get_services_total_for_car(client, car_id: str) -> Decimal:
+def _build_workshop_index(rows) -> dict:
     """
-    Сумма всех услуг по машине.
+    Индекс Мастерская_Данные по машинам: car_id -> суммы услуг и заморозки.
+    Строится один раз на снимок листа (см. workshop_index).
     """
-    ws = _ensure_workshop_unified_ws(client)
-    rows = ws.get_all_values()[1:]
-    total = Decimal("0")
-    for r in rows:
+    by_car = {}
+    for r in rows[1:]:
         if not r or len(r) < 8:
             continue
-        if (r[0] or "").strip() != "Услуга":
+        kind = (r[0] or "").strip()
+        if kind not in ("Услуга", "Заморозка"):
             continue
-        if (r[2] or "").strip() != car_id:
+        car_id = (r[2] or "").strip()
+        e = by_car.get(car_id)
+        if e is None:
+            e = by_car[car_id] = {
+                "name": "",
+                "services": Decimal("0"),
+                "services_count": 0,
+                "frozen": Decimal("0"),
+                "frozen_card": Decimal("0"),
+                "frozen_cash": Decimal("0"),
+                "frozen_count": 0,
+            }
+        amt = _to_amount(r[7])
+        if kind == "Услуга":
+            e["services"] += amt
+            e["services_count"] += 1
             continue
-        total += _to_amount(r[7])
-    return total
+
+        if not e["frozen_count"]:
+            e["name"] = (r[3] or "").strip()
+        e["frozen"] += amt
+        e["frozen_count"] += 1
+        src = _norm_source((r[6] or "").strip())
+        if src == "Карта":
+            e["frozen_card"] += amt
+        elif src == "Наличные":
+            e["frozen_cash"] += amt
+    return by_car
+
+
+def workshop_index(client) -> dict:
+    """car_id -> {services, frozen, frozen_card, frozen_cash, ...}; общий — не мутировать."""
+    ws = get_ws(client, WORKSHOP_UNIFIED_SHEET)
+    return sheet_derived(ws, "by_car", _build_workshop_index)
+
+
+def get_services_total_for_car(client, car_id: str) -> Decimal:
+    """
+    Сумма всех услуг по машине.
+    """
+    e = workshop_index(client).get(car_id)
+    return e["services"] if e else Decimal("0")
 
 def get_frozen_breakdown_for_car(client, car_id: str):
     """
     Разбивка заморозки по источникам (карта/нал).
     Нужна при завершении ремонта, чтобы вернуть в нужный кошелёк.
     """
-    ws = _ensure_workshop_unified_ws(client)
-    rows = ws.get_all_values()[1:]
-    card = Decimal("0")
-    cash = Decimal("0")
-    cnt  = 0
-    for r in rows:
-        if not r or len(r) < 8:
-            continue
-        if (r[0] or "").strip() != "Заморозка":
-            continue
-        if (r[2] or "").strip() != car_id:
-            continue
-
-        amt = _to_amount(r[7])
-        src_raw = (r[6] if len(r) > 6 else "").strip()
-        src = _norm_source(src_raw)
-        if src == "Карта":
-            card += amt
-        elif src == "Наличные":
-            cash += amt
-        cnt += 1
-
+    e = workshop_index(client).get(car_id)
+    card = e["frozen_card"] if e else Decimal("0")
+    cash = e["frozen_cash"] if e else Decimal("0")
     return {
         "card": card,
         "cash": cash,
         "total": card + cash,
-        "count": cnt,
+        "count": e["frozen_count"] if e else 0,
     }
 
-from decimal import Decimal
-
 def get_frozen_for_car(client, car_id: str) -> Decimal:
-    ws = _ensure_workshop_unified_ws(client)
-    rows = ws.get_all_values()[1:]
-    total = Decimal("0")
-    for r in rows:
-        if not r or len(r) < 8:
-            continue
-        if (r[0] or "").strip() != "Заморозка":
-            continue
-        if (r[2] or "").strip() != car_id:
-            continue
-        total += _to_amount(r[7])
-    return total
+    e = workshop_index(client).get(car_id)
+    return e["frozen"] if e else Decimal("0")
+
+
+def get_frozen_total(client) -> Decimal:
+    """Вся заморозка по Мастерская_Данные."""
+    return sum((e["frozen"] for e in workshop_index(client).values()), Decimal("0"))
 
 
 def get_frozen_by_car(client):
@@ -243,31 +386,16 @@ def get_frozen_by_car(client):
     items = [(car_id, name, sum), ...], total = сумма по всем
     читает из Мастерская_Данные с твоей шапкой
     """
-    ws = _ensure_workshop_unified_ws(client)
-    rows = ws.get_all_values()[1:]
-    by = {}
+    items = []
     total = Decimal("0")
-    for r in rows:
-        if not r or len(r) < 8:
-            continue
-        if (r[0] or "").strip() != "Заморозка":
+    for car_id, e in workshop_index(client).items():
+        if not e["frozen_count"]:
             continue
-
-        car_id = (r[2] or "").strip()
-        name   = (r[3] or "").strip() or "(без названия)"
-        amt    = _to_amount(r[7])
-
-        total += amt
-
-        if not car_id:
-            car_id = "__unknown__"
-            name = "(без машины)"
-
-        if car_id not in by:
-            by[car_id] = [name, Decimal("0")]
-        by[car_id][1] += amt
-
-    items = [(cid, nm, sm) for cid, (nm, sm) in by.items()]
+        total += e["frozen"]
+        if car_id:
+            items.append((car_id, e["name"] or "(без названия)", e["frozen"]))
+        else:
+            items.append(("__unknown__", "(без машины)", e["frozen"]))
     items.sort(key=lambda x: x[2], reverse=True)
     return items, total
 
@@ -276,21 +404,11 @@ def get_frozen_totals(client):
     """
     Разбивка заморозки по источникам (Карта/Наличные) из Мастерская_Данные.
     """
-    ws = _ensure_workshop_unified_ws(client)
-    rows = ws.get_all_values()[1:]
     card = Decimal("0")
     cash = Decimal("0")
-    for r in rows:
-        if not r or len(r) < 8:
-            continue
-        if (r[0] or "").strip() != "Заморозка":
-            continue
-        amt = _to_amount(r[7])
-        src = _norm_source((r[6] or "").strip())
-        if src == "Карта":
-            card += amt
-        elif src == "Наличные":
-            cash += amt
+    for e in workshop_index(client).values():
+        card += e["frozen_card"]
+        cash += e["frozen_cash"]
     return {
         "card": card,
         "cash": cash,
@@ -353,26 +471,30 @@ def _freeze_idx(header: list[str]) -> dict:
     }
 
 def ensure_ws_with_headers(client, sheet_name: str, headers: list[str]):
-    ws = client.open_by_key(SPREADSHEET_ID).worksheet(sheet_name)
-    rows = ws.get_all_values()
-    if not rows:
+    ws = get_ws(client, sheet_name)
+    rows = read_values(ws)
+    ensure_header_row(ws, rows[0] if rows else [], headers)
+    return ws
+
+def ensure_header_row(ws, header: list, headers: list[str]) -> None:
+    """По уже прочитанной шапке: пустой лист — пишем шапку, иначе дополняем пустые ячейки."""
+    if not any((h or "").strip() for h in header):
         # создаём шапку 1-й строкой
         last_col_letter = chr(64 + len(headers))  # D для 4-х колонок
         ws.update(f"A1:{last_col_letter}1", [headers])
-    else:
-        # мягко дополним недостающие заголовки
-        header = rows[0]
+        return
+    # мягко дополним недостающие заголовки (одним запросом)
+    with SheetWriteBatch(ws, header) as wb:
         for i, h in enumerate(headers, start=1):
             cur = header[i-1].strip() if i-1 < len(header) else ""
             if not cur:
-                ws.update_cell(1, i, h)
-    return ws
+                wb.set_cell(1, i, h)
 
 def _safe_idx(header: list[str]) -> dict:
     return { (h or "").strip(): i for i, h in enumerate(header) }
 
 def _get_row_by_id(ws, car_id: str):
-    rows = ws.get_all_values()
+    rows = read_values(ws)
     if not rows or len(rows) < 2:
         return None, None, None  # row, header, idx
     header = rows[0]
@@ -388,86 +510,162 @@ INCOME_SHEET = "Доход"    # если назвал лист иначе — 
 EXPENSE_SHEET = "Расход"  # если назвал лист иначе — поменяй тут
 
 def get_cats_ws(client):
-    return client.open_by_key(SPREADSHEET_ID).worksheet("Категории")
+    return get_ws(client, CATS_SHEET)
     
 def _parse_money(s: str) -> float:
     s = (s or "").strip().replace(",", ".")
     return float(s) if s else 0.0
 
+# ---- Реестр категорий: меню без похода в сеть ----
+CATS_SHEET = "Категории"
+CATS_HEADERS = ["ID", "Тип", "Название", "Активна", "Порядок"]
+
+
+class CategoryRegistry:
+    """
+    Все категории листа + индексы по ID и по (тип, название). Общий — не мутировать.
+    Записи — словари {ID, Тип, Название, Активна, Порядок, _row, _rownum}.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        header = [(h or "").strip() for h in rows[0]] if rows else []
+        idx = {h: i for i, h in enumerate(header)}
+        self.header = header
+        self.cats = []
+        self.by_id = {}
+        self.by_name = {}   # (тип, название.lower()) -> запись (активная важнее)
+        if not all(k in idx for k in ("ID", "Тип", "Название", "Активна")):
+            return
+        for num, r in enumerate(rows[1:], start=2):
+            if not r or any(idx[k] >= len(r) for k in ("ID", "Тип", "Название", "Активна")):
+                continue
+            order = 0
+            if "Порядок" in idx and idx["Порядок"] < len(r):
+                o = (r[idx["Порядок"]] or "").strip()
+                if o and o.lstrip("-").isdigit():
+                    order = int(o)
+            cat = {
+                "ID": r[idx["ID"]].strip(),
+                "Тип": r[idx["Тип"]].strip(),
+                "Название": r[idx["Название"]].strip(),
+                "Активна": r[idx["Активна"]].strip(),
+                "Порядок": order,
+                "_row": r,
+                "_rownum": num,
+            }
+            self.cats.append(cat)
+            if cat["ID"]:
+                self.by_id.setdefault(cat["ID"], cat)
+            key = (cat["Тип"], cat["Название"].lower())
+            prev = self.by_name.get(key)
+            if prev is None or (prev["Активна"] != "1" and cat["Активна"] == "1"):
+                self.by_name[key] = cat
+        self._active = {}
+
+    def of_kind(self, kind: str) -> list:
+        return [c for c in self.cats if c["Тип"] == kind]
+
+    def active(self, kind: str) -> list:
+        out = self._active.get(kind)
+        if out is None:
+            out = [c for c in self.of_kind(kind) if c["Активна"] == "1"]
+            out.sort(key=lambda c: (c["Порядок"], c["Название"].lower()))
+            self._active[kind] = out
+        return out
+
+    def find(self, kind: str, name: str, active_only: bool = False) -> Optional[dict]:
+        cat = self.by_name.get((kind.strip(), name.strip().lower()))
+        if cat is not None and active_only and cat["Активна"] != "1":
+            return None
+        return cat
+
+
+_CATEGORY_REG = None   # (поколение листа, время загрузки, CategoryRegistry)
+_CATEGORY_LOCK = threading.Lock()
+
+
+def category_registry(client=None) -> CategoryRegistry:
+    """
+    Реестр категорий живёт как снимок «Категорий»: до нашей записи или SHEET_CACHE_TTL
+    секунд — категории правят и в листе руками, такие правки должны доходить.
+    """
+    global _CATEGORY_REG
+    gen = _sheet_gen(CATS_SHEET)
+    cached = _CATEGORY_REG
+    fresh = cached is not None and cached[0] == gen and time.monotonic() - cached[1] < SHEET_CACHE_TTL
+    CACHES.lookup("categories", None, fresh)
+    if fresh:
+        return cached[2]
+    snap = sheet_snapshot(get_cats_ws(client or get_gspread_client()))
+    reg = CategoryRegistry(snap.rows)
+    if snap.gen == _sheet_gen(CATS_SHEET):
+        _CATEGORY_REG = (snap.gen, snap.fetched_at, reg)
+        CACHES.put("categories", None, approx_size(reg, {id(snap.rows)}))
+    return reg
+
+
+def _category_patch(ws, gen_before: tuple, fn) -> None:
+    """Наша запись в «Категории» ушла — поправить реестр и снимок на месте."""
+    global _CATEGORY_REG
+    patch_snapshot(ws, gen_before, fn)
+    cached = _CATEGORY_REG
+    if cached is None or cached[0] != gen_before:
+        return
+    expected = _gen_after_own_write(gen_before)
+    snap = _SNAPSHOTS.get(CATS_SHEET)
+    if snap is not None and snap.rows is not None and snap.gen == expected:
+        rows = snap.rows   # снимок уже поправлен — реестр держит его строки, как при загрузке
+    else:
+        rows = [list(r) for r in cached[2].rows]
+        try:
+            if _sheet_gen(CATS_SHEET) != expected:
+                raise LookupError("concurrent write")
+            fn(rows)
+        except (LookupError, IndexError):
+            _CATEGORY_REG = None
+            CACHES.drop("categories", None)
+            return
+    reg = CategoryRegistry(rows)
+    _CATEGORY_REG = (expected, cached[1], reg)
+    CACHES.put("categories", None, approx_size(reg, {id(snap.rows)} if snap is not None else None))
+
+
 def list_categories(kind: str):
     """Активные категории ('Доход'/'Расход') -> [{ID, Название, Порядок}]"""
-    client = get_gspread_client()
-    ws = get_cats_ws(client)
-    rows = ws.get_all_values()
-    if not rows or len(rows) < 2:
-        return []
-    header = rows[0]
-    idx = {h.strip(): i for i, h in enumerate(header)}
-    out = []
-    for r in rows[1:]:
-        if not r: 
-            continue
-        if not all(k in idx for k in ("ID","Тип","Название","Активна")):
-            continue
-        if any(idx[k] >= len(r) for k in ("ID","Тип","Название","Активна")):
-            continue
-        if r[idx["Тип"]].strip() != kind:
-            continue
-        if r[idx["Активна"]].strip() != "1":
-            continue
-        order = 0
-        if "Порядок" in idx and idx["Порядок"] < len(r):
-            s = (r[idx["Порядок"]] or "").strip()
-            if s and s.lstrip("-").isdigit():
-                order = int(s)
-        out.append({"ID": r[idx["ID"]].strip(), "Название": r[idx["Название"]].strip(), "Порядок": order})
-    out.sort(key=lambda x: (x["Порядок"], x["Название"].lower()))
-    return out
+    return [
+        {"ID": c["ID"], "Название": c["Название"], "Порядок": c["Порядок"]}
+        for c in category_registry().active(kind)
+    ]
 
 def get_all_categories(kind: str):
     """ВСЕ категории данного типа ('Доход'/'Расход'), включая неактивные."""
-    client = get_gspread_client()
-    ws = get_cats_ws(client)
-    rows = ws.get_all_values()
-    if not rows or len(rows) < 2:
-        return []
-    header = rows[0]
-    idx = {h.strip(): i for i, h in enumerate(header)}
-    out = []
-    for r in rows[1:]:
-        if not r:
-            continue
-        if not all(k in idx for k in ("ID", "Тип", "Название", "Активна")):
-            continue
-        if any(idx[k] >= len(r) for k in ("ID","Тип","Название","Активна")):
-            continue
-        if r[idx["Тип"]].strip() != kind:
-            continue
-        out.append({
-            "ID": r[idx["ID"]].strip(),
-            "Название": r[idx["Название"]].strip(),
-            "Активна": r[idx["Активна"]].strip(),
-            "_row": r,  # на всякий
-        })
-    return out
+    return [
+        {"ID": c["ID"], "Название": c["Название"], "Активна": c["Активна"], "_row": c["_row"]}
+        for c in category_registry().of_kind(kind)
+    ]
 
 def delete_category(cat_id: str) -> bool:
     """Удаляет строку категории по ID. Возвращает True/False."""
     client = get_gspread_client()
     ws = get_cats_ws(client)
-    rows = ws.get_all_values()
-    if not rows or len(rows) < 2:
-        return False
-    header = rows[0]
-    try:
-        id_idx = header.index("ID")
-    except ValueError:
-        return False
-    for i, r in enumerate(rows[1:], start=2):
-        if id_idx < len(r) and (r[id_idx] or "").strip() == cat_id.strip():
-            ws.delete_rows(i)
-            return True
-    return False
+    with _CATEGORY_LOCK:
+        for attempt in range(2):
+            reg = category_registry(client)
+            cat = reg.by_id.get(cat_id.strip())
+            if cat is None:
+                return False
+            # лист могли поправить руками — перед удалением сверяем строку
+            values = ws.row_values(cat["_rownum"])
+            if values and (values[0] or "").strip() == cat["ID"]:
+                break
+            note_sheet_write(CATS_SHEET)   # реестр устарел — перечитать
+        else:
+            return False
+        gen = _sheet_gen(CATS_SHEET)
+        ws.delete_rows(cat["_rownum"])
+        _category_patch(ws, gen, lambda rows: rows.pop(cat["_rownum"] - 1))
+    return True
 
 def _aggregate_by_category(rows):
     by = {}
@@ -487,8 +685,8 @@ def _sum_sheet_period(client, sheet_name: str, days: int, exclude_transfers: boo
     rows_filtered — строки, попавшие в диапазон по дате (последние N дней).
     Формат строк: [Дата, КатID, Кат, 💳, 💵, 📝]
     """
-    ws = client.open_by_key(SPREADSHEET_ID).worksheet(sheet_name)
-    rows = ws.get_all_values()[1:]
+    ws = get_ws(client, sheet_name)
+    rows = read_values(ws)[1:]
     now = datetime.datetime.now()
     start_date = now - datetime.timedelta(days=days)
 
@@ -531,40 +729,51 @@ def _render_detail_line(r: list, is_income: bool) -> str:
         return f"📅 {dt} | 🚗 {cat} | 🔴 -{_fmt_amount(total)} (💳 {card or '0'} | 💵 {cash or '0'}) | 📝 {desc}"    
 
 def get_category_name(cat_id: str) -> str:
-    client = get_gspread_client()
-    ws = get_cats_ws(client)
-    rows = ws.get_all_values()
-    if not rows: 
-        return cat_id
-    header = rows[0]
-    idx = {h.strip(): i for i, h in enumerate(header)}
-    if "ID" not in idx:
-        return cat_id
-    for r in rows[1:]:
-        if idx["ID"] < len(r) and (r[idx["ID"]] or "").strip() == cat_id:
-            if "Название" in idx and idx["Название"] < len(r):
-                nm = (r[idx["Название"]] or "").strip()
-                return nm or cat_id
-            return cat_id
-    return cat_id
+    cat = category_registry().by_id.get((cat_id or "").strip())
+    return (cat and cat["Название"]) or cat_id
 
-def add_category(kind: str, name: str) -> str:
-    """Создать категорию (Активна=1, Порядок=0). Возвращает cat_id."""
+def add_category(kind: str, name: str, active: bool = True) -> str:
+    """Создать категорию (Активна=1 или 0, Порядок=0). Возвращает cat_id."""
     client = get_gspread_client()
     ws = get_cats_ws(client)
-    rows = ws.get_all_values()
-    if not rows:
-        ws.append_row(["ID","Тип","Название","Активна","Порядок"])
-    cat_id = "cat_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    ws.append_row([cat_id, kind.strip(), name.strip(), "1", "0"])
+    with _CATEGORY_LOCK:
+        reg = category_registry(client)
+        if not reg.rows:
+            ws.append_row(CATS_HEADERS)
+            reg = category_registry(client)
+        cat_id = "cat_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        base, n = cat_id, 1
+        while cat_id in reg.by_id:   # две категории в одну секунду
+            n += 1
+            cat_id = f"{base}_{n}"
+        row = [cat_id, kind.strip(), name.strip(), "1" if active else "0", "0"]
+        gen = _sheet_gen(CATS_SHEET)
+        resp = ws.append_row(row, table_range="A:E")
+        updated = ((resp or {}).get("updates") or {}).get("updatedRange", "")
+        m = re.search(r"!\D*(\d+)", updated)
+
+        def apply(rows):
+            if not m or int(m.group(1)) != len(rows) + 1:
+                raise LookupError("append landed elsewhere")
+            rows.append(row)
+        _category_patch(ws, gen, apply)
     return cat_id
 
+def ensure_category_by_name(kind: str, name: str) -> tuple[str, str]:
+    """
+    Служебная категория («Перевод», «Ремонт») с таким названием, активная или нет;
+    нет — создаём неактивной, чтобы она не появлялась в меню. -> (ID, Название)
+    """
+    cat = category_registry().find(kind, name)
+    if cat is not None:
+        return cat["ID"], cat["Название"]
+    return add_category(kind, name, active=False), name.strip()
+
 def ensure_default_category(kind: str) -> tuple[str, str]:
     """Гарантируем активную категорию 'Другое' для указанного типа."""
-    cats = list_categories(kind)
-    for c in cats:
-        if c["Название"].strip().lower() == "другое":
-            return c["ID"], c["Название"]
+    cat = category_registry().find(kind, "Другое", active_only=True)
+    if cat is not None:
+        return cat["ID"], cat["Название"]
     cat_id = add_category(kind, "Другое")
     return cat_id, "Другое"
 
@@ -572,7 +781,7 @@ def ensure_default_category(kind: str) -> tuple[str, str]:
 INOUT_HEADERS = ["Дата", "КатегорияID", "Категория", "💳 Карта", "💵 Наличные", "📝 Описание"]
 
 def ensure_sheet_headers(ws, headers: list[str]):
-    rows = ws.get_all_values()
+    rows = read_values(ws)
     if not rows:
         ws.append_row(headers)
 
@@ -580,7 +789,7 @@ def _fmt_amount(x): return f"{float(x):.2f}"
 
 def append_income(category_id: str, category_name: str, card_amount: float, cash_amount: float, desc: str):
     client = get_gspread_client()
-    ws = client.open_by_key(SPREADSHEET_ID).worksheet(INCOME_SHEET)
+    ws = get_ws(client, INCOME_SHEET)
     ensure_sheet_headers(ws, INOUT_HEADERS)
     ws.append_row([
         datetime.datetime.now().strftime("%d.%m.%Y %H:%M"),
@@ -590,7 +799,7 @@ def append_income(category_id: str, category_name: str, card_amount: float, cash
 
 def append_expense(category_id: str, category_name: str, card_amount: float, cash_amount: float, desc: str):
     client = get_gspread_client()
-    ws = client.open_by_key(SPREADSHEET_ID).worksheet(EXPENSE_SHEET)
+    ws = get_ws(client, EXPENSE_SHEET)
     ensure_sheet_headers(ws, INOUT_HEADERS)
     ws.append_row([
         datetime.datetime.now().strftime("%d.%m.%Y %H:%M"),
@@ -609,17 +818,19 @@ def _parse_date_flex(s: str) -> Optional[datetime.date]:
             pass
     return None   
 
-def _days_left_label(date_str: str) -> tuple[str, int | None]:
+def _days_left_label(date_str: str, today: Optional[datetime.date] = None) -> tuple[str, int | None]:
     """
     Возвращает метку 'осталось N дней' / 'сегодня' / 'просрочено N дней' и сам N (может быть <0),
     либо ('—', None) если даты нет, либо ('неверный формат', None) если не распарсили.
+    today — от какой даты считать (по умолчанию сегодня по часам сервера).
     """
     if not date_str:
         return "—", None
     d = _parse_date_flex(date_str)
     if not d:
         return "неверный формат", None
-    today = datetime.date.today()
+    if today is None:
+        today = datetime.date.today()
     delta = (d - today).days
     if delta > 0:
         return f"осталось {delta} дней", delta
@@ -628,40 +839,363 @@ def _days_left_label(date_str: str) -> tuple[str, int | None]:
     else:
         return f"просрочено {abs(delta)} дней", delta
 
-def _ensure_column(ws, header_name: str) -> int:
-    """Вернёт индекс колонки по заголовку. Если нет — создаст новую справа и вернёт её индекс."""
-    header = ws.row_values(1)
-    if header_name in header:
-        return header.index(header_name) + 1
-    col = len(header) + 1
-    ws.update_cell(1, col, header_name)
-    return col
-
-def _find_row_by_name(ws, name: str, name_header: str = "Название") -> int | None:
-    """Вернёт индекс строки (2..N) по названию авто, иначе None."""
-    rows = ws.get_all_values()
-    if not rows:
-        return None
-    header = rows[0]
+class SheetWriteBatch:
+    """
+    Единица работы над листом: записи ячеек и диапазонов копятся
+    и уходят одним batch_update в commit(). Шапка читается один раз на пачку.
+
+        with SheetWriteBatch(ws) as wb:
+            wb.set_cell(row_idx, wb.column("Водитель"), "")
+
+    Если внутри with случилось исключение — ничего не пишем.
+    """
+
+    def __init__(self, ws, header: Optional[list] = None):
+        self.ws = ws
+        self._header = list(header) if header is not None else None
+        self._data = []
+
+    @property
+    def header(self) -> list:
+        if self._header is None:
+            self._header = self.ws.row_values(1)
+        return self._header
+
+    def column(self, header_name: str, create: bool = True) -> Optional[int]:
+        """1-based индекс колонки по заголовку. Нет — допишем справа в этой же пачке (или None)."""
+        names = [(h or "").strip() for h in self.header]
+        if header_name in names:
+            return names.index(header_name) + 1
+        if not create:
+            return None
+        self._header.append(header_name)
+        col = len(self._header)
+        self.set_cell(1, col, header_name)
+        return col
+
+    def set_cell(self, row: int, col: int, value) -> None:
+        self._data.append({"range": gspread.utils.rowcol_to_a1(row, col), "values": [[value]]})
+
+    def set_range(self, rng: str, values: list) -> None:
+        self._data.append({"range": rng, "values": values})
+
+    def commit(self):
+        if not self._data:
+            return None
+        data, self._data = self._data, []
+        return self.ws.batch_update(data, value_input_option="USER_ENTERED")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self._data = []
+        return False
+
+
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+_SHEETS_EPOCH = datetime.datetime(1899, 12, 30)
+_APPEND_FIELDS = "userEnteredValue,userEnteredFormat.numberFormat"
+
+
+def _append_cell(value) -> dict:
+    """Ячейка для appendCells так, как её понял бы USER_ENTERED: числа, даты, текст."""
+    if value is None or value == "":
+        return {}
+    if isinstance(value, (int, float, Decimal)):
+        return {"userEnteredValue": {"numberValue": float(value)}}
+    s = str(value)
+    if _NUMBER_RE.fullmatch(s):
+        return {"userEnteredValue": {"numberValue": float(s)}}
+    for fmt, pattern in ((DATE_FMT, "dd.mm.yyyy hh:mm"), ("%d.%m.%Y", "dd.mm.yyyy")):
+        try:
+            dt = datetime.datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        serial = (dt - _SHEETS_EPOCH).total_seconds() / 86400
+        return {
+            "userEnteredValue": {"numberValue": serial},
+            "userEnteredFormat": {"numberFormat": {"type": "DATE_TIME" if fmt == DATE_FMT else "DATE", "pattern": pattern}},
+        }
+    return {"userEnteredValue": {"stringValue": s}}
+
+
+def append_rows_atomic(client, rows: list) -> None:
+    """
+    Дописать строки в несколько листов одним spreadsheet.batch_update
+    (appendCells): либо записываются все, либо ни одной.
+    rows = [(название листа, [значения]), ...]
+    """
+    requests = []
+    sh = None
+    for title, values in rows:
+        ws = get_ws(client, title)
+        sh = ws.spreadsheet
+        requests.append({"appendCells": {
+            "sheetId": ws.id,
+            "rows": [{"values": [_append_cell(v) for v in values]}],
+            "fields": _APPEND_FIELDS,
+        }})
+    if requests:
+        sh.batch_update({"requests": requests})
+
+
+def _row_ranges(row_numbers) -> list:
+    """[2, 3, 4, 7] -> [(7, 7), (2, 4)]: непрерывные диапазоны строк, снизу вверх."""
+    ranges = []
+    for n in sorted(set(row_numbers), reverse=True):
+        if ranges and ranges[-1][0] == n + 1:
+            ranges[-1] = (n, ranges[-1][1])
+        else:
+            ranges.append((n, n))
+    return ranges
+
+
+def delete_rows_batched(client, rows: list) -> int:
+    """
+    Удалить строки (1-based) из одного или нескольких листов одним batch_update
+    запросами deleteDimension — по диапазонам, начиная с нижних.
+    rows = [(название листа, [номера строк]), ...]; вернёт число удалённых строк.
+    """
+    requests = []
+    sh = None
+    deleted = 0
+    for title, numbers in rows:
+        if not numbers:
+            continue
+        ws = get_ws(client, title)
+        sh = ws.spreadsheet
+        for start, end in _row_ranges(numbers):
+            requests.append({"deleteDimension": {"range": {
+                "sheetId": ws.id,
+                "dimension": "ROWS",
+                "startIndex": start - 1,
+                "endIndex": end,
+            }}})
+            deleted += end - start + 1
+    if requests:
+        sh.batch_update({"requests": requests})
+    return deleted
+
+
+# ---- Реестр автомобилей: лист "Автомобили" одним чтением ----
+CARS_SHEET = "Автомобили"
+CAR_DATE_COLUMNS = ("Страховка до", "ТО до", "Договор до")
+
+
+def _car_key(s: str) -> str:
+    """VIN/номер для поиска: без пробелов и дефисов, в верхнем регистре."""
+    return re.sub(r"[\s\-]", "", s or "").upper()
+
+
+# кириллица, похожая на латиницу в госномерах: А123ВС и A123BC — одно и то же
+_LOOKALIKE = str.maketrans("авекмнорстухё", "abekmhopctyxe")
+
+
+def _search_key(s: str) -> str:
+    return re.sub(r"[\s\-_.]", "", (s or "").lower()).translate(_LOOKALIKE)
+
+
+def _trigrams(s: str) -> set:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class Car:
+    __slots__ = ("row", "values", "fields", "dates")
+
+    def __init__(self, row: int, values: list, header: list):
+        self.row = row            # номер строки в листе (1-based)
+        self.values = values
+        self.fields = {h: (values[i] or "").strip() for i, h in enumerate(header) if h and i < len(values)}
+        self.dates = {c: _parse_date_flex(self.fields.get(c, "")) for c in CAR_DATE_COLUMNS}
+
+    def get(self, col_name: str, default: str = "") -> str:
+        return self.fields.get(col_name) or default
+
+    @property
+    def id(self) -> str:
+        return (self.values[0] or "").strip() if self.values else ""
+
+    @property
+    def name(self) -> str:
+        return self.fields.get("Название", "")
+
+
+class CarRegistry:
+    """Все машины + индексы по ID, названию, VIN и госномеру. Общий — не мутировать."""
+
+    def __init__(self, rows):
+        self.header = [(h or "").strip() for h in rows[0]] if rows else []
+        self.cars = []
+        self.by_id = {}
+        self.by_name = {}
+        self.by_vin = {}
+        self.by_plate = {}
+        for i, r in enumerate(rows[1:], start=2):
+            if not any((v or "").strip() for v in r):
+                continue
+            car = Car(i, r, self.header)
+            self.cars.append(car)
+            if car.id:
+                self.by_id.setdefault(car.id, car)
+            if car.name:
+                self.by_name.setdefault(car.name, car)
+            vin = _car_key(car.get("VIN"))
+            if vin:
+                self.by_vin.setdefault(vin, car)
+            plate = _car_key(car.get("Номер"))
+            if plate:
+                self.by_plate.setdefault(plate, car)
+        self._keys = None       # car -> ключи поиска (название, VIN, номер)
+        self._joined = None     # те же ключи одной строкой — для коротких запросов
+        self._trigram = None    # триграмма -> индексы машин в self.cars
+
+    def _build_search(self) -> None:
+        keys, trigram = [], collections.defaultdict(set)
+        for n, car in enumerate(self.cars):
+            ks = tuple(k for k in (_search_key(car.name), _search_key(car.get("VIN")), _search_key(car.get("Номер"))) if k)
+            keys.append(ks)
+            for k in ks:
+                for t in _trigrams(k):
+                    trigram[t].add(n)
+        # поиск идёт из потоков: _keys — признак готовности, публикуем его последним
+        self._joined = ["\x00".join(ks) for ks in keys]
+        self._trigram = dict(trigram)
+        self._keys = keys
+
+    def search(self, query: str, limit: int = 8) -> list:
+        """Машины по фрагменту названия, VIN или госномера — лучшие совпадения первыми."""
+        q = _search_key(query)
+        if not q:
+            return []
+        if self._keys is None:
+            self._build_search()
+
+        qgrams = _trigrams(q)
+        if qgrams:
+            hits = collections.Counter()
+            for t in qgrams:
+                hits.update(self._trigram.get(t, ()))
+            # меньше половины общих триграмм — заведомо мимо, даже не проверяем
+            need = (len(qgrams) + 1) // 2
+            candidates = {n: c for n, c in hits.items() if c >= need}
+        else:
+            # 1-2 символа: триграмм нет — просто подстрока
+            candidates = {n: 0 for n, j in enumerate(self._joined) if q in j}
+
+        scored = []
+        for n, common in candidates.items():
+            ks = self._keys[n]
+            score = common / max(len(qgrams), 1)
+            if any(k == q for k in ks):
+                score += 3
+            elif any(k.startswith(q) for k in ks):
+                score += 2
+            elif any(q in k for k in ks):
+                score += 1
+            if score >= 0.5:
+                scored.append((-score, n))
+        scored.sort()
+        return [self.cars[n] for _, n in scored[:limit]]
+
+
+def car_registry(client) -> CarRegistry:
+    """Реестр машин по снимку листа: строится один раз на снимок."""
+    reg = sheet_derived(get_ws(client, CARS_SHEET), "registry", CarRegistry)
+    if reg is not _REMINDER_SRC:
+        reminders_rebuild(reg)   # даты могли поменяться — переставим напоминания
+    return reg
+
+
+def _same_car(values: list, car: Car, header: list) -> bool:
+    if car.id:
+        return bool(values) and (values[0] or "").strip() == car.id
     try:
-        name_idx = header.index(name_header)
+        i = header.index("Название")
     except ValueError:
-        return None
-    for i, r in enumerate(rows[1:], start=2):
-        if name_idx < len(r) and r[name_idx].strip() == name.strip():
-            return i
-    return None
+        return False
+    return i < len(values) and (values[i] or "").strip() == car.name
 
-def _find_row_by_id(ws, car_id: str) -> int | None:
-    """Вернёт индекс строки (2..N) по ID (первый столбец), иначе None."""
-    rows = ws.get_all_values()
-    if not rows:
-        return None
-    for i, r in enumerate(rows[1:], start=2):
-        if r and r[0].strip() == car_id.strip():
-            return i
+
+def find_car(client, car_id: str = "", name: str = "", verify: bool = False) -> Optional[Car]:
+    """
+    Машина по ID или названию из реестра. verify=True — перед записью убедиться,
+    что строка в листе не съехала (правки руками); иначе реестр перечитывается.
+    """
+    ws = get_ws(client, CARS_SHEET)
+    for attempt in range(2):
+        if attempt:
+            note_sheet_write(CARS_SHEET)   # кэш разошёлся с листом — перечитаем
+        reg = car_registry(client)
+        car = reg.by_id.get(car_id.strip()) if car_id else reg.by_name.get(name.strip())
+        if car is None:
+            if verify:
+                continue
+            return None
+        if not verify or _same_car(ws.row_values(car.row), car, reg.header):
+            return car
     return None
 
+
+def editcar_callback(car: Car) -> str:
+    """Кнопка «открыть машину» в редакторе: по ID; старые строки без ID — по названию."""
+    return f"editcar:{car.id}" if car.id else f"editcar_select|{car.name}"
+
+
+def _editcar_back(user_data) -> str:
+    ref = user_data.get("edit_car_ref", "")
+    return f"editcar:{ref}" if ref else f"editcar_select|{user_data.get('edit_car_name', '')}"
+
+
+def edited_car(client, user_data, verify: bool = False) -> Optional[Car]:
+    """Машина, открытая в редакторе (по ID, если он был, иначе по названию)."""
+    ref = user_data.get("edit_car_ref", "")
+    if ref:
+        return find_car(client, car_id=ref, verify=verify)
+    return find_car(client, name=user_data.get("edit_car_name", ""), verify=verify)
+
+
+def car_update(client, car: Car, fields: dict) -> None:
+    """Записать поля машины одним batch_update (недостающие колонки создаются) и поправить реестр."""
+    ws = get_ws(client, CARS_SHEET)
+    gen = _sheet_gen(CARS_SHEET)
+    with SheetWriteBatch(ws, car_registry(client).header) as wb:
+        cols = {wb.column(col_name): value for col_name, value in fields.items()}
+        for col, value in cols.items():
+            wb.set_cell(car.row, col, value)
+
+    def apply(rows):
+        rows[0] = list(wb.header)
+        r = rows[car.row - 1]
+        for col, value in cols.items():
+            r.extend([""] * (col - len(r)))
+            r[col - 1] = value
+    patch_snapshot(ws, gen, apply)
+
+
+def car_append(client, row: list) -> None:
+    ws = get_ws(client, CARS_SHEET)
+    gen = _sheet_gen(CARS_SHEET)
+    resp = ws.append_row(row, value_input_option="USER_ENTERED", table_range="A:E")
+    updated = ((resp or {}).get("updates") or {}).get("updatedRange", "")
+    m = re.search(r"!\D*(\d+)", updated)
+
+    def apply(rows):
+        if not m or int(m.group(1)) != len(rows) + 1:
+            raise LookupError("append landed elsewhere")
+        rows.append(list(row))
+    patch_snapshot(ws, gen, apply)
+
+
+def car_delete(client, car: Car) -> None:
+    ws = get_ws(client, CARS_SHEET)
+    gen = _sheet_gen(CARS_SHEET)
+    ws.delete_rows(car.row)
+    patch_snapshot(ws, gen, lambda rows: rows.pop(car.row - 1))
+
 def _format_date_with_days(date_str: str) -> str:
     """
     "ДД.ММ.ГГГГ" или "ДД.ММ.ГГГГ ЧЧ:ММ" -> "ДД.ММ.ГГГГ (N дней)"
@@ -695,6 +1229,8 @@ from telegram import (
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     ReplyKeyboardMarkup,
 )
 from telegram.ext import (
@@ -702,9 +1238,12 @@ from telegram.ext import (
     ContextTypes,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
 )
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -715,62 +1254,1679 @@ GOOGLE_CREDENTIALS_B64 = os.getenv("GOOGLE_CREDENTIALS_B64")
 SPREADSHEET_ID = "1qjVJZUqm1hT5IkrASq-_iL9cc4wDl8fdjvd7KDMWL-U"
 
 # ---- KV в листе "Сводка": две колонки [Ключ | Значение] ----
+# Настройки читаются из памяти: лист загружается один раз и живёт до нашей
+# записи в него, запись — одна ячейка (или одна строка для нового ключа).
 
-def _summary_get(client, key: str, default: str = "") -> str:
-    ws = client.open_by_key(SPREADSHEET_ID).worksheet("Сводка")
-    rows = ws.get_all_values()
-    for r in rows:
-        if not r:
-            continue
-        if (r[0] or "").strip() == key:
-            return (r[1] or "").strip() if len(r) > 1 else default
-    return default
+SUMMARY_SHEET = "Сводка"
 
-def _summary_set(client, key: str, value: str) -> None:
-    ws = client.open_by_key(SPREADSHEET_ID).worksheet("Сводка")
-    rows = ws.get_all_values()
-    # попытка обновить существующую строку
-    for i, r in enumerate(rows, start=1):
-        if r and (r[0] or "").strip() == key:
-            ws.update_cell(i, 2, value)  # кол. B = Значение
-            return
-    # иначе добавим строку
-    ws.append_row([key, value], value_input_option="USER_ENTERED")
 
-def get_initial_balance(client) -> Decimal:
-    s = _summary_get(client, "INITIAL_BALANCE", "0")
-    try:
-        return _to_amount(s)
-    except Exception:
-        return Decimal("0")
+class SettingsStore:
+    """Ключ -> (номер строки, значение) по снимку листа «Сводка». Общий — не мутировать."""
 
-def set_initial_balance(client, val: Decimal) -> None:
+    def __init__(self, rows):
+        self.rows = rows
+        self.values = {}
+        self.row_of = {}
+        for i, r in enumerate(rows, start=1):
+            if not r:
+                continue
+            key = (r[0] or "").strip()
+            if not key or key in self.row_of:
+                continue
+            self.row_of[key] = i
+            if len(r) > 1:
+                self.values[key] = (r[1] or "").strip()
+
+    def get(self, key: str, default: str = "") -> str:
+        return self.values.get(key, default)
+
+    def get_decimal(self, key: str, default: Decimal = Decimal("0")) -> Decimal:
+        s = self.values.get(key)
+        if s is None:
+            return default
+        try:
+            return _to_amount(s)
+        except Exception:
+            return default
+
+    def get_int(self, key: str, default: int = 0) -> int:
+        try:
+            return int(self.values.get(key, ""))
+        except ValueError:
+            return default
+
+
+_SETTINGS = None   # (поколение листа, время загрузки, SettingsStore)
+_SETTINGS_LOCK = threading.Lock()
+
+
+def settings_store(client=None) -> SettingsStore:
+    """
+    Настройки живут как снимок «Сводки»: до нашей записи или SHEET_CACHE_TTL секунд —
+    INITIAL_BALANCE и прочее правят в листе руками, такие правки должны доходить.
+    """
+    global _SETTINGS
+    gen = _sheet_gen(SUMMARY_SHEET)
+    cached = _SETTINGS
+    fresh = cached is not None and cached[0] == gen and time.monotonic() - cached[1] < SHEET_CACHE_TTL
+    CACHES.lookup("settings", None, fresh)
+    if fresh:
+        return cached[2]
+    snap = sheet_snapshot(get_ws(client or get_gspread_client(), SUMMARY_SHEET))
+    store = SettingsStore(snap.rows)
+    if snap.gen == _sheet_gen(SUMMARY_SHEET):
+        _SETTINGS = (snap.gen, snap.fetched_at, store)
+        CACHES.put("settings", None, approx_size(store, {id(snap.rows)}))
+    return store
+
+
+def settings_set(client, key: str, value: str) -> None:
+    """Записать настройку: update одной ячейки B или append новой строки, без перечитывания."""
+    global _SETTINGS
+    ws = get_ws(client, SUMMARY_SHEET)
+    with _SETTINGS_LOCK:
+        store = settings_store(client)
+        gen = _sheet_gen(SUMMARY_SHEET)
+        row = store.row_of.get(key)
+        if row is not None:
+            ws.update_cell(row, 2, value)  # кол. B = Значение
+
+            def apply(rows):
+                r = rows[row - 1]
+                r.extend([""] * (2 - len(r)))
+                r[1] = value
+        else:
+            resp = ws.append_row([key, value], value_input_option="USER_ENTERED")
+            updated = ((resp or {}).get("updates") or {}).get("updatedRange", "")
+            m = re.search(r"!\D*(\d+)", updated)
+
+            def apply(rows):
+                if not m or int(m.group(1)) != len(rows) + 1:
+                    raise LookupError("append landed elsewhere")
+                rows.append([key, value])
+
+        patch_snapshot(ws, gen, apply)
+        cached = _SETTINGS
+        if cached is not None and cached[0] == gen:
+            expected = _gen_after_own_write(gen)
+            snap = _SNAPSHOTS.get(SUMMARY_SHEET)
+            if snap is not None and snap.rows is not None and snap.gen == expected:
+                rows = snap.rows   # снимок уже поправлен — настройки держат его строки, как при загрузке
+            else:
+                rows = [list(r) for r in cached[2].rows]
+                try:
+                    if _sheet_gen(SUMMARY_SHEET) != expected:
+                        raise LookupError("concurrent write")
+                    apply(rows)
+                except LookupError:
+                    _SETTINGS = None
+                    CACHES.drop("settings", None)
+                    return
+            store = SettingsStore(rows)
+            _SETTINGS = (expected, cached[1], store)
+            CACHES.put("settings", None, approx_size(store, {id(snap.rows)} if snap is not None else None))
+
+
+def _summary_get(client, key: str, default: str = "") -> str:
+    return settings_store(client).get(key, default)
+
+def _summary_set(client, key: str, value: str) -> None:
+    settings_set(client, key, value)
+
+def get_initial_balance(client) -> Decimal:
+    return settings_store(client).get_decimal("INITIAL_BALANCE")
+
+def set_initial_balance(client, val: Decimal) -> None:
     _summary_set(client, "INITIAL_BALANCE", str(val.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)))
 
 
 
-def get_gspread_client():
-    creds_json = base64.b64decode(GOOGLE_CREDENTIALS_B64).decode("utf-8")
-    creds_dict = json.loads(creds_json)
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive",
+# ---- Метрики: задержки хендлеров и вызовы API ----
+# Всё считается в памяти процесса: с момента старта и поминутными окнами за последний час.
+# Гистограммы — с фиксированными корзинами, перцентили по ним приблизительные.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+METRICS_WINDOW_MINUTES = 60
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.lstrip("-").isdigit()}
+
+
+class _Stat:
+    """Счётчик вызовов + сумма времени/байтов + гистограмма задержек."""
+    __slots__ = ("count", "errors", "seconds", "bytes", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds: float, nbytes: int = 0, error: bool = False) -> None:
+        self.count += 1
+        self.errors += error
+        self.seconds += seconds
+        self.bytes += nbytes
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def merge(self, other: "_Stat") -> None:
+        self.count += other.count
+        self.errors += other.errors
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def quantile(self, q: float) -> float:
+        """Оценка перцентиля: линейно внутри корзины, для последней — её нижняя граница."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen, lower = 0, 0.0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            if n and seen + n >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            if bound != float("inf"):
+                lower = bound
+        return lower
+
+
+_METRICS_LOCK = threading.Lock()
+_METRICS_STARTED = time.time()
+_METRICS_TOTAL = collections.defaultdict(_Stat)   # (семейство, ключ) -> _Stat
+_METRICS_WINDOWS = collections.deque()            # (минута, {(семейство, ключ): _Stat})
+
+
+def metric_observe(family: str, key, seconds: float, nbytes: int = 0, error: bool = False) -> None:
+    """Семейства: route — хендлеры, sheets — вызовы таблицы, tg — вызовы Telegram Bot API."""
+    minute = int(time.time() // 60)
+    with _METRICS_LOCK:
+        _METRICS_TOTAL[(family, key)].observe(seconds, nbytes, error)
+        if not _METRICS_WINDOWS or _METRICS_WINDOWS[-1][0] != minute:
+            _METRICS_WINDOWS.append((minute, collections.defaultdict(_Stat)))
+            while _METRICS_WINDOWS[0][0] <= minute - METRICS_WINDOW_MINUTES:
+                _METRICS_WINDOWS.popleft()
+        _METRICS_WINDOWS[-1][1][(family, key)].observe(seconds, nbytes, error)
+
+
+_COUNTERS = collections.Counter()   # (имя, метки) -> значение
+
+
+def metric_inc(name: str, *labels, n: int = 1) -> None:
+    """Простой счётчик: metric_inc("cache", "snapshot", "hit")."""
+    with _METRICS_LOCK:
+        _COUNTERS[(name, labels)] += n
+
+
+def cache_hit(cache: str, hit: bool) -> None:
+    metric_inc("cache", cache, "hit" if hit else "miss")
+
+
+def metric_stats(family: str, last_minutes: Optional[int] = None) -> dict:
+    """ключ -> _Stat (копия): с момента старта или за последние last_minutes минут."""
+    out = collections.defaultdict(_Stat)
+    with _METRICS_LOCK:
+        if last_minutes is None:
+            sources = [_METRICS_TOTAL]
+        else:
+            edge = int(time.time() // 60) - last_minutes
+            sources = [stats for minute, stats in _METRICS_WINDOWS if minute > edge]
+        for stats in sources:
+            for (fam, key), st in stats.items():
+                if fam == family:
+                    out[key].merge(st)
+    return dict(out)
+
+
+def callback_route(data: str) -> str:
+    """"workshop_edit_item:w123" / "report_30" / "income_cat|c1" -> пространство имён кнопки."""
+    ns = re.split(r"[:|]", data or "", 1)[0]
+    return re.sub(r"\d+", "N", ns) or "?"
+
+
+def update_route(update: Update, context) -> str:
+    """Имя маршрута для метрик: кнопка, команда или шаг текстового ввода."""
+    if update.callback_query is not None:
+        return "cb:" + callback_route(update.callback_query.data)
+    if update.inline_query is not None:
+        return "inline"
+    msg = update.effective_message
+    text = (msg.text or "") if msg is not None else ""
+    if text.startswith("/"):
+        parts = text[1:].split()
+        return "cmd:" + (parts[0].split("@")[0] if parts else "?")
+    ud = context.user_data if context.user_data is not None else {}
+    if ud.get("action") or ud.get("step"):
+        return f"text:{ud.get('action') or '-'}/{ud.get('step') or '-'}"
+    return "text"
+
+
+_ROUTE = contextvars.ContextVar("route", default=None)
+
+
+# ---- Метрики в формате Prometheus (необязательно) ----
+# METRICS_PORT=9108 включает HTTP-эндпоинт /metrics; слушаем METRICS_HOST (по умолчанию
+# только localhost). Сервер живёт в своём потоке — отвечает, даже если цикл событий встал.
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+
+def _prom_labels(**labels) -> str:
+    def esc(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+
+def _prom_histogram(out: list, name: str, stats: dict, label_of) -> None:
+    out.append(f"# TYPE {name} histogram")
+    for key, st in sorted(stats.items(), key=lambda kv: str(kv[0])):
+        labels = label_of(key)
+        acc = 0
+        for bound, n in zip(LATENCY_BUCKETS, st.buckets):
+            acc += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            out.append(f"{name}_bucket{_prom_labels(**labels, le=le)} {acc}")
+        out.append(f"{name}_sum{_prom_labels(**labels)} {st.seconds:.6f}")
+        out.append(f"{name}_count{_prom_labels(**labels)} {st.count}")
+
+
+def prometheus_text() -> str:
+    out = []
+    routes = metric_stats("route")
+    out.append("# TYPE bot_updates_total counter")
+    for route, st in sorted(routes.items()):
+        out.append(f"bot_updates_total{_prom_labels(route=route)} {st.count}")
+    out.append("# TYPE bot_handler_errors_total counter")
+    for route, st in sorted(routes.items()):
+        out.append(f"bot_handler_errors_total{_prom_labels(route=route)} {st.errors}")
+    _prom_histogram(out, "bot_handler_latency_seconds", routes, lambda k: {"route": k})
+
+    sheets = metric_stats("sheets")
+    out.append("# TYPE bot_sheets_calls_total counter")
+    for (title, op), st in sorted(sheets.items()):
+        out.append(f"bot_sheets_calls_total{_prom_labels(worksheet=title, method=op)} {st.count}")
+    out.append("# TYPE bot_sheets_errors_total counter")
+    for (title, op), st in sorted(sheets.items()):
+        out.append(f"bot_sheets_errors_total{_prom_labels(worksheet=title, method=op)} {st.errors}")
+    out.append("# TYPE bot_sheets_response_bytes_total counter")
+    for (title, op), st in sorted(sheets.items()):
+        out.append(f"bot_sheets_response_bytes_total{_prom_labels(worksheet=title, method=op)} {st.bytes}")
+    _prom_histogram(out, "bot_sheets_latency_seconds", sheets, lambda k: {"worksheet": k[0], "method": k[1]})
+
+    tg = metric_stats("tg")
+    out.append("# TYPE bot_telegram_calls_total counter")
+    for method, st in sorted(tg.items()):
+        out.append(f"bot_telegram_calls_total{_prom_labels(method=method)} {st.count}")
+    out.append("# TYPE bot_telegram_errors_total counter")
+    for method, st in sorted(tg.items()):
+        out.append(f"bot_telegram_errors_total{_prom_labels(method=method)} {st.errors}")
+
+    with _METRICS_LOCK:
+        caches = sorted((labels, n) for (name, labels), n in _COUNTERS.items() if name == "cache")
+    out.append("# TYPE bot_cache_requests_total counter")
+    for (cache, result), n in caches:
+        out.append(f"bot_cache_requests_total{_prom_labels(cache=cache, result=result)} {n}")
+    with _METRICS_LOCK:
+        evictions = sorted((labels, n) for (name, labels), n in _COUNTERS.items() if name == "cache_evictions")
+    out.append("# TYPE bot_cache_evictions_total counter")
+    for (cache,), n in evictions:
+        out.append(f"bot_cache_evictions_total{_prom_labels(cache=cache)} {n}")
+    usage = CACHES.usage()
+    out.append("# TYPE bot_cache_entries gauge")
+    for cache, (n, _) in sorted(usage.items()):
+        out.append(f"bot_cache_entries{_prom_labels(cache=cache)} {n}")
+    out.append("# TYPE bot_cache_bytes gauge")
+    for cache, (_, nbytes) in sorted(usage.items()):
+        out.append(f"bot_cache_bytes{_prom_labels(cache=cache)} {nbytes}")
+    out.append("# TYPE bot_cache_budget_bytes gauge")
+    out.append(f"bot_cache_budget_bytes {CACHES.budget:.0f}")
+
+    with _METRICS_LOCK:
+        stalls = sorted((labels, n) for (name, labels), n in _COUNTERS.items() if name == "loop_stall")
+    out.append("# TYPE bot_loop_stalls_total counter")
+    for (site,), n in stalls:
+        out.append(f"bot_loop_stalls_total{_prom_labels(site=site)} {n}")
+
+    out.append("# TYPE bot_outbox_depth gauge")
+    out.append(f"bot_outbox_depth {len(_OUTBOX)}")
+    _prom_histogram(out, "bot_loop_lag_seconds", metric_stats("loop"), lambda k: {})
+    out.append("# TYPE bot_uptime_seconds gauge")
+    out.append(f"bot_uptime_seconds {time.time() - _METRICS_STARTED:.0f}")
+    return "\n".join(out) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def metrics_server_start() -> None:
+    if not METRICS_PORT:
+        return
+    try:
+        server = http.server.ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"metrics endpoint {METRICS_HOST}:{METRICS_PORT} failed: {e}")
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+# ---- Бюджет вызовов таблицы на одно обновление ----
+# Считаем чтения/записи/байты и общее время обновления, включая фоновые задачи,
+# запущенные хендлером (дорисовка экрана, отложенные сообщения). Превысили — warning
+# в лог одной JSON-строкой с местами вызовов, чтобы регрессии было видно сразу.
+
+API_BUDGET_READS = int(os.getenv("API_BUDGET_READS", "8"))
+API_BUDGET_WRITES = int(os.getenv("API_BUDGET_WRITES", "6"))
+API_BUDGET_BYTES = int(os.getenv("API_BUDGET_BYTES", str(2 * 1024 * 1024)))
+API_BUDGET_SECONDS = float(os.getenv("API_BUDGET_SECONDS", "5"))
+
+# наши обёртки над чтением — место вызова ищем выше них
+_CALL_SITE_SKIP = {
+    "request", "note_sheets_call", "note", "_call_site", "_singleflight", "load",
+    "sheet_snapshot", "sheet_derived", "read_values", "get_ws",
+}
+
+
+def _call_site(depth: int = 3) -> str:
+    """Ближайшие функции бота над вызовом gspread: "get_frozen_total:812 < compute_balance:840"."""
+    sites = []
+    f = sys._getframe(1)
+    while f is not None and len(sites) < depth:
+        code = f.f_code
+        if code.co_filename == __file__ and code.co_name not in _CALL_SITE_SKIP:
+            sites.append(f"{code.co_name}:{f.f_lineno}")
+        f = f.f_back
+    return " < ".join(sites) or "?"
+
+
+class UpdateBudget:
+    """Счётчики одного обновления. Живёт, пока держат хендлер и его фоновые задачи."""
+
+    def __init__(self, route: str):
+        self.route = route
+        self.started = time.perf_counter()
+        self.reads = 0
+        self.writes = 0
+        self.bytes = 0
+        self.sites = collections.Counter()
+        self._holders = 0
+        self._lock = threading.Lock()
+
+    def note(self, method: str, nbytes: int) -> None:
+        site = _call_site()
+        with self._lock:
+            if method == "get":
+                self.reads += 1
+            else:
+                self.writes += 1
+            self.bytes += nbytes
+            self.sites[site] += 1
+
+    def hold(self) -> None:
+        with self._lock:
+            self._holders += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._holders -= 1
+            done = self._holders == 0
+        if done:
+            self.check()
+
+    def check(self) -> None:
+        wall = time.perf_counter() - self.started
+        over = []
+        if self.reads > API_BUDGET_READS:
+            over.append("reads")
+        if self.writes > API_BUDGET_WRITES:
+            over.append("writes")
+        if self.bytes > API_BUDGET_BYTES:
+            over.append("bytes")
+        if wall > API_BUDGET_SECONDS:
+            over.append("wall")
+        if not over:
+            return
+        logger.warning("api budget exceeded " + json.dumps({
+            "route": self.route,
+            "over": over,
+            "reads": self.reads,
+            "writes": self.writes,
+            "bytes": self.bytes,
+            "wall_s": round(wall, 3),
+            "sites": dict(self.sites.most_common(10)),
+        }, ensure_ascii=False))
+
+
+_BUDGET = contextvars.ContextVar("api_budget", default=None)
+
+
+# ---- Профайлер по запросу: сэмплирование стеков ----
+# /profile включает поток, который раз в PROFILE_INTERVAL секунд снимает стеки всех
+# потоков (sys._current_frames) и раскладывает их по маршрутам. Маршрут берётся из
+# контекста задачи asyncio или функции из asyncio.to_thread, так что фоновая дорисовка
+# и работа в потоках попадают к своему обновлению. Выключен — ни потока, ни хуков.
+
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 15
+
+
+def _frame_route(f):
+    """Кадр, запускающий код в контексте (Handle._run asyncio / _WorkItem.run пула) -> маршрут."""
+    if f.f_code.co_name not in ("_run", "run"):
+        return None
+    owner = f.f_locals.get("self")
+    if isinstance(owner, asyncio.Handle):
+        ctx = owner._context
+    elif type(owner).__name__ == "_WorkItem":
+        # asyncio.to_thread: fn = functools.partial(ctx.run, func, ...)
+        ctx = getattr(getattr(owner.fn, "func", None), "__self__", None)
+    else:
+        return None
+    if isinstance(ctx, contextvars.Context):
+        return ctx.get(_ROUTE)
+    return None
+
+
+class StackSampler:
+    """Сэмплы стеков по маршрутам: route -> Counter(стек снаружи внутрь -> число сэмплов)."""
+
+    def __init__(self, updates: int, seconds: float, chat_id: int, bot, as_pstats: bool):
+        self.updates_left = updates
+        self.seconds = seconds
+        self.chat_id = chat_id
+        self.bot = bot
+        self.as_pstats = as_pstats
+        self.samples = collections.defaultdict(collections.Counter)
+        self.started = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="stack-sampler", daemon=True)
+        self._timer = None
+
+    def start(self) -> None:
+        self._thread.start()
+        self._timer = asyncio.get_running_loop().call_later(self.seconds, self.finish)
+
+    def _loop(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(PROFILE_INTERVAL):
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack, route, f = [], None, frame
+                while f is not None:
+                    route = _frame_route(f)
+                    if route is not None:
+                        break
+                    code = f.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    f = f.f_back
+                if route is not None and stack:
+                    self.samples[route][tuple(reversed(stack))] += 1
+
+    def count_update(self, route: str) -> None:
+        if route == "cmd:profile":   # сама команда включения не в счёт
+            return
+        self.updates_left -= 1
+        if self.updates_left <= 0:
+            self.finish()
+
+    def finish(self) -> None:
+        global _PROFILER
+        if _PROFILER is not self:
+            return
+        _PROFILER = None
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.cancel()
+        _spawn(self._report())
+
+    def pstats_dict(self, route: str) -> dict:
+        """Сэмплы маршрута в формате pstats: {(file, line, func): (cc, nc, tt, ct, callers)}."""
+        own = collections.Counter()
+        cum = collections.Counter()
+        callers = collections.defaultdict(collections.Counter)
+        for stack, n in self.samples[route].items():
+            own[stack[-1]] += n
+            for func in set(stack):
+                cum[func] += n
+            for caller, callee in set(zip(stack, stack[1:])):
+                callers[callee][caller] += n
+        dt = PROFILE_INTERVAL
+        return {
+            func: (
+                cum[func], cum[func], own[func] * dt, cum[func] * dt,
+                {c: (k, k, 0.0, k * dt) for c, k in callers[func].items()},
+            )
+            for func in cum
+        }
+
+    def report_text(self) -> str:
+        elapsed = time.monotonic() - self.started
+        routes = sorted(self.samples.items(), key=lambda kv: -sum(kv[1].values()))
+        if not routes:
+            return f"🔬 Профиль за {elapsed:.0f} с: ни одного сэмпла в хендлерах."
+        parts = [f"🔬 Профиль за {elapsed:.0f} с (сэмпл раз в {PROFILE_INTERVAL * 1000:.0f} мс)"]
+        for route, stacks in routes:
+            total = sum(stacks.values())
+            stats = self.pstats_dict(route)
+            lines = [f"\n{route}: {total} сэмплов ≈ {total * PROFILE_INTERVAL:.2f} с"]
+            top = sorted(stats.items(), key=lambda kv: -kv[1][3])[:PROFILE_TOP]
+            for (filename, line, name), (_, nc, tt, ct, _) in top:
+                lines.append(
+                    f"  {100 * nc / total:5.1f}% {ct:6.2f}s (своё {tt:.2f}s) "
+                    f"{name} ({os.path.basename(filename)}:{line})"
+                )
+            parts.append("\n".join(lines))
+        return "\n".join(parts)
+
+    async def _report(self) -> None:
+        # сэмплер мог быть посреди прохода — ждём, пока он выйдет, и только потом читаем samples
+        await asyncio.to_thread(self._thread.join)
+        try:
+            for chunk in split_message(self.report_text()):
+                await self.bot.send_message(self.chat_id, chunk)
+            if self.as_pstats:
+                for route in self.samples:
+                    data = marshal.dumps(self.pstats_dict(route))
+                    name = re.sub(r"[^\w.-]+", "_", route) + ".pstats"
+                    await self.bot.send_document(self.chat_id, document=io.BytesIO(data), filename=name)
+        except Exception as e:
+            logger.error(f"profile report error: {e}")
+
+
+_PROFILER = None   # активный StackSampler или None
+
+
+# ---- Сторож цикла событий ----
+# Задача в цикле каждые LOOP_LAG_INTERVAL секунд отмечается и пишет задержку своего
+# пробуждения в гистограмму "loop". Поток-сторож следит за отметками: если цикл молчит
+# дольше LOOP_LAG_THRESHOLD, он снимает стек потока цикла — это и есть блокирующий вызов
+# (обычно синхронный gspread прямо в корутине). Когда цикл оживает, блокировка уходит
+# в лог и в /stats вместе с маршрутом и местом в коде.
+
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+LOOP_STALLS_KEEP = 20
+LOOP_STACK_DEPTH = 12
+
+_LOOP_LOCK = threading.Lock()
+_LOOP_THREAD = None                                   # ident потока цикла событий
+_LOOP_BEAT = 0.0                                      # time.monotonic() последней отметки
+_LOOP_CAPTURE = None                                  # снимок текущей блокировки (от сторожа)
+_LOOP_STALLS = collections.deque(maxlen=LOOP_STALLS_KEEP)
+_LOOP_STALL_SITES = collections.Counter()             # место в bot.py -> число блокировок
+
+
+def _loop_capture(frame, beat: float) -> dict:
+    """
+    Стек потока цикла изнутри наружу до Handle._run: маршрут, место в bot.py (выше наших
+    обёрток над gspread) и кадры — самый внутренний плюс все кадры бота.
+    """
+    route, site, stack, f = None, None, [], frame
+    while f is not None:
+        route = _frame_route(f)
+        if route is not None:
+            break
+        code = f.f_code
+        ours = code.co_filename == __file__
+        if site is None and ours and code.co_name not in _CALL_SITE_SKIP:
+            site = f"{code.co_name}:{f.f_lineno}"
+        if ours or not stack:
+            stack.append(f"{os.path.basename(code.co_filename)}:{f.f_lineno} {code.co_name}")
+        f = f.f_back
+    return {
+        "beat": beat,
+        "route": route or "?",
+        "site": site or "?",
+        "stack": stack[:LOOP_STACK_DEPTH],
+    }
+
+
+def _loop_watchdog() -> None:
+    step = min(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD) / 2
+    global _LOOP_CAPTURE
+    while True:
+        time.sleep(step)
+        beat = _LOOP_BEAT
+        if time.monotonic() - beat - LOOP_LAG_INTERVAL < LOOP_LAG_THRESHOLD:
+            continue
+        with _LOOP_LOCK:
+            if _LOOP_CAPTURE is not None and _LOOP_CAPTURE["beat"] == beat:
+                continue   # эту блокировку уже сняли
+        frame = sys._current_frames().get(_LOOP_THREAD)
+        if frame is None:
+            continue
+        capture = _loop_capture(frame, beat)
+        del frame
+        with _LOOP_LOCK:
+            _LOOP_CAPTURE = capture
+
+
+def _loop_stall_done(beat: float, lag: float) -> None:
+    global _LOOP_CAPTURE
+    with _LOOP_LOCK:
+        capture, _LOOP_CAPTURE = _LOOP_CAPTURE, None
+    if capture is None or capture["beat"] != beat:
+        # сторож не успел (блокировка чуть выше порога) — стека нет
+        capture = {"route": "?", "site": "?", "stack": []}
+    stall = {
+        "at": time.time(),
+        "lag": lag,
+        "route": capture["route"],
+        "site": capture["site"],
+        "stack": capture["stack"],
+    }
+    with _LOOP_LOCK:
+        _LOOP_STALLS.append(stall)
+        _LOOP_STALL_SITES[stall["site"]] += 1
+    metric_inc("loop_stall", stall["site"])
+    logger.warning(
+        f"event loop blocked {lag:.2f}s route={stall['route']} at {stall['site']}"
+        + "".join(f"\n    {line}" for line in reversed(stall["stack"]))
+    )
+
+
+async def _loop_lag_probe() -> None:
+    """Насколько позже заказанного просыпается sleep — столько цикл событий был занят."""
+    global _LOOP_THREAD, _LOOP_BEAT
+    loop = asyncio.get_running_loop()
+    _LOOP_THREAD = threading.get_ident()
+    _LOOP_BEAT = time.monotonic()
+    threading.Thread(target=_loop_watchdog, name="loop-watchdog", daemon=True).start()
+    while True:
+        beat = _LOOP_BEAT = time.monotonic()
+        t0 = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - t0 - LOOP_LAG_INTERVAL)
+        metric_observe("loop", "lag", lag)
+        if lag >= LOOP_LAG_THRESHOLD:
+            _loop_stall_done(beat, lag)
+
+
+def loop_stalls_text(last: int = 5, top: int = 5) -> str:
+    with _LOOP_LOCK:
+        stalls = list(_LOOP_STALLS)[-last:]
+        sites = _LOOP_STALL_SITES.most_common(top)
+    if not stalls:
+        return f"Блокировок цикла дольше {_fmt_ms(LOOP_LAG_THRESHOLD)} мс не было."
+    lines = [f"Блокировки цикла > {_fmt_ms(LOOP_LAG_THRESHOLD)} мс, по месту в коде:"]
+    lines += [f"  {site}: {n}" for site, n in sites]
+    lines.append("Последние:")
+    for st in reversed(stalls):
+        at = datetime.datetime.fromtimestamp(st["at"]).strftime("%H:%M:%S")
+        lines.append(f"  {at} {_fmt_ms(st['lag'])} мс {st['route']} @ {st['site']}")
+        callers = [line for line in st["stack"][1:] if line.rsplit(" ", 1)[-1] not in _CALL_SITE_SKIP]
+        lines += [f"      {line}" for line in callers[:3]]
+    return "\n".join(lines)
+
+
+def instrumented(handler):
+    """Обёртка хендлера верхнего уровня: время и число вызовов по маршруту."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        route = update_route(update, context)
+        token = _ROUTE.set(route)
+        budget = UpdateBudget(route)
+        budget.hold()
+        budget_token = _BUDGET.set(budget)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(update, context)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            metric_observe("route", route, time.perf_counter() - started, error=failed)
+            if _PROFILER is not None:
+                _PROFILER.count_update(route)
+            _BUDGET.reset(budget_token)
+            _ROUTE.reset(token)
+            budget.release()
+
+    return wrapper
+
+
+def _sheets_call_target(method: str, endpoint: str, params, body) -> tuple:
+    """Вызов gspread -> (операция, [листы])."""
+    tail = endpoint.split("/spreadsheets/", 1)[-1]
+    if "/values/" in tail:
+        rng, verb = tail.split("/values/", 1)[1], ""
+        m = re.fullmatch(r"(.*):(append|clear)", rng)
+        if m:
+            rng, verb = m.groups()
+        op = "values." + (verb or ("get" if method == "get" else "update"))
+        return op, [_sheet_title_from_range(unquote(rng))]
+    if tail.endswith("values:batchGet"):
+        ranges = (params or {}).get("ranges") or []
+        if isinstance(ranges, str):
+            ranges = [ranges]
+        return "values.batchGet", sorted({_sheet_title_from_range(r) for r in ranges}) or ["*"]
+    if tail.endswith("values:batchUpdate") and isinstance(body, dict):
+        titles = {_sheet_title_from_range(d.get("range", "")) for d in body.get("data", [])}
+        return "values.batchUpdate", sorted(titles) or ["*"]
+    if tail.endswith(":batchUpdate") and isinstance(body, dict):
+        titles = set()
+        for req in body.get("requests", []):
+            inner = next(iter(req.values()), {}) if len(req) == 1 else {}
+            sheet_id = inner.get("sheetId", (inner.get("range") or {}).get("sheetId"))
+            titles.add(_sheet_title_by_id(sheet_id) or "*")
+        return "batchUpdate", sorted(titles) or ["*"]
+    return ("metadata" if method == "get" else method), ["*"]
+
+
+def note_sheets_call(method, endpoint, params, body, seconds: float, nbytes: int, error: bool) -> None:
+    budget = _BUDGET.get()
+    if budget is not None:
+        budget.note(method, nbytes)
+    op, titles = _sheets_call_target(method, endpoint, params, body)
+    share = nbytes // len(titles)
+    for title in titles:
+        metric_observe("sheets", (title, op), seconds, share, error)
+
+
+class _TelegramRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы Bot API по методам."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        started = time.perf_counter()
+        failed = True
+        nbytes = 0
+        try:
+            code, payload = await super().do_request(url, method, request_data=request_data, **kwargs)
+            failed = code >= 400
+            nbytes = len(payload or b"")
+            return code, payload
+        finally:
+            metric_observe("tg", url.rsplit("/", 1)[-1], time.perf_counter() - started, nbytes, failed)
+
+
+def is_admin(update: Update) -> bool:
+    user = update.effective_user
+    return user is not None and user.id in ADMIN_IDS
+
+
+def _fmt_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}"
+
+
+def _stats_block(last_minutes: Optional[int], top: int = 10) -> str:
+    lines = []
+    routes = metric_stats("route", last_minutes)
+    lines.append("Маршруты (n, p50/p95/p99 мс, ошибки), по суммарному времени:")
+    for key, st in sorted(routes.items(), key=lambda kv: -kv[1].seconds)[:top]:
+        lines.append(
+            f"  {key}: {st.count}, {_fmt_ms(st.quantile(0.5))}/{_fmt_ms(st.quantile(0.95))}/"
+            f"{_fmt_ms(st.quantile(0.99))}" + (f", ошибок {st.errors}" if st.errors else "")
+        )
+    if not routes:
+        lines.append("  —")
+
+    sheets = metric_stats("sheets", last_minutes)
+    by_sheet = collections.defaultdict(_Stat)
+    for (title, op), st in sheets.items():
+        by_sheet[title].merge(st)
+    lines.append("Таблица по листам (вызовы, КБ, p95 мс):")
+    for title, st in sorted(by_sheet.items(), key=lambda kv: -kv[1].count)[:top]:
+        ops = ", ".join(
+            f"{op} {s.count}" for (t, op), s in sorted(sheets.items(), key=lambda kv: -kv[1].count) if t == title
+        )
+        lines.append(f"  {title}: {st.count}, {st.bytes / 1024:.0f} КБ, {_fmt_ms(st.quantile(0.95))} ({ops})")
+    if not sheets:
+        lines.append("  —")
+
+    tg = metric_stats("tg", last_minutes)
+    lines.append("Telegram API (вызовы, p95 мс):")
+    for method, st in sorted(tg.items(), key=lambda kv: -kv[1].count)[:top]:
+        lines.append(f"  {method}: {st.count}, {_fmt_ms(st.quantile(0.95))}" + (f", ошибок {st.errors}" if st.errors else ""))
+    if not tg:
+        lines.append("  —")
+
+    lag = metric_stats("loop", last_minutes).get("lag")
+    if lag is not None:
+        lines.append(
+            f"Задержка цикла событий p50/p95/p99 мс: {_fmt_ms(lag.quantile(0.5))}/"
+            f"{_fmt_ms(lag.quantile(0.95))}/{_fmt_ms(lag.quantile(0.99))}"
+        )
+    return "\n".join(lines)
+
+
+def cache_stats_text() -> str:
+    with _METRICS_LOCK:
+        counters = dict(_COUNTERS)
+    lines = [f"Кэши ({_fmt_bytes(CACHES.used)} из {CACHE_BUDGET_MB:g} МБ; попадания/промахи/выселения, записей, объём):"]
+    for cache, (n, nbytes) in sorted(CACHES.usage().items(), key=lambda kv: -kv[1][1]):
+        hits = counters.get(("cache", (cache, "hit")), 0)
+        misses = counters.get(("cache", (cache, "miss")), 0)
+        evicted = counters.get(("cache_evictions", (cache,)), 0)
+        lines.append(f"  {cache}: {hits}/{misses}/{evicted}, {n}, {_fmt_bytes(nbytes)}")
+    return "\n".join(lines)
+
+
+def stats_text() -> str:
+    uptime = datetime.timedelta(seconds=int(time.time() - _METRICS_STARTED))
+    return (
+        f"📈 Статистика (аптайм {uptime})\n\n"
+        f"— За последний час —\n{_stats_block(METRICS_WINDOW_MINUTES)}\n\n"
+        f"— С момента старта —\n{_stats_block(None)}\n\n"
+        f"{cache_stats_text()}\n\n"
+        f"{loop_stalls_text()}"
+    )
+
+
+# ---- Память: размеры кэшей, общий LRU и снимки tracemalloc ----
+# Размер записи — обход объектов с sys.getsizeof; у длинных списков и словарей (строки
+# листа) меряем равномерную выборку и пересчитываем на всю длину. Общий объект
+# считается у первого владельца: строки листа — у снимка, а не у индекса поверх них.
+# Все кэши регистрируются в CACHES: записи учитываются в байтах, и при превышении
+# CACHE_BUDGET_MB выселяются давно не использованные — из любого кэша.
+# Отдельные лимиты (0 — без ограничения): SNAPSHOT_CACHE_MB на снимки листов,
+# SCREEN_CACHE_MAX на число экранов.
+
+CACHE_BUDGET_MB = float(os.getenv("CACHE_BUDGET_MB", "256"))
+SNAPSHOT_CACHE_MB = float(os.getenv("SNAPSHOT_CACHE_MB", "0"))
+SCREEN_CACHE_MAX = int(os.getenv("SCREEN_CACHE_MAX", "500"))
+SIZE_SAMPLE = 200
+MEM_TOP = 15
+
+_SIZE_LEAVES = (str, bytes, int, float, bool, Decimal, type(None), datetime.date, datetime.time)
+
+
+def approx_size(obj, seen: Optional[set] = None) -> int:
+    """Примерный размер объекта в байтах со всем, на что он ссылается."""
+    seen = set() if seen is None else seen
+    total = 0.0
+    stack = [(obj, 1.0)]
+    while stack:
+        o, weight = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o) * weight
+        if isinstance(o, _SIZE_LEAVES) or isinstance(o, type) or callable(o):
+            continue
+        if isinstance(o, dict):
+            items = list(o.items())
+        elif isinstance(o, (list, tuple)):
+            items = o
+        elif isinstance(o, (set, frozenset, collections.deque)):
+            items = list(o)
+        else:
+            items = list(getattr(o, "__dict__", {}).values())
+            for cls in type(o).__mro__:
+                for name in getattr(cls, "__slots__", ()):
+                    if hasattr(o, name) and name != "__dict__":
+                        items.append(getattr(o, name))
+        n = len(items)
+        if n > SIZE_SAMPLE:
+            step = n / SIZE_SAMPLE
+            items = [items[int(i * step)] for i in range(SIZE_SAMPLE)]
+            weight *= n / SIZE_SAMPLE
+        for item in items:
+            if isinstance(o, dict):
+                stack.append((item[0], weight))
+                stack.append((item[1], weight))
+            else:
+                stack.append((item, weight))
+    return int(total)
+
+
+class CacheManager:
+    """
+    Общий LRU по записям всех кэшей: (кэш, ключ) -> байты. Сами данные живут у владельцев
+    (_SNAPSHOTS, _SCREEN_CACHE, ...), менеджер только ведёт учёт и при нехватке бюджета
+    вызывает evict(ключ) зарегистрированного кэша.
+    """
+
+    def __init__(self, budget_bytes: float):
+        self.budget = budget_bytes
+        self.used = 0
+        self._entries = collections.OrderedDict()   # (кэш, ключ) -> байты, старые в начале
+        self._caches = {}                            # кэш -> (evict, max_bytes, max_entries)
+        self._lock = threading.RLock()
+
+    def register(self, cache: str, evict, max_bytes: float = 0, max_entries: int = 0) -> None:
+        self._caches[cache] = (evict, max_bytes, max_entries)
+
+    def lookup(self, cache: str, key, hit: bool) -> None:
+        """Отметить обращение к кэшу; попадание поднимает запись в конец очереди."""
+        cache_hit(cache, hit)
+        if hit:
+            with self._lock:
+                if (cache, key) in self._entries:
+                    self._entries.move_to_end((cache, key))
+
+    def put(self, cache: str, key, nbytes: int) -> None:
+        """Запись добавлена или заменена; потом выселяем лишнее (кроме неё самой)."""
+        with self._lock:
+            self.used += nbytes - self._entries.pop((cache, key), 0)
+            self._entries[(cache, key)] = nbytes
+            self._trim(keep=(cache, key))
+
+    def drop(self, cache: str, key) -> None:
+        """Владелец сам выбросил запись."""
+        with self._lock:
+            self.used -= self._entries.pop((cache, key), 0)
+
+    def discard(self, cache: str, match) -> None:
+        """Владелец сам выбросил записи, для ключей которых match(ключ) истинно."""
+        with self._lock:
+            for entry in [e for e in self._entries if e[0] == cache and match(e[1])]:
+                self.used -= self._entries.pop(entry)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.used = 0
+
+    def usage(self) -> dict:
+        """кэш -> (записей, байт)."""
+        out = {cache: [0, 0] for cache in self._caches}
+        with self._lock:
+            for (cache, _), nbytes in self._entries.items():
+                out.setdefault(cache, [0, 0])
+                out[cache][0] += 1
+                out[cache][1] += nbytes
+        return {cache: tuple(v) for cache, v in out.items()}
+
+    def _trim(self, keep) -> None:
+        per_cache = collections.Counter()
+        counts = collections.Counter()
+        for (cache, _), nbytes in self._entries.items():
+            per_cache[cache] += nbytes
+            counts[cache] += 1
+        victims = []
+        used = self.used
+        for entry, nbytes in self._entries.items():
+            cache = entry[0]
+            _, max_bytes, max_entries = self._caches.get(cache, (None, 0, 0))
+            over_cache = (max_bytes > 0 and per_cache[cache] > max_bytes) or (
+                max_entries > 0 and counts[cache] > max_entries
+            )
+            if entry == keep or not (over_cache or (self.budget > 0 and used > self.budget)):
+                continue
+            victims.append(entry)
+            used -= nbytes
+            per_cache[cache] -= nbytes
+            counts[cache] -= 1
+        for entry in victims:
+            self._evict(entry)
+
+    def _evict(self, entry) -> None:
+        cache, key = entry
+        nbytes = self._entries.pop(entry, None)
+        if nbytes is None:
+            return
+        self.used -= nbytes
+        metric_inc("cache_evictions", cache)
+        evict = self._caches.get(cache, (None,))[0]
+        if evict is not None:
+            try:
+                evict(key)
+            except Exception as e:
+                logger.error(f"cache {cache} evict {key!r} error: {e}")
+
+
+CACHES = CacheManager(CACHE_BUDGET_MB * 1024 * 1024)
+
+
+def _evict_snapshot(title: str) -> None:
+    _SNAPSHOTS.pop(title, None)
+    CACHES.discard("derived", lambda key: key[0] == title)
+
+
+def _evict_derived(key: tuple) -> None:
+    title, name = key
+    snap = _SNAPSHOTS.get(title)
+    if snap is not None:
+        snap.derived.pop(name, None)
+
+
+def _evict_categories(_key) -> None:
+    global _CATEGORY_REG
+    _CATEGORY_REG = None
+
+
+def _evict_settings(_key) -> None:
+    global _SETTINGS
+    _SETTINGS = None
+
+
+CACHES.register("snapshot", _evict_snapshot, max_bytes=SNAPSHOT_CACHE_MB * 1024 * 1024)
+CACHES.register("derived", _evict_derived)
+CACHES.register("screen", lambda key: _SCREEN_CACHE.pop(key, None), max_entries=SCREEN_CACHE_MAX)
+CACHES.register("categories", _evict_categories)
+CACHES.register("settings", _evict_settings)
+
+
+def _fmt_bytes(n: float) -> str:
+    if abs(n) >= 1024 * 1024:
+        return f"{n / 1024 / 1024:.1f} МБ"
+    return f"{n / 1024:.0f} КБ"
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+_CACHE_NAMES = {
+    "snapshot": "Снимки листов",
+    "derived": "Индексы по снимкам",
+    "categories": "Реестр категорий",
+    "settings": "Настройки",
+    "screen": "Экраны",
+}
+
+
+def cache_sizes(user_data=None) -> list:
+    """
+    [(название, записей, байт)]: кэши из CACHES — по их учёту, остальное меряем сейчас;
+    user_data — application.user_data.
+    """
+    out = [(_CACHE_NAMES.get(cache, cache), n, nbytes) for cache, (n, nbytes) in CACHES.usage().items()]
+    # учёт, а не кэш: выбросить запись нельзя, поэтому её нет в CACHES
+    out.append(("Недорисованные экраны", len(_SCREEN_SEQ), approx_size(dict(_SCREEN_SEQ))))
+    out.append(("Строки записей мастерской", len(_WS_RECORD_ROWS), approx_size(dict(_WS_RECORD_ROWS))))
+    out.append(("Outbox", len(_OUTBOX), approx_size(list(_OUTBOX))))
+    if user_data is not None:
+        out.append(("Сессии пользователей", len(user_data), approx_size(dict(user_data))))
+    return out
+
+
+def mem_text(user_data=None) -> str:
+    rss = _rss_bytes()
+    lines = ["🧠 Память" + (f": RSS {_fmt_bytes(rss)}" if rss is not None else "")]
+    lines.append("Кэши (записей, примерно байт):")
+    for name, entries, nbytes in cache_sizes(user_data):
+        lines.append(f"  {name}: {entries}, {_fmt_bytes(nbytes)}")
+    limits = [
+        f"всего {_fmt_bytes(CACHES.used)} из {CACHE_BUDGET_MB:g} МБ" if CACHE_BUDGET_MB > 0 else "общего лимита нет",
+        f"снимки {SNAPSHOT_CACHE_MB:g} МБ" if SNAPSHOT_CACHE_MB > 0 else "снимки без отдельного лимита",
+        f"экраны {SCREEN_CACHE_MAX}" if SCREEN_CACHE_MAX > 0 else "экраны без лимита",
     ]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    return gspread.authorize(creds)
+    lines.append("Лимиты: " + ", ".join(limits))
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"tracemalloc: {_fmt_bytes(current)} сейчас, пик {_fmt_bytes(peak)}")
+    else:
+        lines.append("tracemalloc выключен: /mem start")
+    return "\n".join(lines)
+
+
+_MEM_SNAPSHOT = None   # предыдущий снимок tracemalloc — с ним сравнивает /mem snap
+
+
+def _mem_take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+
+
+def _mem_site(frame) -> str:
+    return f"{os.path.basename(frame.filename)}:{frame.lineno}"
+
+
+def mem_snapshot_text() -> str:
+    """Снять снимок: топ мест выделения и разница с предыдущим снимком."""
+    global _MEM_SNAPSHOT
+    snap = _mem_take_snapshot()
+    prev, _MEM_SNAPSHOT = _MEM_SNAPSHOT, snap
+    stats = snap.statistics("lineno")
+    lines = [f"📸 Снимок tracemalloc: {_fmt_bytes(sum(s.size for s in stats))} в {len(stats)} местах"]
+    lines.append("Топ мест выделения:")
+    for st in stats[:MEM_TOP]:
+        lines.append(f"  {_fmt_bytes(st.size)}, {st.count} блоков — {_mem_site(st.traceback[0])}")
+    if prev is not None:
+        diff = [d for d in snap.compare_to(prev, "lineno") if d.size_diff]
+        lines.append("С прошлого снимка:")
+        for d in diff[:MEM_TOP]:
+            sign = "+" if d.size_diff > 0 else "−"
+            lines.append(
+                f"  {sign}{_fmt_bytes(abs(d.size_diff))} ({d.count_diff:+d} блоков), "
+                f"всего {_fmt_bytes(d.size)} — {_mem_site(d.traceback[0])}"
+            )
+        if not diff:
+            lines.append("  без изменений")
+    return "\n".join(lines)
+
+
+# ---- Доступ к таблице: клиент и чтение листов ----
+
+_SHEET_GEN = collections.Counter()   # title -> сколько раз мы писали в лист
+_INFLIGHT = {}                       # ключ чтения -> Future общей загрузки
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def _sheet_title_from_range(rng: str) -> str:
+    """"'Доход'!A1:F" -> "Доход"."""
+    title = rng.rsplit("!", 1)[0] if "!" in rng else rng
+    if len(title) >= 2 and title[0] == "'" and title[-1] == "'":
+        title = title[1:-1].replace("''", "'")
+    return title
+
+
+def note_sheet_write(title: Optional[str] = None) -> None:
+    """Отмечает запись в лист (None — структурное изменение, считаем изменёнными все листы)."""
+    if title is None:
+        for t in list(_SHEET_GEN):
+            _SHEET_GEN[t] += 1
+        _SHEET_GEN[None] += 1
+    else:
+        _SHEET_GEN[title] += 1
+
+
+class _SheetsClient(gspread.Client):
+    """gspread.Client, который видит все наши записи в таблицу."""
+
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        started = time.perf_counter()
+        resp = None
+        try:
+            resp = super().request(
+                method, endpoint, params=params, data=data, json=json, files=files, headers=headers,
+            )
+            return resp
+        finally:
+            if method != "get":
+                self._note_write(endpoint, json)
+            note_sheets_call(
+                method, endpoint, params, json, time.perf_counter() - started,
+                len(resp.content) if resp is not None else 0, resp is None,
+            )
+
+    @staticmethod
+    def _note_write(endpoint: str, body) -> None:
+        if "/values/" in endpoint:
+            rng = unquote(endpoint.split("/values/", 1)[1].split(":", 1)[0])
+            note_sheet_write(_sheet_title_from_range(rng))
+        elif endpoint.endswith("values:batchUpdate") and isinstance(body, dict):
+            # один запрос — один шаг поколения каждого задетого листа (см. patch_snapshot)
+            for title in {_sheet_title_from_range(item.get("range", "")) for item in body.get("data", [])}:
+                note_sheet_write(title)
+        elif endpoint.endswith(":batchUpdate") and isinstance(body, dict):
+            # структурные запросы: если все адресованы известным листам — отмечаем только их
+            titles = set()
+            for req in body.get("requests", []):
+                inner = next(iter(req.values()), {}) if len(req) == 1 else {}
+                sheet_id = inner.get("sheetId", (inner.get("range") or {}).get("sheetId"))
+                title = _sheet_title_by_id(sheet_id)
+                if title is None:
+                    note_sheet_write(None)
+                    return
+                titles.add(title)
+            for title in titles:
+                note_sheet_write(title)
+        else:
+            note_sheet_write(None)
+
+
+def _sheet_title_by_id(sheet_id) -> Optional[str]:
+    if sheet_id is None:
+        return None
+    for title, ws in list(_WORKSHEETS.items()):
+        if ws.id == sheet_id:
+            return title
+    return None
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_gspread_client():
+    """Один авторизованный клиент на процесс (токен он обновляет сам)."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            creds_json = base64.b64decode(GOOGLE_CREDENTIALS_B64).decode("utf-8")
+            creds_dict = json.loads(creds_json)
+            scope = [
+                "https://spreadsheets.google.com/feeds",
+                "https://www.googleapis.com/auth/drive",
+            ]
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+            _CLIENT = _SheetsClient(auth=creds)
+        return _CLIENT
+
+
+# реестр листов: open_by_key() и worksheet() — это по запросу метаданных на каждый вызов
+_WORKSHEETS = {}   # title -> gspread.Worksheet
+_WORKSHEETS_LOCK = threading.Lock()
+
+
+def _load_worksheets(client) -> None:
+    sh = client.open_by_key(SPREADSHEET_ID)
+    fresh = {w.title: w for w in sh.worksheets()}
+    with _WORKSHEETS_LOCK:
+        _WORKSHEETS.clear()
+        _WORKSHEETS.update(fresh)
+
+
+def get_ws(client, title: str):
+    """Лист по названию из реестра; при промахе реестр перечитывается один раз."""
+    ws = _WORKSHEETS.get(title)
+    if ws is None:
+        _singleflight(("worksheets",), lambda: _load_worksheets(client))
+        ws = _WORKSHEETS.get(title)
+    if ws is None:
+        raise gspread.WorksheetNotFound(title)
+    return ws
+
+
+def _singleflight(key, fn):
+    """Одновременные одинаковые запросы делят одну загрузку и её результат."""
+    with _INFLIGHT_LOCK:
+        fut = _INFLIGHT.get(key)
+        leader = fut is None
+        if leader:
+            fut = concurrent.futures.Future()
+            _INFLIGHT[key] = fut
+    if not leader:
+        return fut.result()
+    try:
+        res = fn()
+        fut.set_result(res)
+        return res
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+
+
+# снимки листов целиком: живут SHEET_CACHE_TTL секунд или до нашей записи в лист
+SHEET_CACHE_TTL = float(os.getenv("SHEET_CACHE_TTL", "300"))
+
+
+class _Snapshot:
+    __slots__ = ("rows", "gen", "fetched_at", "derived", "fingerprint")
+
+    def __init__(self, rows, gen, fetched_at):
+        self.rows = rows    # None — снимок поднят с диска без строк, есть только derived
+        self.gen = gen
+        self.fetched_at = fetched_at
+        self.derived = {}   # посчитанное по этим строкам: name -> value
+        self.fingerprint = None
+
+
+_SNAPSHOTS = {}   # title -> _Snapshot
+
+
+def _sheet_gen(title: str) -> tuple:
+    return _SHEET_GEN[title], _SHEET_GEN[None]
+
+
+def _snapshot_store(title: str, snap: _Snapshot) -> None:
+    """Положить снимок в кэш и учесть в CACHES (посчитанное по старому снимку уходит с ним)."""
+    _SNAPSHOTS[title] = snap
+    CACHES.discard("derived", lambda key: key[0] == title)
+    seen = {id(snap.rows)}
+    for name, value in list(snap.derived.items()):
+        CACHES.put("derived", (title, name), approx_size(value, seen))
+    CACHES.put("snapshot", title, approx_size(snap.rows))
+
+
+def _derived_store(title: str, snap: _Snapshot, name: str, value) -> None:
+    snap.derived[name] = value
+    if _SNAPSHOTS.get(title) is snap:
+        CACHES.put("derived", (title, name), approx_size(value, {id(snap.rows)}))
+
+
+def _snapshot_fresh(title: str, snap) -> bool:
+    return (
+        snap is not None
+        and snap.gen == _sheet_gen(title)
+        and time.monotonic() - snap.fetched_at < SHEET_CACHE_TTL
+    )
+
+
+def sheet_snapshot(ws) -> _Snapshot:
+    title = ws.title
+    gen = _sheet_gen(title)
+    snap = _SNAPSHOTS.get(title)
+    if snap is not None and snap.rows is not None and _snapshot_fresh(title, snap):
+        CACHES.lookup("snapshot", title, True)
+        return snap
+    CACHES.lookup("snapshot", title, False)
+
+    def load():
+        snap = _Snapshot(ws.get_all_values(), gen, time.monotonic())
+        if _sheet_gen(title) == gen:
+            _snapshot_store(title, snap)
+        return snap
+
+    return _singleflight((ws.spreadsheet.id, title, None) + gen, load)
+
+
+def _gen_after_own_write(gen_before: tuple) -> tuple:
+    """Поколение листа после ровно одной нашей записи (запрос к листу — один шаг)."""
+    return gen_before[0] + 1, gen_before[1]
+
+
+def _snapshot_drop(title: str) -> None:
+    _evict_snapshot(title)
+    CACHES.drop("snapshot", title)
+
+
+def patch_snapshot(ws, gen_before: tuple, fn) -> None:
+    """
+    Наша запись уже ушла в лист — поправить снимок на месте вместо перечитывания.
+    Только если снимок был актуален до записи и между ними не было чужих записей
+    (поколение ушло ровно на наш шаг); иначе снимок выбрасывается и лист перечитается.
+    fn(rows) правит копию строк (LookupError — не получилось, тоже перечитаем).
+    """
+    title = ws.title
+    snap = _SNAPSHOTS.get(title)
+    if snap is None or snap.rows is None or snap.gen != gen_before:
+        return
+    expected = _gen_after_own_write(gen_before)
+    if _sheet_gen(title) != expected:
+        _snapshot_drop(title)
+        return
+    rows = [list(r) for r in snap.rows]
+    try:
+        fn(rows)
+    except (LookupError, IndexError):
+        _snapshot_drop(title)
+        return
+    # метка — ожидаемое поколение, а не текущее: запись, пришедшая прямо сейчас, снимок устарит
+    _snapshot_store(title, _Snapshot(rows, expected, snap.fetched_at))
+
+
+def sheet_derived(ws, name: str, fn):
+    """fn(rows), посчитанная один раз на снимок листа (или поднятая с диска)."""
+    title = ws.title
+    snap = _SNAPSHOTS.get(title)
+    if _snapshot_fresh(title, snap) and name in snap.derived:
+        CACHES.lookup("derived", (title, name), True)
+        CACHES.lookup("snapshot", title, True)
+        return snap.derived[name]
+    CACHES.lookup("derived", (title, name), False)
+    snap = sheet_snapshot(ws)
+    if name not in snap.derived:
+        _derived_store(title, snap, name, fn(snap.rows))
+    return snap.derived[name]
+
+
+def read_values(ws, rng: Optional[str] = None):
+    """
+    ws.get_all_values() / ws.get(rng), но параллельные одинаковые чтения склеиваются,
+    а лист целиком отдаётся из снимка. Чтение после нашей записи в лист
+    к старой загрузке не присоединяется. Результат общий — не мутировать.
+    """
+    if rng:
+        key = (ws.spreadsheet.id, ws.title, rng) + _sheet_gen(ws.title)
+        return _singleflight(key, lambda: ws.get(rng))
+    return sheet_snapshot(ws).rows
+
+
+def read_fresh(ws, rng: Optional[str] = None):
+    """
+    Прямое чтение мимо снимков и склейки — когда по прочитанному будем удалять
+    строки по номерам. Поколение листа не трогает: кэши других читателей живут дальше.
+    """
+    return ws.get(rng) if rng else ws.get_all_values()
+
+
+_ROW_COUNTS = {}   # title -> (gen, fetched_at, число строк данных)
+
+
+def sheet_row_count(ws) -> int:
+    """Сколько строк данных (без шапки): из снимка, иначе по колонке A; кэшируется как снимок."""
+    title = ws.title
+    snap = _SNAPSHOTS.get(title)
+    if snap is not None and snap.rows is not None and _snapshot_fresh(title, snap):
+        return max(len(snap.rows) - 1, 0)
+    gen = _sheet_gen(title)
+    cached = _ROW_COUNTS.get(title)
+    if cached is not None and cached[0] == gen and time.monotonic() - cached[1] < SHEET_CACHE_TTL:
+        return cached[2]
+    n = max(len(read_values(ws, "A:A")) - 1, 0)
+    if _sheet_gen(title) == gen:
+        _ROW_COUNTS[title] = (gen, time.monotonic(), n)
+    return n
+
+
+def sheet_page(ws, page: int, per_page: int, last_col: str) -> tuple:
+    """
+    (шапка, строки страницы, всего строк данных, номер страницы).
+    Свежий снимок листа просто режем; иначе читаем только шапку и свой срез.
+    """
+    total = sheet_row_count(ws)
+    pages = max(1, (total + per_page - 1) // per_page)
+    page = max(0, min(page, pages - 1))
+    start = 2 + page * per_page          # строка листа, с которой начинается страница
+    end = start + per_page - 1
+
+    snap = _SNAPSHOTS.get(ws.title)
+    if snap is not None and snap.rows is not None and _snapshot_fresh(ws.title, snap):
+        rows = snap.rows
+        return (rows[0] if rows else []), rows[start - 1:end], total, page
+
+    ranges = [f"A1:{last_col}1", f"A{start}:{last_col}{end}"]
+    key = (ws.spreadsheet.id, ws.title, tuple(ranges)) + _sheet_gen(ws.title)
+    header, body = _singleflight(key, lambda: ws.batch_get(ranges))
+    return (list(header[0]) if header else []), [list(r) for r in body], total, page
+
+
+def _ledger_totals(rows) -> dict:
+    card = Decimal("0")
+    cash = Decimal("0")
+    for r in rows[1:]:
+        if len(r) > 3:
+            card += _to_amount(r[3])
+        if len(r) > 4:
+            cash += _to_amount(r[4])
+    return {"card": card, "cash": cash}
+
+
+def ledger_totals(client, sheet_name: str) -> dict:
+    """Суммы 💳/💵 по листу Доход/Расход, пересчитываются только при смене снимка."""
+    return sheet_derived(get_ws(client, sheet_name), "totals", _ledger_totals)
 
 
 def get_data():
     try:
-        client = get_gspread_client()
-        sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Сводка")
-        rows = sheet.get_all_values()
-        return {row[0].strip(): row[1].strip() for row in rows if len(row) >= 2}
+        return dict(settings_store().values)
     except Exception as e:
         logger.error(f"Ошибка получения данных: {e}")
         return {}
 
 
+# ---- Outbox: фоновая доставка сообщений в группу REMINDER_CHAT_ID ----
+# Хендлер только кладёт текст в очередь и сразу отвечает пользователю,
+# а отправкой (с ретраями и паузами под лимиты Telegram) занимается воркер.
+# Очередь пишется на диск, чтобы неотправленное пережило рестарт: изменения
+# только помечают её грязной, а на диск её раз в OUTBOX_SAVE_DELAY сбрасывает
+# одна фоновая задача (в потоке) — и лишь если содержимое правда поменялось.
+
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.json")
+OUTBOX_MAX_ATTEMPTS = 8          # после стольких сетевых ошибок сообщение выкидываем
+OUTBOX_MAX_BACKOFF = 300         # потолок паузы между ретраями, сек
+GROUP_MIN_INTERVAL = 3.0         # Telegram: ~20 сообщений в минуту в одну группу
+OUTBOX_SAVE_DELAY = 1.0          # сколько копим изменения очереди перед записью на диск, сек
+
+_OUTBOX = collections.deque()    # элементы: {chat_id, text, parse_mode, attempts, not_before}
+_OUTBOX_WAKE = asyncio.Event()
+_OUTBOX_DIRTY = asyncio.Event()
+_OUTBOX_SAVED = None             # что последним ушло на диск (JSON)
+_BG_TASKS = set()                # держим ссылки на фоновые задачи, чтобы их не съел GC
+
+
+def _outbox_save() -> None:
+    """Очередь поменялась — запишем её на диск чуть позже (вызывается в event loop)."""
+    _OUTBOX_DIRTY.set()
+
+
+def _outbox_write(data: str) -> None:
+    global _OUTBOX_SAVED
+    if data == _OUTBOX_SAVED:
+        return
+    try:
+        tmp = OUTBOX_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, OUTBOX_PATH)
+        _OUTBOX_SAVED = data
+    except Exception as e:
+        logger.error(f"outbox save error: {e}")
+
+
+def _outbox_dump() -> str:
+    return json.dumps(list(_OUTBOX), ensure_ascii=False)
+
+
+async def _outbox_flusher() -> None:
+    while True:
+        await _OUTBOX_DIRTY.wait()
+        await asyncio.sleep(OUTBOX_SAVE_DELAY)
+        _OUTBOX_DIRTY.clear()
+        # снимаем очередь в цикле событий (её меняют только здесь), пишем в потоке
+        await asyncio.to_thread(_outbox_write, _outbox_dump())
+
+
+def _outbox_load() -> None:
+    global _OUTBOX_SAVED
+    try:
+        with open(OUTBOX_PATH, encoding="utf-8") as f:
+            items = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.error(f"outbox load error: {e}")
+        return
+    for it in items:
+        if isinstance(it, dict) and it.get("text"):
+            _OUTBOX.append(it)
+    _OUTBOX_SAVED = _outbox_dump()
+    if _OUTBOX:
+        logger.info(f"outbox: восстановлено {len(_OUTBOX)} неотправленных сообщений")
+
+
+def outbox_send(text: str, parse_mode: Optional[str] = None, chat_id: int = None) -> None:
+    """Ставит сообщение в очередь на отправку в группу. Не ждёт доставки."""
+    if not text:
+        return
+    _OUTBOX.append({
+        "chat_id": chat_id if chat_id is not None else REMINDER_CHAT_ID,
+        "text": text,
+        "parse_mode": parse_mode,
+        "attempts": 0,
+        "not_before": 0.0,
+    })
+    _outbox_save()
+    _OUTBOX_WAKE.set()
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+    # фоновая работа хендлера входит в бюджет его обновления
+    budget = _BUDGET.get()
+    if budget is not None:
+        budget.hold()
+        task.add_done_callback(lambda _t: budget.release())
+    return task
+
+
+def outbox_send_later(build, parse_mode: Optional[str] = None) -> None:
+    """
+    Для сообщений, которым нужны доп. данные (баланс и т.п.):
+    build() — синхронная функция, считается в потоке уже после ответа пользователю.
+    """
+    async def _run():
+        try:
+            text = await asyncio.to_thread(build)
+        except Exception as e:
+            logger.error(f"outbox build error: {e}")
+            return
+        outbox_send(text, parse_mode=parse_mode)
+    _spawn(_run())
+
+
+async def _outbox_worker(bot):
+    last_sent = {}  # chat_id -> time.monotonic() последней отправки
+    while True:
+        if not _OUTBOX:
+            _OUTBOX_WAKE.clear()
+            await _OUTBOX_WAKE.wait()
+            continue
+
+        item = _OUTBOX[0]
+        chat_id = item["chat_id"]
+        wait = max(
+            item.get("not_before", 0.0) - time.time(),
+            last_sent.get(chat_id, float("-inf")) + GROUP_MIN_INTERVAL - time.monotonic(),
+        )
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+
+        try:
+            await bot.send_message(chat_id=chat_id, text=item["text"], parse_mode=item.get("parse_mode"))
+        except RetryAfter as e:
+            # флуд-контроль: ждём сколько сказали и пробуем это же сообщение снова
+            item["not_before"] = time.time() + float(e.retry_after)
+            _outbox_save()
+            continue
+        except BadRequest as e:
+            if item.get("parse_mode"):
+                # чаще всего это кривая Markdown-разметка из пользовательского текста — шлём как есть
+                item["parse_mode"] = None
+                _outbox_save()
+                continue
+            logger.error(f"outbox: сообщение отклонено Telegram: {e}")
+        except (TimedOut, NetworkError) as e:
+            item["attempts"] = item.get("attempts", 0) + 1
+            if item["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"outbox: сообщение выброшено после {item['attempts']} попыток: {e}")
+                _OUTBOX.popleft()
+            else:
+                item["not_before"] = time.time() + min(2 ** item["attempts"], OUTBOX_MAX_BACKOFF)
+            _outbox_save()
+            continue
+        except Exception as e:
+            logger.error(f"outbox send error: {e}")
+
+        last_sent[chat_id] = time.monotonic()
+        _OUTBOX.popleft()
+        _outbox_save()
+
+
 def _to_amount(val):
     s = str(val) if val is not None else "0"
     s = s.replace(" ", "").replace(",", ".")
@@ -795,27 +2951,11 @@ def compute_balance(client):
     - Баланс    = Карта + Наличные
     + добавим: Заморожено (из Мастерская_Данные), если лист есть
     """
-    income_ws = client.open_by_key(SPREADSHEET_ID).worksheet("Доход")
-    expense_ws = client.open_by_key(SPREADSHEET_ID).worksheet("Расход")
+    income = ledger_totals(client, "Доход")
+    expense = ledger_totals(client, "Расход")
 
-    income_rows = income_ws.get_all_values()[1:]
-    expense_rows = expense_ws.get_all_values()[1:]
-
-    income_card = Decimal("0")
-    income_cash = Decimal("0")
-    for r in income_rows:
-        if len(r) > 3:
-            income_card += _to_amount(r[3])
-        if len(r) > 4:
-            income_cash += _to_amount(r[4])
-
-    expense_card = Decimal("0")
-    expense_cash = Decimal("0")
-    for r in expense_rows:
-        if len(r) > 3:
-            expense_card += _to_amount(r[3])
-        if len(r) > 4:
-            expense_cash += _to_amount(r[4])
+    income_card, income_cash = income["card"], income["cash"]
+    expense_card, expense_cash = expense["card"], expense["cash"]
 
     initial = get_initial_balance(client)
 
@@ -826,14 +2966,7 @@ def compute_balance(client):
     # попробуем подтянуть заморозку из единого листа мастерской
     frozen_total = Decimal("0")
     try:
-        ws = client.open_by_key(SPREADSHEET_ID).worksheet("Мастерская_Данные")
-        rows = ws.get_all_values()[1:]
-        for r in rows:
-            if not r or len(r) < 8:
-                continue
-            if (r[0] or "").strip() != "Заморозка":
-                continue
-            frozen_total += _to_amount(r[7])
+        frozen_total = get_frozen_total(client)
     except Exception:
         # если листа нет — просто игнор
         pass
@@ -858,27 +2991,11 @@ def compute_summary(client):
     - Заработано (Чистая прибыль) = Доход - Расход
     + Заморожено = сумма по типу "Заморозка" из листа "Мастерская_Данные"
     """
-    income_ws = client.open_by_key(SPREADSHEET_ID).worksheet("Доход")
-    expense_ws = client.open_by_key(SPREADSHEET_ID).worksheet("Расход")
-
-    income_rows = income_ws.get_all_values()[1:]
-    expense_rows = expense_ws.get_all_values()[1:]
-
-    income_card = Decimal("0")
-    income_cash = Decimal("0")
-    for r in income_rows:
-        if len(r) > 3:
-            income_card += _to_amount(r[3])  # 💳
-        if len(r) > 4:
-            income_cash += _to_amount(r[4])  # 💵
+    income = ledger_totals(client, "Доход")
+    expense = ledger_totals(client, "Расход")
 
-    expense_card = Decimal("0")
-    expense_cash = Decimal("0")
-    for r in expense_rows:
-        if len(r) > 3:
-            expense_card += _to_amount(r[3])  # 💳
-        if len(r) > 4:
-            expense_cash += _to_amount(r[4])  # 💵
+    income_card, income_cash = income["card"], income["cash"]          # 💳 / 💵
+    expense_card, expense_cash = expense["card"], expense["cash"]      # 💳 / 💵
 
     income_total  = income_card + income_cash
     expense_total = expense_card + expense_cash
@@ -900,14 +3017,7 @@ def compute_summary(client):
     # подтянем заморозку из мастерской
     frozen_total = Decimal("0")
     try:
-        ws = client.open_by_key(SPREADSHEET_ID).worksheet("Мастерская_Данные")
-        rows = ws.get_all_values()[1:]
-        for r in rows:
-            if not r or len(r) < 8:
-                continue
-            if (r[0] or "").strip() != "Заморозка":
-                continue
-            frozen_total += _to_amount(r[7])
+        frozen_total = get_frozen_total(client)
     except Exception:
         pass
 
@@ -922,31 +3032,178 @@ def compute_summary(client):
         "Заморожено": frozen_total,
     }
 
-# Статичная клавиатура с кнопкой "Меню" под полем ввода
-def persistent_menu_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[["Меню"]],
-        resize_keyboard=True,
-        one_time_keyboard=False,
-    )
+# Статичная клавиатура с кнопкой "Меню" под полем ввода
+def persistent_menu_keyboard():
+    return ReplyKeyboardMarkup(
+        keyboard=[["Меню"]],
+        resize_keyboard=True,
+        one_time_keyboard=False,
+    )
+
+async def _show_categories_view(query, kind: str):
+    cats = list_categories(kind)
+    if not cats:
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
+        ])
+        await query.edit_message_text(f"Нет категорий для {kind.lower()}а.", reply_markup=kb)
+        return
+
+    cbp = "income_cat" if kind == "Доход" else "expense_cat"
+    buttons = [[InlineKeyboardButton(c["Название"], callback_data=f"{cbp}|{c['ID']}")] for c in cats]
+    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu")])
+
+    await query.edit_message_text(
+        f"{'📥' if kind=='Доход' else '📤'} Категории {kind.lower()}:",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+CAR_SEARCH_LIMIT = 8
+
+
+def _car_card(car: Car) -> str:
+    return (
+        f"🚘 *{car.name or '(без названия)'}*\n"
+        f"🔑 _VIN:_ `{car.get('VIN', '—')}`\n"
+        f"🔖 _Номер:_ `{car.get('Номер', '—')}`\n"
+        f"🛡️ _Страховка:_ {_format_date_with_days(car.get('Страховка до'))}\n"
+        f"🧰 _Техосмотр:_ {_format_date_with_days(car.get('ТО до'))}\n"
+        f"👤 _Водитель:_ {car.get('Водитель', '—')}\n"
+        f"📃 _Договор:_ {car.get('Договор до', '—')}"
+    )
+
+
+# /car <название | часть VIN | госномер> — поиск машины, кнопки ведут в редактор
+async def car_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await update.message.reply_text("Использование: /car <название, часть VIN или госномер>")
+        return
+    await wait_warm()
+    try:
+        matches = await asyncio.to_thread(
+            lambda: car_registry(get_gspread_client()).search(query, CAR_SEARCH_LIMIT)
+        )
+    except Exception as e:
+        logger.error(f"car search error: {e}")
+        await update.message.reply_text("⚠️ Не удалось выполнить поиск.")
+        return
+
+    if not matches:
+        await update.message.reply_text(f"🔍 По запросу «{query}» ничего не найдено.")
+        return
+
+    buttons = [
+        [InlineKeyboardButton(
+            f"{car.name or '(без названия)'} • {car.get('Номер', '—')}",
+            callback_data=editcar_callback(car),
+        )]
+        for car in matches
+    ]
+    await update.message.reply_text(
+        f"🔍 Найдено: {len(matches)}" + ("\n\n" + _car_card(matches[0]) if len(matches) == 1 else ""),
+        reply_markup=InlineKeyboardMarkup(buttons),
+        parse_mode="Markdown",
+    )
+
+
+# @бот <запрос> в любом чате — карточки машин (inline-режим включается у @BotFather)
+async def inline_car_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq = update.inline_query
+    await wait_warm()
+    try:
+        # реестр мог истечь по TTL — перечитываем лист в потоке, а не на каждом нажатии клавиши в цикле
+        matches = await asyncio.to_thread(
+            lambda: car_registry(get_gspread_client()).search(iq.query, CAR_SEARCH_LIMIT)
+        )
+    except Exception as e:
+        logger.error(f"inline car search error: {e}")
+        matches = []
+
+    results = [
+        InlineQueryResultArticle(
+            id=car.id or f"row{car.row}",
+            title=car.name or "(без названия)",
+            description=f"{car.get('Номер', '—')} • VIN {car.get('VIN', '—')}",
+            input_message_content=InputTextMessageContent(_car_card(car), parse_mode="Markdown"),
+        )
+        for car in matches
+    ]
+    await iq.answer(results, cache_time=10, is_personal=True)
+
 
-async def _show_categories_view(query, kind: str):
-    cats = list_categories(kind)
-    if not cats:
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
-        ])
-        await query.edit_message_text(f"Нет категорий для {kind.lower()}а.", reply_markup=kb)
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats — задержки маршрутов и вызовы API (только для ADMIN_IDS)."""
+    if not is_admin(update):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
         return
+    for chunk in split_message(stats_text()):
+        await update.message.reply_text(chunk)
 
-    cbp = "income_cat" if kind == "Доход" else "expense_cat"
-    buttons = [[InlineKeyboardButton(c["Название"], callback_data=f"{cbp}|{c['ID']}")] for c in cats]
-    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu")])
 
-    await query.edit_message_text(
-        f"{'📥' if kind=='Доход' else '📤'} Категории {kind.lower()}:",
-        reply_markup=InlineKeyboardMarkup(buttons)
-    )
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /profile [N] [M] [pstats] — сэмплировать следующие N обновлений или M секунд
+    (что наступит раньше) и прислать топ функций по маршрутам; pstats — ещё и файлы .pstats.
+    /profile stop — закончить досрочно.
+    """
+    global _PROFILER
+    if not is_admin(update):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    args = [a.lower() for a in (context.args or [])]
+    if args[:1] == ["stop"]:
+        if _PROFILER is None:
+            await update.message.reply_text("Профайлер и так выключен.")
+        else:
+            _PROFILER.finish()
+        return
+    if _PROFILER is not None:
+        await update.message.reply_text("Профайлер уже работает. /profile stop — остановить.")
+        return
+    nums = [int(a) for a in args if a.isdigit()]
+    updates = nums[0] if nums else 20
+    seconds = nums[1] if len(nums) > 1 else 60
+    _PROFILER = StackSampler(updates, seconds, update.effective_chat.id, context.bot, "pstats" in args)
+    _PROFILER.start()
+    await update.message.reply_text(f"🔬 Профилирую следующие {updates} обновлений или {seconds} с.")
+
+
+async def mem_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /mem — RSS и примерный размер каждого кэша.
+    /mem start [кадров] — включить tracemalloc и снять опорный снимок;
+    /mem snap — топ мест выделения и разница с прошлым снимком; /mem stop — выключить.
+    """
+    global _MEM_SNAPSHOT
+    if not is_admin(update):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    args = [a.lower() for a in (context.args or [])]
+    if args[:1] == ["start"]:
+        if tracemalloc.is_tracing():
+            await update.message.reply_text("tracemalloc уже включён. /mem snap — снимок.")
+            return
+        frames = int(args[1]) if len(args) > 1 and args[1].isdigit() else 1
+        tracemalloc.start(frames)
+        _MEM_SNAPSHOT = await asyncio.to_thread(_mem_take_snapshot)
+        await update.message.reply_text(f"🧠 tracemalloc включён ({frames} кадр.), опорный снимок снят.")
+        return
+    if args[:1] == ["stop"]:
+        tracemalloc.stop()
+        _MEM_SNAPSHOT = None
+        await update.message.reply_text("tracemalloc выключен.")
+        return
+    if args[:1] == ["snap"]:
+        if not tracemalloc.is_tracing():
+            await update.message.reply_text("tracemalloc выключен: /mem start")
+            return
+        text = await asyncio.to_thread(mem_snapshot_text)
+    else:
+        text = await asyncio.to_thread(mem_text, context.application.user_data)
+    for chunk in split_message(text):
+        await update.message.reply_text(chunk)
+
 
 # Показываем меню (inline кнопки) и добавляем кнопку "Меню" под полем ввода
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -983,10 +3240,523 @@ def back_or_cancel_keyboard(back_cb: str):
         [InlineKeyboardButton("❌ Отмена", callback_data="cancel")],
     ])    
 
+# ---- Отложенная отрисовка медленных экранов ----
+# Медленный экран сразу показывает заглушку (или последнюю закэшированную версию
+# с пометкой «обновляется»), а настоящее содержимое дорисовывается в фоне.
+
+SCREEN_PLACEHOLDER = "⏳ Загружаю…"
+_SCREEN_CACHE = {}   # key -> (text, reply_markup, parse_mode)
+# (chat_id, message_id) -> [номер нажатия, сколько экранов ещё дорисовывается];
+# запись живёт только пока на сообщении есть недорисованный экран
+_SCREEN_SEQ = {}
+
+# (user_id, callback_data) -> сколько ещё идёт обработок этого нажатия
+_CALLBACKS_IN_FLIGHT = collections.Counter()
+_CALLBACK_KEY = contextvars.ContextVar("callback_key", default=None)
+
+
+def _screen_cache_put(key: str, screen: tuple) -> None:
+    _SCREEN_CACHE[key] = screen
+    CACHES.put("screen", key, approx_size(screen))
+
+
+def _callback_release(key) -> None:
+    _CALLBACKS_IN_FLIGHT[key] -= 1
+    if _CALLBACKS_IN_FLIGHT[key] <= 0:
+        del _CALLBACKS_IN_FLIGHT[key]
+
+
+def _refresh_mark(parse_mode: Optional[str]) -> str:
+    if parse_mode == "Markdown":
+        return "\n\n🔄 _обновляется…_"
+    if parse_mode == "HTML":
+        return "\n\n🔄 <i>обновляется…</i>"
+    return "\n\n🔄 обновляется…"
+
+
+def _screen_bump(query) -> None:
+    """Новое нажатие на сообщении делает неактуальными все недорисованные экраны на нём."""
+    msg = query.message
+    if msg is None:
+        return
+    entry = _SCREEN_SEQ.get((msg.chat_id, msg.message_id))
+    if entry is not None:
+        entry[0] += 1
+
+
+async def render_deferred(query, key: str, build, error_text: str = "⚠️ Не удалось загрузить данные."):
+    """
+    build() — синхронная функция -> (text, reply_markup, parse_mode), считается в потоке.
+    Хендлер не ждёт загрузки: сообщение правится дважды — сразу и когда данные готовы.
+    """
+    msg = query.message
+    msg_key = (msg.chat_id, msg.message_id) if msg is not None else None
+    seq = None
+    if msg_key is not None:
+        entry = _SCREEN_SEQ.get(msg_key)
+        if entry is None:
+            entry = _SCREEN_SEQ[msg_key] = [0, 0]
+        entry[1] += 1
+        seq = entry[0]
+
+    cb_key = _CALLBACK_KEY.get()
+
+    cached = _SCREEN_CACHE.get(key)
+    CACHES.lookup("screen", key, cached is not None)
+    try:
+        if cached:
+            text, kb, mode = cached
+            await query.edit_message_text(text + _refresh_mark(mode), reply_markup=kb, parse_mode=mode)
+        else:
+            await query.edit_message_text(SCREEN_PLACEHOLDER)
+    except BadRequest:
+        pass
+
+    async def _fill():
+        started = time.perf_counter()
+        try:
+            text, kb, mode = await asyncio.to_thread(build)
+            _screen_cache_put(key, (text, kb, mode))
+            metric_observe("route", "render:" + callback_route(key), time.perf_counter() - started)
+        except Exception as e:
+            logger.error(f"render {key} error: {e}")
+            metric_observe("route", "render:" + callback_route(key), time.perf_counter() - started, error=True)
+            text, mode = error_text, None
+            kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="menu")]])
+
+        entry = _SCREEN_SEQ.get(msg_key)
+        superseded = entry is not None and entry[0] != seq
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                _SCREEN_SEQ.pop(msg_key, None)
+        try:
+            # пока грузили, пользователь мог уйти на другой экран — тогда не трогаем сообщение
+            if superseded:
+                return
+            await query.edit_message_text(text, reply_markup=kb, parse_mode=mode)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.error(f"render {key} edit error: {e}")
+        finally:
+            if cb_key is not None:
+                _callback_release(cb_key)
+
+    # нажатие считается «в работе», пока экран не дорисован
+    if cb_key is not None:
+        _CALLBACKS_IN_FLIGHT[cb_key] += 1
+    _spawn(_fill())
+
+
+def _build_balance_screen():
+    client = get_gspread_client()
+
+    # 1. Основные цифры
+    summary = compute_summary(client)
+    initial       = summary["Начальная"]
+    income_total  = summary.get("Доход", Decimal("0"))
+    expense_total = summary.get("Расход", Decimal("0"))
+    earned        = summary.get("Заработано", income_total - expense_total)
+    total_balance = summary["Баланс"]
+    card_balance  = summary["Карта"]
+    cash_balance  = summary["Наличные"]
+
+    # 2. Заморозка по машинам
+    try:
+        frozen_items, frozen_total = get_frozen_by_car(client)
+    except Exception as e:
+        logger.error(f"get_frozen_by_car error: {e}")
+        frozen_items, frozen_total = [], Decimal("0")
+
+    # 3. Заморозка по источникам
+    frozen_card = Decimal("0")
+    frozen_cash = Decimal("0")
+    try:
+        ft = get_frozen_totals(client)
+        frozen_card = ft.get("card", Decimal("0"))
+        frozen_cash = ft.get("cash", Decimal("0"))
+    except Exception as e:
+        logger.error(f"get_frozen_totals error: {e}")
+
+    # если по машинам 0, а по источникам есть — подставим это число
+    frozen_by_sources = frozen_card + frozen_cash
+    if frozen_total == 0 and frozen_by_sources > 0:
+        frozen_total = frozen_by_sources
+
+    # 4. Доступно с учётом заморозки
+    available_total = total_balance - frozen_total
+    available_card  = card_balance - frozen_card
+    available_cash  = cash_balance - frozen_cash
+
+    lines = []
+    lines.append("📊 *Баланс*")
+    lines.append(f"🪙 Начальная: {_fmt_amount(initial)}")
+    lines.append(f"📥 Доход: {_fmt_amount(income_total)}")
+    lines.append(f"📤 Расход: {_fmt_amount(expense_total)}")
+    lines.append(f"💡 Заработано: *{_fmt_amount(earned)}*")
+    lines.append("")
+    lines.append(f"💼 Всего: *{_fmt_amount(total_balance)}*")
+    lines.append(f"✅ Доступно (с учётом заморозки): *{_fmt_amount(available_total)}*")
+    lines.append("")
+    lines.append(f"💳 Карта: {_fmt_amount(card_balance)}")
+    lines.append(f"   ↳ свободно: {_fmt_amount(available_card)}")
+    lines.append(f"💵 Наличные: {_fmt_amount(cash_balance)}")
+    lines.append(f"   ↳ свободно: {_fmt_amount(available_cash)}")
+    lines.append("")
+    lines.append(f"🧊 Заморожено всего: *{_fmt_amount(frozen_total)}*")
+    lines.append(f"   💳 по карте: {_fmt_amount(frozen_card)}")
+    lines.append(f"   💵 по налу:  {_fmt_amount(frozen_cash)}")
+
+    # показываем блок по машинам только если есть что показать
+    if frozen_items:
+        lines.append("")
+        lines.append("🔧 Заморожено по машинам:")
+        for car_id, name, summ in frozen_items:
+            lines.append(f"• {name} — {_fmt_amount(summ)}")
+
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
+    ])
+    return "\n".join(lines), kb, "Markdown"
+
+
+WORKSHOP_PAGE_SIZE = 20   # машин на странице списка мастерской
+CARS_PAGE_SIZE = 5        # карточек на странице «Автомобили»
+
+
+def _pager_row(prefix: str, page: int, total: int, per_page: int) -> list:
+    """Кнопки ⬅️/➡️ для списков; callback_data = f"{prefix}:page{N}"."""
+    pages = max(1, (total + per_page - 1) // per_page)
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}:page{page-1}"))
+    if pages > 1:
+        nav.append(InlineKeyboardButton(f"• {page + 1}/{pages} •", callback_data=f"{prefix}:page{page}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}:page{page+1}"))
+    return nav
+
+
+def _build_workshop_list_screen(page: int = 0):
+    client = get_gspread_client()
+    ws = get_ws(client, WORKSHOP_SHEET)
+    # только своя страница: ID | Название | VIN | Создано (как у тебя в шапке);
+    # шапку проверяем по той, что пришла вместе со страницей
+    header, body, total, page = sheet_page(ws, page, WORKSHOP_PAGE_SIZE, "D")
+    ensure_header_row(ws, header, WORKSHOP_HEADERS)
+
+    if not body:
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("➕ Добавить машину", callback_data="workshop_add")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
+        ])
+        return "🧰 *Автомастерская*\n\nСписок пуст.", kb, "Markdown"
+
+    buttons = []
+    for r in body:
+        if not r:
+            continue
+        car_id = (r[0] or "").strip() if len(r) > 0 else ""
+        if not car_id:
+            continue
+        name = (r[1] or "").strip() if len(r) > 1 else "(без названия)"
+        buttons.append([InlineKeyboardButton(name, callback_data=f"workshop_view:{car_id}")])
+
+    nav = _pager_row("workshop_list", page, total, WORKSHOP_PAGE_SIZE)
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton("➕ Добавить машину", callback_data="workshop_add")])
+    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu")])
+
+    title = "🧰 *Автомастерская* — выберите машину:"
+    if total > WORKSHOP_PAGE_SIZE:
+        title += f"\nВсего машин: {total}"
+    return title, InlineKeyboardMarkup(buttons), "Markdown"
+
+
+def _build_cars_screen(page: int = 0):
+    client = get_gspread_client()
+    ws = get_ws(client, "Автомобили")
+
+    # только своя страница карточек; L — подгони под фактическую ширину листа
+    header, body, total, page = sheet_page(ws, page, CARS_PAGE_SIZE, "L")
+
+    if not body:
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("➕ Создать автомобиль", callback_data="create_car")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
+        ])
+        return "🚗 *Автомобили:*\n\nСписок пуст.", kb, "Markdown"
+
+    # удобный геттер по названию колонки
+    idx = { (h or "").strip(): i for i, h in enumerate(header) }
+    def g(row, col_name, default=""):
+        i = idx.get(col_name)
+        if i is None or i >= len(row):
+            return default
+        return (row[i] or "").strip()
+
+    cards = []
+    sep = "─" * 35
+
+    for r in body:
+        if not r:
+            continue
+
+        name         = g(r, "Название", "(без названия)")
+        vin          = g(r, "VIN", "—")
+        plate        = g(r, "Номер", "—")
+        driver       = g(r, "Водитель", "—")
+        driver_phone = g(r, "Телефон водителя", "—")
+        contract_str = g(r, "Договор до", "—")
+
+        card = (
+            f"🚘 *{name}*\n"
+            f"🔑 _VIN:_ `{vin}`\n"
+            f"🔖 _Номер:_ `{plate}`\n"
+            f"🛡️ _Страховка:_ {_format_date_with_days(g(r, 'Страховка до'))}\n"
+            f"🧰 _Техосмотр:_ {_format_date_with_days(g(r, 'ТО до'))}\n"
+            f"👤 _Водитель:_ {driver}\n"
+            f"📞 _Телефон:_ {driver_phone}\n"
+            f"📃 _Договор:_ {contract_str}"
+        )
+        cards.append(card)
+
+    title = "🚗 *Автомобили:*"
+    if total > CARS_PAGE_SIZE:
+        title += f" {total}"
+    text = title + "\n\n" + f"\n{sep}\n".join(cards)
+
+    rows_kb = []
+    nav = _pager_row("cars_list", page, total, CARS_PAGE_SIZE)
+    if nav:
+        rows_kb.append(nav)
+    rows_kb += [
+        [InlineKeyboardButton("➕ Создать автомобиль", callback_data="create_car")],
+        [InlineKeyboardButton("✏️ Редактировать", callback_data="cars_edit")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
+    ]
+    return text, InlineKeyboardMarkup(rows_kb), "Markdown"
+
+
+def _build_workshop_view_screen(car_id: str):
+    client = get_gspread_client()
+
+    # Берём лист "Мастерская" (из кэша снимков — весь, без ограничения в 50 строк)
+    ws = get_ws(client, WORKSHOP_SHEET)
+    rows = read_values(ws)
+
+    # если лист вдруг пустой — гарантируем шапку как раньше
+    if not rows:
+        ws = ensure_ws_with_headers(client, WORKSHOP_SHEET, WORKSHOP_HEADERS)
+        rows = read_values(ws)
+
+    header = rows[0] if rows else []
+    # мапа "Название колонки" -> индекс
+    idx = { (h or "").strip(): i for i, h in enumerate(header) }
+
+    # ищем нашу машину
+    row = None
+    for r in rows[1:]:
+        if not r:
+            continue
+        rid = (r[0] or "").strip() if len(r) > 0 else ""
+        if rid == car_id:
+            row = r
+            break
+
+    if row is None:
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="workshop")]])
+        return "🚫 Машина не найдена в листе «Мастерская».", kb, None
+
+    # геттер как у тебя
+    def g(col_name: str, default=""):
+        i = idx.get(col_name)
+        if i is None or i >= len(row):
+            return default
+        v = row[i]
+        return v.strip() if v else default
+
+    name = g("Название", "(без названия)")
+    vin  = g("VIN", "—")
+
+    # эти функции оставляем как у тебя — они уже под твой "единый лист"
+    frozen         = get_frozen_for_car(client, car_id)
+    services_total = get_services_total_for_car(client, car_id)
+    all_services   = get_services_for_car(client, car_id)
+    services_count = len(all_services)
+
+    recent = get_services_recent_for_car(client, car_id, limit=5)
+    if recent:
+        lines = []
+        for _dt, amt, desc in recent:
+            tail = f" — {desc}" if desc and desc != "-" else ""
+            lines.append(f"• {_fmt_amount(amt)}{tail}")
+        services_list_block = "Последние услуги:\n" + "\n".join(lines) + "\n"
+    else:
+        services_list_block = ""
+
+    text = (
+        f"🧰 *{name}*\n"
+        f"🔑 VIN: `{vin}`\n"
+        f"🧊 Запчастей (заморожено): {_fmt_amount(frozen)}\n"
+        f"🛠️ Услуг на сумму: {_fmt_amount(services_total)}\n"
+        f"{services_list_block}\n"
+        f"Что делаем?"
+    )
+
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🧾 Купить запчасти", callback_data=f"workshop_buy_parts:{car_id}")],
+        [InlineKeyboardButton("🛠️ Добавить услугу", callback_data=f"workshop_add_service:{car_id}")],
+        [InlineKeyboardButton(f"📜 Все услуги ({services_count})", callback_data=f"workshop_services:{car_id}:page0")],
+        [InlineKeyboardButton("✏️ Редактировать записи", callback_data=f"workshop_edit:{car_id}")],
+        [InlineKeyboardButton("✅ Завершить ремонт", callback_data=f"workshop_finish:{car_id}")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="workshop")],
+    ])
+    return text, kb, "Markdown"
+
+
+def _build_report_screen(days: int):
+    client = get_gspread_client()
+
+    in_card, in_cash, _ = _sum_sheet_period(client, "Доход", days, exclude_transfers=True)
+    ex_card, ex_cash, _ = _sum_sheet_period(client, "Расход", days, exclude_transfers=True)
+
+    income_total  = in_card + in_cash
+    expense_total = ex_card + ex_cash
+    net_income    = income_total - expense_total
+
+    text = (
+        f"📅 Отчёт за {days} дней:\n\n"
+        f"📥 Доход:  {_fmt_amount(income_total)}  (💳 {_fmt_amount(in_card)} | 💵 {_fmt_amount(in_cash)})\n"
+        f"📤 Расход: {_fmt_amount(expense_total)} (💳 {_fmt_amount(ex_card)} | 💵 {_fmt_amount(ex_cash)})\n"
+        f"— — — — — — — — —\n"
+        f"💼 Итог: *{_fmt_amount(net_income)}*"
+    )
+    keyboard = InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("📋 Подробности", callback_data=f"report_{days}_details_page0")],
+            [InlineKeyboardButton("🏷 По категориям", callback_data=f"report_{days}_bycat")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
+        ]
+    )
+    return text, keyboard, None
+
+
+def _build_report_details_screen(days: int, detail_type: str, page: int):
+    client = get_gspread_client()
+    is_income = (detail_type == "income")
+    sheet_name = "Доход" if is_income else "Расход"
+
+    _, _, filtered = _sum_sheet_period(client, sheet_name, days, exclude_transfers=True)
+
+    page_size = 10
+    total_pages = max(1, (len(filtered) + page_size - 1) // page_size)
+    page = max(0, min(page, total_pages - 1))
+    page_rows = filtered[page * page_size : (page + 1) * page_size]
+
+    lines = [_render_detail_line(r, is_income) for r in page_rows]
+    text = f"📋 Подробности ({'Доход' if is_income else 'Расход'}) за {days} дней:\n\n"
+    text += "\n".join(lines) if lines else "Данные не найдены."
+
+    buttons = []
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton("⬅️ Предыдущая", callback_data=f"report_{days}_details_{detail_type}_page{page-1}")
+        )
+    if page < total_pages - 1:
+        buttons.append(
+            InlineKeyboardButton("➡️ Следующая", callback_data=f"report_{days}_details_{detail_type}_page{page+1}")
+        )
+
+    keyboard = InlineKeyboardMarkup(
+        [
+            buttons if buttons else [InlineKeyboardButton("• 1/1 •", callback_data=f"report_{days}_details_page0")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data=f"report_{days}_details_page0")],
+            [InlineKeyboardButton("🏠 Меню", callback_data="menu")],
+        ]
+    )
+    return text, keyboard, None
+
+
+def _build_report_bycat_screen(days: int, kind: str, page: int):
+    client = get_gspread_client()
+    sheet_name = "Доход" if kind == "income" else "Расход"
+    _, _, filtered = _sum_sheet_period(client, sheet_name, days, exclude_transfers=True)
+    items = _aggregate_by_category(filtered)
+
+    # пагинация
+    page_size = 15
+    total_pages = max(1, (len(items) + page_size - 1) // page_size)
+    page = max(0, min(page, total_pages - 1))
+    slice_items = items[page * page_size : (page + 1) * page_size]
+
+    is_income = (kind == "income")
+    hdr_icon = "📥" if is_income else "📤"
+    line_icon = "🟢" if is_income else "🔴"
+    sign = "" if is_income else "-"
+
+    if slice_items:
+        start_idx = page * page_size + 1
+        lines = [
+            f"{i}. {cat} — {line_icon} {sign}{_fmt_amount(amt)}"
+            for i, (cat, amt) in enumerate(slice_items, start=start_idx)
+        ]
+        body = "\n".join(lines)
+    else:
+        body = "Нет данных за период."
+
+    total_sum = sum((v for _, v in items), Decimal("0"))
+    total_line = f"Итого: {line_icon} {sign}{_fmt_amount(total_sum)}"
+
+    text = f"{hdr_icon} По категориям за {days} дней:\n\n{body}\n\n{total_line}"
+
+    # навигация
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Предыдущая", callback_data=f"report_{days}_bycat_{kind}_page{page-1}"))
+    if page < total_pages - 1:
+        nav.append(InlineKeyboardButton("➡️ Следующая", callback_data=f"report_{days}_bycat_{kind}_page{page+1}"))
+
+    kb_rows = []
+    if nav:
+        kb_rows.append(nav)
+    kb_rows.append([InlineKeyboardButton("🔁 Выбрать тип", callback_data=f"report_{days}_bycat")])
+    kb_rows.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"report_{days}")])
+
+    return text, InlineKeyboardMarkup(kb_rows), None
+
+
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Точка входа для inline-кнопок. Повторное нажатие той же кнопки тем же
+    пользователем, пока первое ещё обрабатывается (включая фоновую дорисовку),
+    просто гасится — без второго похода в таблицу.
+    """
+    query = update.callback_query
+    key = (update.effective_user.id if update.effective_user else 0, query.data)
+    if _CALLBACKS_IN_FLIGHT[key]:
+        try:
+            await query.answer()
+        except Exception:
+            pass
+        return
+
+    _CALLBACKS_IN_FLIGHT[key] += 1
+    token = _CALLBACK_KEY.set(key)
+    try:
+        await wait_warm()
+        await route_button(update, context)
+    finally:
+        _CALLBACK_KEY.reset(token)
+        _callback_release(key)
+
+
+async def route_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     data = query.data
+    _screen_bump(query)
 
     if data == "cancel" or data == "menu":
         context.user_data.clear()
@@ -1010,7 +3780,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             client = get_gspread_client()
             # подтянем имя авто для заголовка
             ws = ensure_ws_with_headers(client, WORKSHOP_SHEET, WORKSHOP_HEADERS)
-            rows = ws.get_all_values()
+            rows = read_values(ws)
             header = rows[0] if rows else []
             idx = {h.strip(): i for i, h in enumerate(header)}
 
@@ -1070,50 +3840,16 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return    
 
     elif data == "workshop":
-        try:
-            client = get_gspread_client()
-            ws = ensure_ws_with_headers(client, WORKSHOP_SHEET, WORKSHOP_HEADERS)
-            # БЫСТРО: берём только первые 50 строк и только нужные колонки
-            rows = ws.get("A1:D50")  # ID | Название | VIN | Создано (как у тебя в шапке)
-
-            # rows[0] — шапка
-            body = rows[1:] if len(rows) > 1 else []
-
-            if not body:
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("➕ Добавить машину", callback_data="workshop_add")],
-                    [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
-                ])
-                await query.edit_message_text(
-                    "🧰 *Автомастерская*\n\nСписок пуст.",
-                    reply_markup=kb,
-                    parse_mode="Markdown"
-                )
-                return
-
-            buttons = []
-            for r in body:
-                if not r:
-                    continue
-                car_id = (r[0] or "").strip() if len(r) > 0 else ""
-                if not car_id:
-                    continue
-                name = (r[1] or "").strip() if len(r) > 1 else "(без названия)"
-                buttons.append([InlineKeyboardButton(name, callback_data=f"workshop_view:{car_id}")])
-
-            buttons.append([InlineKeyboardButton("➕ Добавить машину", callback_data="workshop_add")])
-            buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu")])
-
-            await query.edit_message_text(
-                "🧰 *Автомастерская* — выберите машину:",
-                reply_markup=InlineKeyboardMarkup(buttons),
-                parse_mode="Markdown"
-            )
-        except Exception as e:
-            logger.error(f"workshop list error: {e}")
-            await query.message.reply_text("⚠️ Не удалось открыть Автомастерскую.")
+        await render_deferred(query, "workshop", _build_workshop_list_screen, "⚠️ Не удалось открыть Автомастерскую.")
         return
 
+    elif data.startswith("workshop_list:page"):
+        page = int(data.split("page", 1)[1] or 0)
+        await render_deferred(
+            query, data, lambda: _build_workshop_list_screen(page),
+            "⚠️ Не удалось открыть Автомастерскую.",
+        )
+        return
 
     elif data == "settings":
         kb = InlineKeyboardMarkup([
@@ -1265,40 +4001,6 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await _show_categories_view(query, "Расход")
         return
 
-    elif data == "workshop":
-        # Список машин в Автомастерской
-        try:
-            client = get_gspread_client()
-            ws = ensure_ws_with_headers(client, WORKSHOP_SHEET, WORKSHOP_HEADERS)
-            rows = ws.get_all_values()[1:]  # пропускаем шапку
-
-            if not rows:
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("➕ Добавить машину", callback_data="workshop_add")],
-                    [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
-                ])
-                await query.edit_message_text("🧰 *Автомастерская*\n\nСписок пуст.", reply_markup=kb, parse_mode="Markdown")
-                return
-
-            buttons = []
-            for r in rows:
-                if not r:
-                    continue
-                car_id = (r[0] or "").strip()
-                name   = (r[1] or "").strip() or "(без названия)"
-                buttons.append([InlineKeyboardButton(name, callback_data=f"workshop_view:{car_id}")])
-
-            buttons.append([InlineKeyboardButton("➕ Добавить машину", callback_data="workshop_add")])
-            buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu")])
-
-            await query.edit_message_text("🧰 *Автомастерская* — выберите машину:",
-                                          reply_markup=InlineKeyboardMarkup(buttons),
-                                          parse_mode="Markdown")
-        except Exception as e:
-            logger.error(f"workshop list error: {e}")
-            await query.message.reply_text("⚠️ Не удалось открыть Автомастерскую.")
-        return
-
     elif data == "workshop_add":
         # Мастер добавления: шаг 1 — название
         context.user_data.clear()
@@ -1313,87 +4015,10 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("workshop_view:"):
         car_id = data.split(":", 1)[1]
-        try:
-            client = get_gspread_client()
-
-            # Берём лист "Мастерская"
-            ws = client.open_by_key(SPREADSHEET_ID).worksheet(WORKSHOP_SHEET)
-            # Быстрый вариант: максимум 50 строк и первые колонки
-            rows = ws.get("A1:H50")
-
-            # если лист вдруг пустой — гарантируем шапку как раньше
-            if not rows:
-                ws = ensure_ws_with_headers(client, WORKSHOP_SHEET, WORKSHOP_HEADERS)
-                rows = ws.get("A1:H50")
-
-            header = rows[0] if rows else []
-            # мапа "Название колонки" -> индекс
-            idx = { (h or "").strip(): i for i, h in enumerate(header) }
-
-            # ищем нашу машину среди первых 50 строк
-            row = None
-            for r in rows[1:]:
-                if not r:
-                    continue
-                rid = (r[0] or "").strip() if len(r) > 0 else ""
-                if rid == car_id:
-                    row = r
-                    break
-
-            if row is None:
-                kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="workshop")]])
-                await query.edit_message_text("🚫 Машина не найдена в листе «Мастерская».", reply_markup=kb)
-                return
-
-            # геттер как у тебя
-            def g(col_name: str, default=""):
-                i = idx.get(col_name)
-                if i is None or i >= len(row):
-                    return default
-                v = row[i]
-                return v.strip() if v else default
-
-            name = g("Название", "(без названия)")
-            vin  = g("VIN", "—")
-
-            # эти функции оставляем как у тебя — они уже под твой "единый лист"
-            frozen         = get_frozen_for_car(client, car_id)
-            services_total = get_services_total_for_car(client, car_id)
-            all_services   = get_services_for_car(client, car_id)
-            services_count = len(all_services)
-
-            recent = get_services_recent_for_car(client, car_id, limit=5)
-            if recent:
-                lines = []
-                for _dt, amt, desc in recent:
-                    tail = f" — {desc}" if desc and desc != "-" else ""
-                    lines.append(f"• {_fmt_amount(amt)}{tail}")
-                services_list_block = "Последние услуги:\n" + "\n".join(lines) + "\n"
-            else:
-                services_list_block = ""
-
-            text = (
-                f"🧰 *{name}*\n"
-                f"🔑 VIN: `{vin}`\n"
-                f"🧊 Запчастей (заморожено): {_fmt_amount(frozen)}\n"
-                f"🛠️ Услуг на сумму: {_fmt_amount(services_total)}\n"
-                f"{services_list_block}\n"
-                f"Что делаем?"
-            )
-
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🧾 Купить запчасти", callback_data=f"workshop_buy_parts:{car_id}")],
-                [InlineKeyboardButton("🛠️ Добавить услугу", callback_data=f"workshop_add_service:{car_id}")],
-                [InlineKeyboardButton(f"📜 Все услуги ({services_count})", callback_data=f"workshop_services:{car_id}:page0")],
-                [InlineKeyboardButton("✏️ Редактировать записи", callback_data=f"workshop_edit:{car_id}")],
-                [InlineKeyboardButton("✅ Завершить ремонт", callback_data=f"workshop_finish:{car_id}")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data="workshop")],
-            ])
-            await query.edit_message_text(text, reply_markup=kb, parse_mode="Markdown")
-
-        except Exception as e:
-            logger.error(f"workshop_view error: {e}")
-            await query.message.reply_text("⚠️ Не удалось открыть карточку машины.")
+        await render_deferred(
+            query, data, lambda: _build_workshop_view_screen(car_id),
+            "⚠️ Не удалось открыть карточку машины.",
+        )
         return
     
     elif data.startswith("workshop_edit:"):
@@ -1401,6 +4026,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         car_id = data.split(":", 1)[1]
         try:
             client = get_gspread_client()
+            ensure_workshop_record_ids(client)
             records = get_workshop_records_for_car(client, car_id)
 
             if not records:
@@ -1428,7 +4054,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 buttons.append([
                     InlineKeyboardButton(
                         btn_text,
-                        callback_data=f"workshop_edit_item:{rec['row_index']}"
+                        callback_data=f"workshop_edit_item:{rec['id']}"
                     )
                 ])
 
@@ -1444,17 +4070,18 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     elif data.startswith("workshop_edit_item:"):
-        # формат: workshop_edit_item:<row_index>
-        try:
-            row_index = int(data.split(":", 1)[1])
-        except Exception:
-            await query.message.reply_text("⚠️ Неверные данные записи.")
-            return
+        # формат: workshop_edit_item:<record_id>
+        record_id = data.split(":", 1)[1]
 
         try:
             client = get_gspread_client()
-            ws = _ensure_workshop_unified_ws(client)
-            row = ws.row_values(row_index)
+            row_index, row = find_workshop_record(client, record_id)
+            if row_index is None:
+                await query.edit_message_text(
+                    "🚫 Запись не найдена (возможно, уже удалена).",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К мастерской", callback_data="workshop")]]),
+                )
+                return
 
             kind   = (row[0] if len(row) > 0 else "").strip()
             car_id = (row[2] if len(row) > 2 else "").strip()
@@ -1463,7 +4090,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             amount = _to_amount(row[7] if len(row) > 7 else "0")
             desc   = (row[8] if len(row) > 8 else "-").strip() or "-"
 
-            context.user_data["edit_row_index"] = row_index
+            context.user_data["edit_record_id"] = record_id
             context.user_data["edit_car_id"]    = car_id
             context.user_data["edit_kind"]      = kind
             context.user_data["edit_amount"]    = amount
@@ -1480,8 +4107,8 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
             kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✏️ Изменить", callback_data=f"workshop_edit_change:{row_index}")],
-                [InlineKeyboardButton("🗑 Удалить", callback_data=f"workshop_edit_delete:{row_index}")],
+                [InlineKeyboardButton("✏️ Изменить", callback_data=f"workshop_edit_change:{record_id}")],
+                [InlineKeyboardButton("🗑 Удалить", callback_data=f"workshop_edit_delete:{record_id}")],
                 [InlineKeyboardButton("⬅️ Назад к списку", callback_data=f"workshop_edit:{car_id}")],
             ])
             await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
@@ -1491,24 +4118,22 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     elif data.startswith("workshop_edit_delete:"):
-        # формат: workshop_edit_delete:<row_index>
-        try:
-            row_index = int(data.split(":", 1)[1])
-        except Exception:
-            await query.message.reply_text("⚠️ Неверные данные для удаления.")
-            return
+        # формат: workshop_edit_delete:<record_id>
+        record_id = data.split(":", 1)[1]
 
         try:
             client = get_gspread_client()
-            ws = _ensure_workshop_unified_ws(client)
-            rows = ws.get_all_values()
-            car_id = ""
-            if 1 <= row_index <= len(rows):
-                r = rows[row_index - 1]
-                if len(r) > 2:
-                    car_id = (r[2] or "").strip()
+            row_index, r = find_workshop_record(client, record_id)
+            if row_index is None:
+                await query.edit_message_text(
+                    "🚫 Запись не найдена (возможно, уже удалена).",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К мастерской", callback_data="workshop")]]),
+                )
+                return
+            car_id = (r[2] or "").strip() if len(r) > 2 else ""
 
-            ws.delete_rows(row_index)
+            get_ws(client, WORKSHOP_UNIFIED_SHEET).delete_rows(row_index)
+            ws_record_index_deleted([row_index])
 
             if not car_id:
                 car_id = context.user_data.get("edit_car_id", "")
@@ -1524,17 +4149,18 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     elif data.startswith("workshop_edit_change:"):
-        # формат: workshop_edit_change:<row_index>
-        try:
-            row_index = int(data.split(":", 1)[1])
-        except Exception:
-            await query.message.reply_text("⚠️ Неверные данные для изменения.")
-            return
+        # формат: workshop_edit_change:<record_id>
+        record_id = data.split(":", 1)[1]
 
         try:
             client = get_gspread_client()
-            ws = _ensure_workshop_unified_ws(client)
-            row = ws.row_values(row_index)
+            row_index, row = find_workshop_record(client, record_id)
+            if row_index is None:
+                await query.edit_message_text(
+                    "🚫 Запись не найдена (возможно, уже удалена).",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К мастерской", callback_data="workshop")]]),
+                )
+                return
 
             kind   = (row[0] if len(row) > 0 else "").strip()
             car_id = (row[2] if len(row) > 2 else "").strip()
@@ -1545,7 +4171,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             context.user_data["action"]       = "ws_edit"
             context.user_data["step"]         = "ws_edit_amount"
-            context.user_data["edit_row"]     = row_index
+            context.user_data["edit_record"]  = record_id
             context.user_data["edit_car_id"]  = car_id
             context.user_data["edit_kind"]    = kind
             context.user_data["edit_amount"]  = amount
@@ -1567,7 +4193,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             client = get_gspread_client()
             ws = ensure_ws_with_headers(client, WORKSHOP_SHEET, WORKSHOP_HEADERS)
-            rows = ws.get_all_values()
+            rows = read_values(ws)
             header = rows[0]
             idx = {h.strip(): i for i, h in enumerate(header)}
             row = None
@@ -1781,20 +4407,19 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            # 1. читаем Мастерская_Данные и собираем заморозку
-            ws_data = client.open_by_key(SPREADSHEET_ID).worksheet("Мастерская_Данные")
-            rows = ws_data.get_all_values()
+            # 1. заморозка машины — по свежему листу: по ней двигаем деньги
+            ws_data = get_ws(client, "Мастерская_Данные")
+            rows = read_fresh(ws_data)
 
             frozen_from_card = Decimal("0")
             frozen_from_cash = Decimal("0")
-            rows_to_delete = []
 
-            for i, r in enumerate(rows[1:], start=2):
+            for r in rows[1:]:
                 if not r:
                     continue
                 typ = (r[0] or "").strip()
                 cid = (r[2] or "").strip() if len(r) > 2 else ""
-                if typ != "Заморозка" or cid != car_id:
+                if cid != car_id or typ != "Заморозка":
                     continue
 
                 # ❗❗ вот тут была ошибка: источник в колонке 6, не 5
@@ -1815,25 +4440,15 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     # если не узнали — пусть будет как чаще всего (нал)
                     frozen_from_cash += amt
 
-                rows_to_delete.append(i)
-
-            # удаляем строки заморозки по машине
-            for i in sorted(rows_to_delete, reverse=True):
-                ws_data.delete_rows(i)
-
             # 2. подготовка листов и вспомогалки
-            expense_ws = client.open_by_key(SPREADSHEET_ID).worksheet("Расход")
-            income_ws  = client.open_by_key(SPREADSHEET_ID).worksheet("Доход")
+            income_ws  = get_ws(client, "Доход")
             now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
 
             def append_transfer(amount: Decimal, direction: str):
                 if amount <= 0:
                     return
                 q = str(amount.quantize(Decimal("0.01")))
-                try:
-                    cat_id, cat_name = ensure_category_by_name("Доход", "Перевод")
-                except NameError:
-                    cat_id, cat_name = "", "Перевод"
+                cat_id, cat_name = ensure_category_by_name("Доход", "Перевод")
 
                 exp = [now, cat_id, cat_name, "", "", f"Перевод заморозки: {car_name}"]
                 inc = [now, cat_id, cat_name, "", "", f"Перевод заморозки: {car_name}"]
@@ -1845,8 +4460,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     exp[4] = q   # списали с нал
                     inc[3] = q   # положили на карту
 
-                expense_ws.append_row(exp, value_input_option="USER_ENTERED", table_range="A:F")
-                income_ws.append_row(inc,  value_input_option="USER_ENTERED", table_range="A:F")
+                append_rows_atomic(client, [(EXPENSE_SHEET, exp), (INCOME_SHEET, inc)])
 
             # 3. делаем перевод, если нужно
             # вернуть на карту, а заморозка была наличкой
@@ -1859,10 +4473,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             # 4. доход по услугам
             if services_total > 0:
-                try:
-                    cat_id_inc, cat_name_inc = ensure_category_by_name("Доход", "Ремонт")
-                except NameError:
-                    cat_id_inc, cat_name_inc = "", "Ремонт"
+                cat_id_inc, cat_name_inc = ensure_category_by_name("Доход", "Ремонт")
 
                 row_inc = [now, cat_id_inc, cat_name_inc, "", "", f"Ремонт: {car_name}"]
                 q = str(services_total.quantize(Decimal("0.01")))
@@ -1872,39 +4483,15 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     row_inc[4] = q
                 income_ws.append_row(row_inc, value_input_option="USER_ENTERED")
 
-            # ===== 4. Чистим лист "Мастерская_Данные" по этой машине =====
+            # ===== 4. Чистим Мастерская_Данные и убираем машину из "Мастерская" =====
+            # деньги уже проведены — при ошибке не даём завершить ремонт второй раз,
+            # а предлагаем повторить только удаление
+            cleanup_error = None
             try:
-                ws_data = client.open_by_key(SPREADSHEET_ID).worksheet("Мастерская_Данные")
-                rows = ws_data.get_all_values()
-                rows_to_delete = []
-
-                for i, r in enumerate(rows[1:], start=2):
-                    if not r or len(r) < 3:
-                        continue
-                    cid = (r[2] or "").strip()
-                    if cid != car_id:
-                        continue
-                    typ = (r[0] or "").strip()
-                    if typ in ("Услуга", "Заморозка"):
-                        rows_to_delete.append(i)
-
-                for idx in reversed(rows_to_delete):
-                    ws_data.delete_rows(idx)
-
-                logger.info(f"Удалено {len(rows_to_delete)} строк из Мастерская_Данные для CarID={car_id}")
+                workshop_car_cleanup(client, car_id)
             except Exception as e:
-                logger.warning(f"Не удалось очистить Мастерская_Данные для машины {car_id}: {e}")
-
-            # ===== 5. Удаляем машину из листа "Мастерская" =====
-            try:
-                ws_cars = client.open_by_key(SPREADSHEET_ID).worksheet(WORKSHOP_SHEET)
-                rows = ws_cars.get_all_values()
-                for i, r in enumerate(rows[1:], start=2):
-                    if len(r) > 0 and r[0] == car_id:
-                        ws_cars.delete_rows(i)
-                        break
-            except Exception as e:
-                logger.warning(f"Не удалось удалить машину из листа Мастерская: {e}")
+                cleanup_error = f"{type(e).__name__}: {e}"
+                logger.error(f"Не удалось очистить мастерскую для машины {car_id}: {cleanup_error}")
 
             # ===== 5. Сообщение и финал =====
             txt = [
@@ -1920,36 +4507,44 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if services_total > 0:
                 txt.append(f"🛠️ Доход по услугам: {_fmt_amount(services_total)} → {dest_income}")
 
-            # Итоговый баланс после ремонта
-            try:
-                from decimal import Decimal
-
-                live = compute_balance(client)
+            # Итоговый баланс после ремонта — считается уже в фоне, после ответа пользователю
+            def build_group_msg():
+                try:
+                    live = compute_balance(client)
 
-                card   = live.get("Карта", Decimal("0"))
-                cash   = live.get("Наличные", Decimal("0"))
-                frozen = live.get("Заморожено", Decimal("0"))
+                    card   = live.get("Карта", Decimal("0"))
+                    cash   = live.get("Наличные", Decimal("0"))
+                    frozen = live.get("Заморожено", Decimal("0"))
 
-                total_money = card + cash
-                free_total  = total_money - frozen
+                    total_money = card + cash
+                    free_total  = total_money - frozen
 
-                txt.append(
-                    "📊 Баланс после ремонта:\n"
-                    f"💼 {_fmt_amount(free_total)} — свободно (с учётом заморозки)\n"
-                    f"💰 {_fmt_amount(total_money)} — всего на счетах (карта+наличные)\n"
-                    f"💳 {_fmt_amount(card)} — на карте\n"
-                    f"💵 {_fmt_amount(cash)} — наличные\n"
-                    f"🧊 {_fmt_amount(frozen)} — заморожено"
-                )
-            except Exception as e:
-                logger.error(f"finish compute_balance error: {e}")
+                    txt.append(
+                        "📊 Баланс после ремонта:\n"
+                        f"💼 {_fmt_amount(free_total)} — свободно (с учётом заморозки)\n"
+                        f"💰 {_fmt_amount(total_money)} — всего на счетах (карта+наличные)\n"
+                        f"💳 {_fmt_amount(card)} — на карте\n"
+                        f"💵 {_fmt_amount(cash)} — наличные\n"
+                        f"🧊 {_fmt_amount(frozen)} — заморожено"
+                    )
+                except Exception as e:
+                    logger.error(f"finish compute_balance error: {e}")
+                return "\n".join(txt)
 
-            try:
-                await context.bot.send_message(chat_id=REMINDER_CHAT_ID, text="\n".join(txt))
-            except Exception:
-                pass
+            outbox_send_later(build_group_msg)
 
             context.user_data.clear()
+            if cleanup_error:
+                kb = InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔁 Повторить удаление", callback_data=f"ws_finish_cleanup:{car_id}")],
+                    [InlineKeyboardButton("⬅️ К списку", callback_data="workshop")],
+                ])
+                await query.edit_message_text(
+                    "⚠️ Деньги проведены, но машину не удалось убрать из мастерской:\n"
+                    f"{cleanup_error}\n\nЗавершать ремонт повторно не нужно — повторите только удаление.",
+                    reply_markup=kb,
+                )
+                return
             kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К списку", callback_data="workshop")]])
             await query.edit_message_text("✅ Ремонт завершён. Машина убрана.", reply_markup=kb)
 
@@ -1963,6 +4558,22 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text("❌ Не удалось завершить ремонт.")
         return
 
+    elif data.startswith("ws_finish_cleanup:"):
+        car_id = data.split(":", 1)[1]
+        retry_kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔁 Повторить удаление", callback_data=f"ws_finish_cleanup:{car_id}")],
+            [InlineKeyboardButton("⬅️ К списку", callback_data="workshop")],
+        ])
+        try:
+            await asyncio.to_thread(workshop_car_cleanup, get_gspread_client(), car_id)
+        except Exception as e:
+            logger.error(f"ws_finish_cleanup error: {type(e).__name__}: {e}")
+            await query.edit_message_text(f"⚠️ Снова не удалось убрать машину: {type(e).__name__}: {e}", reply_markup=retry_kb)
+            return
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К списку", callback_data="workshop")]])
+        await query.edit_message_text("✅ Машина убрана из мастерской.", reply_markup=kb)
+        return
+
     elif data.startswith("ws_buy_src:"):
         # формат: ws_buy_src:card:<car_id>
         _, src, car_id = data.split(":", 2)
@@ -2032,27 +4643,22 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # список всех машин по названию
         try:
             client = get_gspread_client()
-            ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
-            rows = ws.get_all_values()
-            if not rows or len(rows) < 2:
+            reg = car_registry(client)
+            if not reg.cars:
                 kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="cars")]])
                 await query.edit_message_text("Список пуст.", reply_markup=kb)
                 return
 
-            header, body = rows[0], rows[1:]
-            try:
-                name_idx = header.index("Название")
-            except ValueError:
+            if "Название" not in reg.header:
                 kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="cars")]])
                 await query.edit_message_text("Не найдена колонка «Название».", reply_markup=kb)
                 return
 
             # Кнопки по именам
             btns = []
-            for r in body:
-                if name_idx < len(r) and r[name_idx].strip():
-                    name = r[name_idx].strip()
-                    btns.append([InlineKeyboardButton(name, callback_data=f"editcar_select|{name}")])
+            for car in reg.cars:
+                if car.name:
+                    btns.append([InlineKeyboardButton(car.name, callback_data=editcar_callback(car))])
 
             btns.append([InlineKeyboardButton("⬅️ Назад", callback_data="cars")])
             await query.edit_message_text("Выберите автомобиль для редактирования:", reply_markup=InlineKeyboardMarkup(btns))
@@ -2065,18 +4671,12 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         car_id = data.split(":", 1)[1]
 
         client = get_gspread_client()
-        ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
-
-        row_idx = _find_row_by_id(ws, car_id)
-        if not row_idx:
+        car = find_car(client, car_id=car_id)
+        if car is None:
             await query.edit_message_text("❌ Машина не найдена.")
             return
 
-        rows = ws.get_all_values()
-        header = rows[0]
-        idx = {h.strip(): i for i, h in enumerate(header)}
-        name_col = idx.get("Название")
-        car_name = rows[row_idx-1][name_col].strip() if name_col is not None else car_id
+        car_name = car.name or car_id
 
         context.user_data["action"] = "extend_contract"
         context.user_data["car_id"] = car_id
@@ -2088,27 +4688,26 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    elif data.startswith("editcar_select|"):
-        name = data.split("|", 1)[1]
-        context.user_data["edit_car_name"] = name
-
+    elif data.startswith("editcar:") or data.startswith("editcar_select|"):
+        # editcar:<car_id>; editcar_select|<название> — старые кнопки и машины без ID
         try:
             client = get_gspread_client()
-            ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
-
-            row_idx = _find_row_by_name(ws, name)
-            if not row_idx:
+            if data.startswith("editcar:"):
+                car = find_car(client, car_id=data.split(":", 1)[1])
+            else:
+                car = find_car(client, name=data.split("|", 1)[1])
+            if car is None:
                 await query.edit_message_text(
                     "🚫 Автомобиль не найден.",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="cars_edit")]])
                 )
                 return
 
-            header = ws.row_values(1)
-            row    = ws.row_values(row_idx)
+            name = car.name
+            context.user_data["edit_car_name"] = name
+            context.user_data["edit_car_ref"]  = car.id
 
-            def get_col(label: str) -> str:
-                return row[header.index(label)].strip() if label in header and header.index(label) < len(row) else ""
+            get_col = car.get
 
             car_id       = get_col("ID")  # нужен для надёжных апдейтов
             vin          = get_col("VIN")
@@ -2160,7 +4759,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("🔁 Сменить водителя", callback_data="editcar_driver_change")],
             [InlineKeyboardButton("🗑 Удалить водителя", callback_data="editcar_driver_delete_confirm")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data=f"editcar_select|{name}")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data=_editcar_back(context.user_data))],
         ])
         await query.edit_message_text(f"🚘 {name}\nЧто сделать с водителем?", reply_markup=kb)
         return
@@ -2179,7 +4778,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         name = context.user_data.get("edit_car_name", "")
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ Да, удалить водителя", callback_data="editcar_driver_delete_yes")],
-            [InlineKeyboardButton("⬅️ Отмена", callback_data=f"editcar_select|{name}")],
+            [InlineKeyboardButton("⬅️ Отмена", callback_data=_editcar_back(context.user_data))],
         ])
         await query.edit_message_text(f"Удалить водителя у «{name}»? Будут очищены имя, телефон и дата договора.", reply_markup=kb)
         return
@@ -2187,20 +4786,13 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "editcar_driver_delete_yes":
         try:
             client = get_gspread_client()
-            ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
             name = context.user_data.get("edit_car_name", "")
-            row_idx = _find_row_by_name(ws, name)
-            if not row_idx:
+            car = edited_car(client, context.user_data, verify=True)
+            if car is None:
                 await query.edit_message_text("🚫 Автомобиль не найден.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="cars_edit")]]))
                 return
 
-            col_driver        = _ensure_column(ws, "Водитель")
-            col_driver_phone  = _ensure_column(ws, "Телефон водителя")
-            col_contract_till = _ensure_column(ws, "Договор до")
-
-            ws.update_cell(row_idx, col_driver,        "")
-            ws.update_cell(row_idx, col_driver_phone,  "")
-            ws.update_cell(row_idx, col_contract_till, "")
+            car_update(client, car, {"Водитель": "", "Телефон водителя": "", "Договор до": ""})
 
             kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("⬅️ К редактированию", callback_data="cars_edit")],
@@ -2232,13 +4824,13 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "editcar_delete_yes":
         try:
             client = get_gspread_client()
-            ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
-            row_idx = _find_row_by_name(ws, context.user_data.get("edit_car_name", ""))
-            if not row_idx:
+            car = edited_car(client, context.user_data, verify=True)
+            if car is None:
                 await query.edit_message_text("Авто не найдено.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="cars_edit")]]))
                 return
-            ws.delete_rows(row_idx)
+            car_delete(client, car)
             context.user_data.pop("edit_car_name", None)
+            context.user_data.pop("edit_car_ref", None)
             kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К списку", callback_data="cars")]])
             await query.edit_message_text("✅ Машина удалена.", reply_markup=kb)
         except Exception as e:
@@ -2287,71 +4879,12 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["step"] = "amount"
         await query.edit_message_text("Введите сумму перевода:", reply_markup=cancel_keyboard())
 
-    elif data == "cars":
-        try:
-            client = get_gspread_client()
-            ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
-
-            # БЫСТРО: максимум 50 строк и нужная ширина
-            rows = ws.get("A1:L50")  # подгони L под свою фактическую ширину
-
-            if not rows or len(rows) < 2:
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("➕ Создать автомобиль", callback_data="create_car")],
-                    [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
-                ])
-                await query.edit_message_text("🚗 *Автомобили:*\n\nСписок пуст.", reply_markup=kb, parse_mode="Markdown")
-                return
-
-            header = rows[0]
-            body = rows[1:]
-
-            # удобный геттер по названию колонки
-            idx = { (h or "").strip(): i for i, h in enumerate(header) }
-            def g(row, col_name, default=""):
-                i = idx.get(col_name)
-                if i is None or i >= len(row):
-                    return default
-                return (row[i] or "").strip()
-
-            cards = []
-            sep = "─" * 35
-
-            for r in body:
-                if not r:
-                    continue
-
-                name         = g(r, "Название", "(без названия)")
-                vin          = g(r, "VIN", "—")
-                plate        = g(r, "Номер", "—")
-                driver       = g(r, "Водитель", "—")
-                driver_phone = g(r, "Телефон водителя", "—")
-                contract_str = g(r, "Договор до", "—")
-
-                card = (
-                    f"🚘 *{name}*\n"
-                    f"🔑 _VIN:_ `{vin}`\n"
-                    f"🔖 _Номер:_ `{plate}`\n"
-                    f"🛡️ _Страховка:_ {_format_date_with_days(g(r, 'Страховка до'))}\n"
-                    f"🧰 _Техосмотр:_ {_format_date_with_days(g(r, 'ТО до'))}\n"
-                    f"👤 _Водитель:_ {driver}\n"
-                    f"📞 _Телефон:_ {driver_phone}\n"
-                    f"📃 _Договор:_ {contract_str}"
-                )
-                cards.append(card)
-
-            text = "🚗 *Автомобили:*\n\n" + f"\n{sep}\n".join(cards)
-
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("➕ Создать автомобиль", callback_data="create_car")],
-                [InlineKeyboardButton("✏️ Редактировать", callback_data="cars_edit")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
-            ])
-            await query.edit_message_text(text, reply_markup=keyboard, parse_mode="Markdown")
-
-        except Exception as e:
-            logger.error(f"Ошибка списка авто: {e}")
-            await query.message.reply_text("⚠️ Не удалось загрузить список «Автомобили».")
+    elif data == "cars" or data.startswith("cars_list:page"):
+        page = int(data.split("page", 1)[1] or 0) if data != "cars" else 0
+        await render_deferred(
+            query, data, lambda: _build_cars_screen(page),
+            "⚠️ Не удалось загрузить список «Автомобили».",
+        )
         return
 
     elif data == "create_car":
@@ -2376,86 +4909,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     elif data == "balance":
-        from decimal import Decimal
-        try:
-            client = get_gspread_client()
-
-            # 1. Основные цифры
-            summary = compute_summary(client)
-            initial       = summary["Начальная"]
-            income_total  = summary.get("Доход", Decimal("0"))
-            expense_total = summary.get("Расход", Decimal("0"))
-            earned        = summary.get("Заработано", income_total - expense_total)
-            total_balance = summary["Баланс"]
-            card_balance  = summary["Карта"]
-            cash_balance  = summary["Наличные"]
-
-            # 2. Заморозка по машинам
-            try:
-                frozen_items, frozen_total = get_frozen_by_car(client)
-            except Exception as e:
-                logger.error(f"get_frozen_by_car error: {e}")
-                frozen_items, frozen_total = [], Decimal("0")
-
-            # 3. Заморозка по источникам
-            frozen_card = Decimal("0")
-            frozen_cash = Decimal("0")
-            try:
-                ft = get_frozen_totals(client)
-                frozen_card = ft.get("card", Decimal("0"))
-                frozen_cash = ft.get("cash", Decimal("0"))
-            except Exception as e:
-                logger.error(f"get_frozen_totals error: {e}")
-
-            # если по машинам 0, а по источникам есть — подставим это число
-            frozen_by_sources = frozen_card + frozen_cash
-            if frozen_total == 0 and frozen_by_sources > 0:
-                frozen_total = frozen_by_sources
-
-            # 4. Доступно с учётом заморозки
-            available_total = total_balance - frozen_total
-            available_card  = card_balance - frozen_card
-            available_cash  = cash_balance - frozen_cash
-
-            lines = []
-            lines.append("📊 *Баланс*")
-            lines.append(f"🪙 Начальная: {_fmt_amount(initial)}")
-            lines.append(f"📥 Доход: {_fmt_amount(income_total)}")
-            lines.append(f"📤 Расход: {_fmt_amount(expense_total)}")
-            lines.append(f"💡 Заработано: *{_fmt_amount(earned)}*")
-            lines.append("")
-            lines.append(f"💼 Всего: *{_fmt_amount(total_balance)}*")
-            lines.append(f"✅ Доступно (с учётом заморозки): *{_fmt_amount(available_total)}*")
-            lines.append("")
-            lines.append(f"💳 Карта: {_fmt_amount(card_balance)}")
-            lines.append(f"   ↳ свободно: {_fmt_amount(available_card)}")
-            lines.append(f"💵 Наличные: {_fmt_amount(cash_balance)}")
-            lines.append(f"   ↳ свободно: {_fmt_amount(available_cash)}")
-            lines.append("")
-            lines.append(f"🧊 Заморожено всего: *{_fmt_amount(frozen_total)}*")
-            lines.append(f"   💳 по карте: {_fmt_amount(frozen_card)}")
-            lines.append(f"   💵 по налу:  {_fmt_amount(frozen_cash)}")
-
-            # показываем блок по машинам только если есть что показать
-            if frozen_items:
-                lines.append("")
-                lines.append("🔧 Заморожено по машинам:")
-                for car_id, name, summ in frozen_items:
-                    lines.append(f"• {name} — {_fmt_amount(summ)}")
-
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
-            ])
-
-            await query.edit_message_text(
-                "\n".join(lines),
-                parse_mode="Markdown",
-                reply_markup=kb,
-            )
-
-        except Exception as e:
-            logger.error(f"balance error: {e}")
-            await query.message.reply_text("⚠️ Не удалось получить баланс.")
+        await render_deferred(query, "balance", _build_balance_screen, "⚠️ Не удалось получить баланс.")
         return
 
     elif data.startswith("workshop_add_service:"):
@@ -2463,7 +4917,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             client = get_gspread_client()
             ws = ensure_ws_with_headers(client, WORKSHOP_SHEET, WORKSHOP_HEADERS)
-            rows = ws.get_all_values()
+            rows = read_values(ws)
             header = rows[0]
             idx = {h.strip(): i for i, h in enumerate(header)}
             row = None
@@ -2501,35 +4955,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data in ["report_7", "report_30"]:
         days = 7 if data == "report_7" else 30
-        try:
-            client = get_gspread_client()
-
-            in_card, in_cash, _ = _sum_sheet_period(client, "Доход", days, exclude_transfers=True)
-            ex_card, ex_cash, _ = _sum_sheet_period(client, "Расход", days, exclude_transfers=True)
-
-
-            income_total  = in_card + in_cash
-            expense_total = ex_card + ex_cash
-            net_income    = income_total - expense_total
-
-            text = (
-                f"📅 Отчёт за {days} дней:\n\n"
-                f"📥 Доход:  {_fmt_amount(income_total)}  (💳 {_fmt_amount(in_card)} | 💵 {_fmt_amount(in_cash)})\n"
-                f"📤 Расход: {_fmt_amount(expense_total)} (💳 {_fmt_amount(ex_card)} | 💵 {_fmt_amount(ex_cash)})\n"
-                f"— — — — — — — — —\n"
-                f"💼 Итог: *{_fmt_amount(net_income)}*"
-            )
-            keyboard = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("📋 Подробности", callback_data=f"report_{days}_details_page0")],
-                    [InlineKeyboardButton("🏷 По категориям", callback_data=f"report_{days}_bycat")],
-                    [InlineKeyboardButton("⬅️ Назад", callback_data="menu")],
-                ]
-            )
-            await query.edit_message_text(text, reply_markup=keyboard)
-        except Exception as e:
-            logger.error(f"Ошибка получения отчёта: {e}")
-            await query.message.reply_text("⚠️ Не удалось загрузить отчёт.")
+        await render_deferred(query, data, lambda: _build_report_screen(days), "⚠️ Не удалось загрузить отчёт.")
         return
 
     elif re.match(r"report_(7|30)_details_page(\d+)", data):
@@ -2553,48 +4979,12 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif re.match(r"report_(7|30)_details_(income|expense)_page(\d+)", data):
         m = re.match(r"report_(7|30)_details_(income|expense)_page(\d+)", data)
         days, detail_type, page = int(m.group(1)), m.group(2), int(m.group(3))
-        try:
-            client = get_gspread_client()
-            is_income = (detail_type == "income")
-            sheet_name = "Доход" if is_income else "Расход"
-
-            _, _, filtered = _sum_sheet_period(client, sheet_name, days, exclude_transfers=True)
-
-
-            page_size = 10
-            total_pages = max(1, (len(filtered) + page_size - 1) // page_size)
-            page = max(0, min(page, total_pages - 1))
-            page_rows = filtered[page * page_size : (page + 1) * page_size]
-
-            lines = [_render_detail_line(r, is_income) for r in page_rows]
-            text = f"📋 Подробности ({'Доход' if is_income else 'Расход'}) за {days} дней:\n\n"
-            text += "\n".join(lines) if lines else "Данные не найдены."
-
-            buttons = []
-            if page > 0:
-                buttons.append(
-                    InlineKeyboardButton("⬅️ Предыдущая", callback_data=f"report_{days}_details_{detail_type}_page{page-1}")
-                )
-            if page < total_pages - 1:
-                buttons.append(
-                    InlineKeyboardButton("➡️ Следующая", callback_data=f"report_{days}_details_{detail_type}_page{page+1}")
-                )
-
-            keyboard = InlineKeyboardMarkup(
-                [
-                    buttons if buttons else [InlineKeyboardButton("• 1/1 •", callback_data=f"report_{days}_details_page0")],
-                    [InlineKeyboardButton("⬅️ Назад", callback_data=f"report_{days}_details_page0")],
-                    [InlineKeyboardButton("🏠 Меню", callback_data="menu")],
-                ]
-            )
-            await query.edit_message_text(text, reply_markup=keyboard)
-        except Exception as e:
-            logger.error(f"Ошибка загрузки подробностей отчёта: {e}")
-            await query.message.reply_text("⚠️ Не удалось загрузить подробности отчёта.")
+        await render_deferred(
+            query, data, lambda: _build_report_details_screen(days, detail_type, page),
+            "⚠️ Не удалось загрузить подробности отчёта.",
+        )
         return
 
-        # ... тут идут другие ветки внутри handle_button ...
-
     elif re.match(r"report_(7|30)_bycat$", data):
         m = re.match(r"report_(7|30)_bycat$", data)
         days = int(m.group(1))
@@ -2611,57 +5001,10 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         days = int(m.group(1))
         kind = m.group(2)  # 'income' | 'expense'
         page = int(m.group(3))
-
-        try:
-            client = get_gspread_client()
-            sheet_name = "Доход" if kind == "income" else "Расход"
-            _, _, filtered = _sum_sheet_period(client, sheet_name, days, exclude_transfers=True)
-            items = _aggregate_by_category(filtered)
-
-            # пагинация
-            page_size = 15
-            total_pages = max(1, (len(items) + page_size - 1) // page_size)
-            page = max(0, min(page, total_pages - 1))
-            slice_items = items[page * page_size : (page + 1) * page_size]
-
-            is_income = (kind == "income")
-            hdr_icon = "📥" if is_income else "📤"
-            line_icon = "🟢" if is_income else "🔴"
-            sign = "" if is_income else "-"
-
-            if slice_items:
-                start_idx = page * page_size + 1
-                lines = [
-                    f"{i}. {cat} — {line_icon} {sign}{_fmt_amount(amt)}"
-                    for i, (cat, amt) in enumerate(slice_items, start=start_idx)
-                ]
-                body = "\n".join(lines)
-            else:
-                body = "Нет данных за период."
-
-            from decimal import Decimal
-            total_sum = sum((v for _, v in items), Decimal("0"))
-            total_line = f"Итого: {line_icon} {sign}{_fmt_amount(total_sum)}"
-
-            text = f"{hdr_icon} По категориям за {days} дней:\n\n{body}\n\n{total_line}"
-
-            # навигация
-            nav = []
-            if page > 0:
-                nav.append(InlineKeyboardButton("⬅️ Предыдущая", callback_data=f"report_{days}_bycat_{kind}_page{page-1}"))
-            if page < total_pages - 1:
-                nav.append(InlineKeyboardButton("➡️ Следующая", callback_data=f"report_{days}_bycat_{kind}_page{page+1}"))
-
-            kb_rows = []
-            if nav:
-                kb_rows.append(nav)
-            kb_rows.append([InlineKeyboardButton("🔁 Выбрать тип", callback_data=f"report_{days}_bycat")])
-            kb_rows.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"report_{days}")])
-
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb_rows))
-        except Exception as e:
-            logger.error(f"Ошибка отчёта по категориям: {e}")
-            await query.message.reply_text("⚠️ Не удалось построить отчёт по категориям.")
+        await render_deferred(
+            query, data, lambda: _build_report_bycat_screen(days, kind, page),
+            "⚠️ Не удалось построить отчёт по категориям.",
+        )
         return
     
 # Обработчик нажатия на кнопку "Меню" с клавиатуры — не отправляем текст, просто открываем меню
@@ -2670,6 +5013,7 @@ async def on_menu_button_pressed(update: Update, context: ContextTypes.DEFAULT_T
 
 
 async def handle_amount_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await wait_warm()
     text = (update.message.text or "").strip()
 
     # -------- Отмена --------
@@ -2867,10 +5211,8 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                 await update.message.reply_text("⚠️ Не удалось сохранить покупку запчастей.")
                 return
 
-            # сообщение в группу
-            try:
-                from decimal import Decimal
-
+            # сообщение в группу (баланс досчитается в фоне)
+            def build_group_msg():
                 try:
                     amount_txt = _fmt_amount(amount)
                 except Exception:
@@ -2917,11 +5259,9 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                     lines.append(balance_line)
                 if desc:
                     lines.append(f"📝 {desc}")
+                return "\n".join(lines)
 
-                msg = "\n".join(lines)
-                await context.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg)
-            except Exception as e:
-                logger.error(f"send group buy parts error: {e}")
+            outbox_send_later(build_group_msg)
 
             context.user_data.clear()
             kb = InlineKeyboardMarkup([
@@ -2987,11 +5327,15 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
             if raw != "-":
                 context.user_data["edit_desc"] = raw or "-"
 
-            row_index = context.user_data.get("edit_row")
+            record_id = context.user_data.get("edit_record")
             car_id    = context.user_data.get("edit_car_id")
             try:
                 client = get_gspread_client()
                 ws = _ensure_workshop_unified_ws(client)
+                row_index, _ = find_workshop_record(client, record_id)
+                if row_index is None:
+                    await update.message.reply_text("🚫 Запись не найдена (возможно, уже удалена).")
+                    return
 
                 from decimal import Decimal
                 amount = context.user_data.get("edit_amount", Decimal("0"))
@@ -2999,10 +5343,11 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                 desc   = context.user_data.get("edit_desc", "-")
 
                 # колонки: 7 = Источник, 8 = Сумма, 9 = Описание
-                if source is not None:
-                    ws.update_cell(row_index, 7, source)
-                ws.update_cell(row_index, 8, str(amount.quantize(Decimal("0.01"))))
-                ws.update_cell(row_index, 9, desc or "-")
+                with SheetWriteBatch(ws) as wb:
+                    if source is not None:
+                        wb.set_cell(row_index, 7, source)
+                    wb.set_cell(row_index, 8, str(amount.quantize(Decimal("0.01"))))
+                    wb.set_cell(row_index, 9, desc or "-")
 
                 kb = InlineKeyboardMarkup([
                     [InlineKeyboardButton("⬅️ К списку записей", callback_data=f"workshop_edit:{car_id}")],
@@ -3014,9 +5359,9 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                 await update.message.reply_text("⚠️ Не удалось сохранить изменения.")
             finally:
                 for key in [
-                    "action", "step", "edit_row", "edit_car_id",
+                    "action", "step", "edit_record", "edit_car_id",
                     "edit_kind", "edit_amount", "edit_source", "edit_desc",
-                    "edit_row_index",
+                    "edit_record_id",
                 ]:
                     context.user_data.pop(key, None)
             return
@@ -3065,10 +5410,8 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                 await update.message.reply_text("⚠️ Не удалось сохранить услугу.")
                 return
 
-            # сообщение в группу
-            try:
-                from decimal import Decimal
-
+            # сообщение в группу (итоги по машине и баланс досчитаются в фоне)
+            def build_group_msg():
                 # формат суммы
                 try:
                     amount_txt = _fmt_amount(amount)
@@ -3119,12 +5462,11 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                     lines.append(balance_line)
 
                 if desc:
-                    lines.append(f"📝 {desc}")    
+                    lines.append(f"📝 {desc}")
 
-                msg = "\n".join(lines)
-                await context.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg)
-            except Exception as e:
-                logger.error(f"send group service error: {e}")
+                return "\n".join(lines)
+
+            outbox_send_later(build_group_msg)
 
 
             context.user_data.clear()
@@ -3152,10 +5494,8 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
 
                 try:
                     client = get_gspread_client()
-                    income_ws  = client.open_by_key(SPREADSHEET_ID).worksheet("Доход")
-                    expense_ws = client.open_by_key(SPREADSHEET_ID).worksheet("Расход")
 
-                    now = datetime.datetime.now().strftime("%d.%m.%Y %H:%М")
+                    now = datetime.datetime.now().strftime(DATE_FMT)
                     income_row  = [now, "", "Перевод", "", "", description]
                     expense_row = [now, "", "Перевод", "", "", description]
 
@@ -3170,8 +5510,7 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                         income_row[3]  = q  # 💳 D
                         arrow = "💵 → 💳"
 
-                    expense_ws.append_row(expense_row, value_input_option="USER_ENTERED", table_range="A:F")
-                    income_ws.append_row(income_row,  value_input_option="USER_ENTERED", table_range="A:F")
+                    append_rows_atomic(client, [(EXPENSE_SHEET, expense_row), (INCOME_SHEET, income_row)])
 
                     live = compute_balance(client)
 
@@ -3191,14 +5530,11 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                     context.user_data.clear()
                     await update.message.reply_text(text_msg, reply_markup=kb, parse_mode="Markdown")
 
-                    try:
-                        group_msg = (
-                            f"🔁 Перевод: {arrow} {_fmt_amount(amount)}\n"
-                            f"Баланс: 💳 {_fmt_amount(live['Карта'])} | 💵 {_fmt_amount(live['Наличные'])}"
-                        )
-                        await context.bot.send_message(chat_id=REMINDER_CHAT_ID, text=group_msg, parse_mode="Markdown")
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки в группу: {e}")
+                    group_msg = (
+                        f"🔁 Перевод: {arrow} {_fmt_amount(amount)}\n"
+                        f"Баланс: 💳 {_fmt_amount(live['Карта'])} | 💵 {_fmt_amount(live['Наличные'])}"
+                    )
+                    outbox_send(group_msg, parse_mode="Markdown")
 
                 except Exception as e:
                     logger.error(f"Ошибка перевода: {e}")
@@ -3351,24 +5687,18 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
         new_date = (update.message.text or "").strip()
 
         client = get_gspread_client()
-        ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
-
-        row_idx = _find_row_by_id(ws, car_id)
-        if not row_idx:
+        car = find_car(client, car_id=car_id, verify=True)
+        if car is None:
             await update.message.reply_text("❌ Машина не найдена.")
             context.user_data.clear()
             return
 
-        rows = ws.get_all_values()
-        header = rows[0]
-        idx = {h.strip(): i for i, h in enumerate(header)}
-        col_contract = idx.get("Договор до")
-        if col_contract is None:
+        if "Договор до" not in car_registry(client).header:
             await update.message.reply_text("❌ В таблице нет колонки «Договор до».")
             context.user_data.clear()
             return
 
-        ws.update_cell(row_idx, col_contract + 1, new_date)  # gspread 1-based
+        car_update(client, car, {"Договор до": new_date})
 
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("⬅️ Назад в Автомобили", callback_data="cars")],
@@ -3398,18 +5728,13 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                     return
 
                 client = get_gspread_client()
-                ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
-
-                row_idx = _find_row_by_name(ws, name)
-                if not row_idx:
+                car = edited_car(client, context.user_data, verify=True)
+                if car is None:
                     await update.message.reply_text("🚫 Автомобиль не найден.")
                     return
 
-                header = ws.row_values(1)
                 col_name = "Страховка до" if step == "edit_insurance" else "ТО до"
-                col_idx = header.index(col_name) + 1 if col_name in header else _ensure_column(ws, col_name)
-
-                ws.update_cell(row_idx, col_idx, date_txt)
+                car_update(client, car, {col_name: date_txt})
 
                 context.user_data.pop("action", None)
                 context.user_data.pop("step", None)
@@ -3433,8 +5758,8 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                 return
 
             sheet_name = "Страховки" if edit_type == "insurance" else "ТехОсмотры"
-            sheet = get_gspread_client().open_by_key(SPREADSHEET_ID).worksheet(sheet_name)
-            rows = sheet.get_all_values()
+            sheet = get_ws(get_gspread_client(), sheet_name)
+            rows = read_values(sheet)
             for i, row in enumerate(rows):
                 if row and row[0].lower() == name.lower():
                     sheet.update_cell(i + 1, 2, new_date)
@@ -3492,26 +5817,22 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
 
             try:
                 client = get_gspread_client()
-                ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
-                row_idx = _find_row_by_name(ws, car_name)
-                if not row_idx:
+                car = edited_car(client, context.user_data, verify=True)
+                if car is None:
                     await update.message.reply_text("🚫 Автомобиль не найден.")
                     return
 
-                # гарантируем колонки
-                col_driver        = _ensure_column(ws, "Водитель")
-                col_driver_phone  = _ensure_column(ws, "Телефон водителя")
-                col_contract_till = _ensure_column(ws, "Договор до")
-
                 # Сохраним локально ПРЕЖДЕ чем чистить user_data
                 driver_name  = context.user_data.get("driver_name", "")
                 driver_phone = context.user_data.get("driver_phone", "")
                 contract_till = txt
 
-                # Запись в таблицу
-                ws.update_cell(row_idx, col_driver,        driver_name)
-                ws.update_cell(row_idx, col_driver_phone,  driver_phone)
-                ws.update_cell(row_idx, col_contract_till, contract_till)
+                # Запись в таблицу (недостающие колонки создаются в той же пачке)
+                car_update(client, car, {
+                    "Водитель":         driver_name,
+                    "Телефон водителя": driver_phone,
+                    "Договор до":       contract_till,
+                })
 
                 # Очистка состояния
                 context.user_data.pop("action", None)
@@ -3553,8 +5874,6 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
 
                 try:
                     client = get_gspread_client()
-                    income_ws  = client.open_by_key(SPREADSHEET_ID).worksheet("Доход")
-                    expense_ws = client.open_by_key(SPREADSHEET_ID).worksheet("Расход")
 
                     # Формат новых листов:
                     # [Дата, КатегорияID, Категория, 💳 Карта, 💵 Наличные, 📝 Описание]
@@ -3575,8 +5894,7 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                         income_row[3]  = q  # 💳 Карта
                         arrow = "💵 → 💳"
 
-                    expense_ws.append_row(expense_row, value_input_option="USER_ENTERED", table_range="A:F")
-                    income_ws.append_row(income_row,  value_input_option="USER_ENTERED", table_range="A:F")
+                    append_rows_atomic(client, [(EXPENSE_SHEET, expense_row), (INCOME_SHEET, income_row)])
 
                     # Баланс
                     live = compute_balance(client)
@@ -3598,14 +5916,11 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                     await update.message.reply_text(text_msg, reply_markup=kb, parse_mode="Markdown")
 
                     # Сообщение в канал
-                    try:
-                        group_msg = (
-                            f"🔁 Перевод: {arrow} {_fmt_amount(amount)}\n"
-                            f"Баланс: 💳 {_fmt_amount(live['Карта'])} | 💵 {_fmt_amount(live['Наличные'])}"
-                        )
-                        await context.bot.send_message(chat_id=REMINDER_CHAT_ID, text=group_msg, parse_mode="Markdown")
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки в группу: {e}")
+                    group_msg = (
+                        f"🔁 Перевод: {arrow} {_fmt_amount(amount)}\n"
+                        f"Баланс: 💳 {_fmt_amount(live['Карта'])} | 💵 {_fmt_amount(live['Наличные'])}"
+                    )
+                    outbox_send(group_msg, parse_mode="Markdown")
 
                 except Exception as e:
                     logger.error(f"Ошибка перевода: {e}")
@@ -3664,7 +5979,7 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
 
             client  = get_gspread_client()
             ws_name = "Доход" if action == "income" else "Расход"
-            ws      = client.open_by_key(SPREADSHEET_ID).worksheet(ws_name)
+            ws      = get_ws(client, ws_name)
 
             # строка нового формата:
             # [Дата, КатегорияID, Категория, 💳 Карта, 💵 Наличные, 📝 Описание]
@@ -3721,28 +6036,21 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
             await update.message.reply_text(text_msg, reply_markup=kb, parse_mode="Markdown")
 
             # короткое сообщение в группу
-            try:
-                source_emoji = "💳" if source == "Карта" else "💵"
-                desc_q = f' “{description}”' if description and description != "-" else ""
-                sign   = "+" if action == "income" else "-"
-
-                group_msg = (
-                    f"{'📥 Доход' if action == 'income' else '📤 Расход'}: "
-                    f"{source_emoji} {sign}{_fmt_amount(amount)} — {cat_name}{desc_q}\n"
-                    f"Баланс: "
-                    f"💼 {_fmt_amount(free_total)} свободно | "
-                    f"💰 {_fmt_amount(total_money)} всего | "
-                    f"💳 {_fmt_amount(card)} | "
-                    f"💵 {_fmt_amount(cash)} | "
-                    f"🧊 {_fmt_amount(frozen)}"
-                )
-                await context.bot.send_message(
-                    chat_id=REMINDER_CHAT_ID,
-                    text=group_msg,
-                    parse_mode="Markdown",
-                )
-            except Exception as e:
-                logger.error(f"Ошибка отправки в группу: {e}")
+            source_emoji = "💳" if source == "Карта" else "💵"
+            desc_q = f' “{description}”' if description and description != "-" else ""
+            sign   = "+" if action == "income" else "-"
+
+            group_msg = (
+                f"{'📥 Доход' if action == 'income' else '📤 Расход'}: "
+                f"{source_emoji} {sign}{_fmt_amount(amount)} — {cat_name}{desc_q}\n"
+                f"Баланс: "
+                f"💼 {_fmt_amount(free_total)} свободно | "
+                f"💰 {_fmt_amount(total_money)} всего | "
+                f"💳 {_fmt_amount(card)} | "
+                f"💵 {_fmt_amount(cash)} | "
+                f"🧊 {_fmt_amount(frozen)}"
+            )
+            outbox_send(group_msg, parse_mode="Markdown")
 
         except Exception as e:
             logger.error(f"Ошибка записи: {e}")
@@ -3788,7 +6096,6 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
             # Записываем в Google Sheets
             try:
                 client = get_gspread_client()
-                ws = client.open_by_key(SPREADSHEET_ID).worksheet("Автомобили")
 
                 new_id = datetime.datetime.now().strftime("car_%Y%m%d_%H%M%S")
                 now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
@@ -3800,7 +6107,7 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                     context.user_data["car_plate"],  # D: Номер
                     now,                             # E: Дата создания
                 ]
-                ws.append_row(row, value_input_option="USER_ENTERED", table_range="A:E")
+                car_append(client, row)
 
                 # Ответ пользователю
                 msg = (
@@ -3823,110 +6130,520 @@ async def handle_amount_description(update: Update, context: ContextTypes.DEFAUL
                 await update.message.reply_text("⚠️ Не удалось создать автомобиль. Проверьте лист «Автомобили».")
             return    
 
-async def check_reminders(app):
+# ---- Напоминания: страховка / ТО / договор ----
+# Куча ближайших порогов (дата окончания минус REMIND_BEFORE_DAYS) строится по реестру
+# машин. Задача JobQueue ставится на REMINDER_TIME того дня, когда порог наступает,
+# и больше ни разу не просыпается впустую. Реестр пересобрался (наша правка даты
+# или перечитанный лист) — куча и расписание пересчитываются. Даты, поправленные
+# в таблице руками, куча сама не увидит, пока бот простаивает, поэтому раз в день
+# в REMINDER_TIME лист машин перечитывается заново.
+REMIND_BEFORE_DAYS = int(os.getenv("REMIND_BEFORE_DAYS", "7"))   # оповещать за N дней
+REMINDER_TIME = datetime.time.fromisoformat(os.getenv("REMINDER_TIME", "09:00"))
+REMINDER_TZ = os.getenv("REMINDER_TZ", "")   # напр. Europe/Moscow; пусто — часовой пояс сервера
+REMINDER_REPEAT_DAYS = int(os.getenv("REMINDER_REPEAT_DAYS", "3"))  # как часто повторять то же самое
+REMINDER_STATE_PATH = os.getenv("REMINDER_STATE_PATH", "reminders.json")
+TG_MESSAGE_LIMIT = 4000    # Telegram режет на 4096 — оставим запас
+
+_REMINDER_HEAP = []        # (дата порога, ключ машины, колонка)
+_REMINDER_SRC = None       # реестр, по которому построена куча
+_REMINDER_LAST_RUN = None  # дата последней отправки
+_REMINDER_RUNNING = False  # идёт рассылка — расписание переставит она сама
+_REMINDER_APP = None
+_REMINDER_LOOP = None
+_REMINDER_LOCK = threading.Lock()
+
+
+def _reminder_tz():
+    if REMINDER_TZ:
+        return zoneinfo.ZoneInfo(REMINDER_TZ)
+    return datetime.datetime.now().astimezone().tzinfo
+
+
+def _reminder_today() -> datetime.date:
+    return datetime.datetime.now(_reminder_tz()).date()
+
+
+def reminders_rebuild(reg: "CarRegistry") -> None:
+    """Пересобрать кучу порогов по реестру и переставить будильник."""
+    global _REMINDER_HEAP, _REMINDER_SRC
+    heap = []
+    before = datetime.timedelta(days=REMIND_BEFORE_DAYS)
+    for car in reg.cars:
+        for col in CAR_DATE_COLUMNS:
+            d = car.dates.get(col)
+            if d:
+                heap.append((d - before, car.id or car.name, col))
+    heapq.heapify(heap)
+    with _REMINDER_LOCK:
+        _REMINDER_HEAP, _REMINDER_SRC = heap, reg
+    if _REMINDER_LOOP is not None:
+        _REMINDER_LOOP.call_soon_threadsafe(_schedule_reminders)
+
+
+def _schedule_reminders() -> None:
+    """Поставить задачу на ближайший день, когда что-то наступает (вызывается в event loop)."""
+    if _REMINDER_APP is None or _REMINDER_APP.job_queue is None or _REMINDER_RUNNING:
+        return
+    jq = _REMINDER_APP.job_queue
+    for job in jq.get_jobs_by_name("reminders"):
+        job.schedule_removal()
+
+    with _REMINDER_LOCK:
+        first = _REMINDER_HEAP[0][0] if _REMINDER_HEAP else None
+    if first is None:
+        return
+
+    tz = _reminder_tz()
+    now = datetime.datetime.now(tz)
+    today = now.date()
+    day = max(first, today)
+    if day == today and _REMINDER_LAST_RUN == today:
+        day = today + datetime.timedelta(days=1)
+    when = datetime.datetime.combine(day, REMINDER_TIME, tzinfo=tz)
+    if when <= now:
+        when = now + datetime.timedelta(seconds=1)   # сегодняшнее время уже прошло — не ждём завтра
+    jq.run_once(check_reminders, when, name="reminders")
+    logger.info(f"reminders: next run {when:%d.%m.%Y %H:%M}")
+
+
+def _reminder_text(col: str, name: str, date_str: str, days: int, label: str) -> str:
+    if col == "Страховка до":
+        if days < 0:
+            return f"🚨 Страховка на *{name}* просрочена! ({date_str}, {label})."
+        if days == 0:
+            return f"⏰ Сегодня истекает страховка на *{name}* ({date_str})."
+        return f"⏰ Через {days} дней истекает страховка на *{name}* ({date_str})."
+    if col == "ТО до":
+        if days < 0:
+            return f"🚨 Техосмотр на *{name}* просрочен! ({date_str}, {label})."
+        if days == 0:
+            return f"⏰ Сегодня истекает техосмотр на *{name}* ({date_str})."
+        return f"⏰ Через {days} дней истекает техосмотр на *{name}* ({date_str})."
+    if days < 0:
+        return (
+            f"📃🤝 *Договор аренды* по *{name}* истёк!\n"
+            f"⏱ Был до: {date_str} ({label})."
+        )
+    if days == 0:
+        return (
+            f"📃🤝 Сегодня истекает *договор аренды* по *{name}*.\n"
+            f"⏱ Дата: {date_str}."
+        )
+    return (
+        f"📃🤝 Через {days} дней истекает *договор аренды* по *{name}*.\n"
+        f"⏱ До: {date_str}."
+    )
+
+
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> list:
+    """Порезать текст на куски не длиннее limit — по границам строк, чтобы не ломать разметку."""
+    chunks, cur = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if cur:
+                chunks.append(cur)
+                cur = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{cur}\n{line}" if cur else line
+        if len(candidate) > limit:
+            chunks.append(cur)
+            candidate = line
+        cur = candidate
+    if cur.strip():
+        chunks.append(cur)
+    return chunks
+
+
+def _reminder_state_load() -> dict:
+    try:
+        with open(REMINDER_STATE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"reminder state unreadable, starting over: {e}")
+        return {}
+
+
+def _reminder_state_save(state: dict) -> None:
+    try:
+        tmp = REMINDER_STATE_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, REMINDER_STATE_PATH)
+    except Exception as e:
+        logger.error(f"reminder state save error: {e}")
+
+
+_REMINDER_SECTIONS = (
+    ("overdue",  "🚨 *Просрочено:*"),
+    ("today",    "⏰ *Истекает сегодня:*"),
+    ("upcoming", f"📅 *В ближайшие {REMIND_BEFORE_DAYS} дней:*"),
+)
+
+
+def _collect_reminders() -> tuple:
+    """
+    Свежий реестр -> одна сводка по всем наступившим порогам (синхронно, в потоке).
+    Одно и то же (машина, дата, статус) повторяем не чаще раза в REMINDER_REPEAT_DAYS.
+    Возвращает (куски сводки, новое состояние дедупликации, сегодня): в очередь outbox
+    кладём уже в цикле событий — из потока её трогать нельзя.
+    """
+    client = get_gspread_client()
+    ws = get_ws(client, CARS_SHEET)
+
+    # гарантируем наличие нужных колонок (шапка — из реестра, без лишнего чтения)
+    reg = car_registry(client)
+    with SheetWriteBatch(ws, reg.header) as wb:
+        for col_name in ("Название",) + CAR_DATE_COLUMNS:
+            wb.column(col_name)
+
+    today = _reminder_today()
+    with _REMINDER_LOCK:
+        due = [item for item in _REMINDER_HEAP if item[0] <= today]
+    due.sort()
+
+    state = _reminder_state_load()
+    fresh_state = {}
+    sections = {name: [] for name, _ in _REMINDER_SECTIONS}
+    for _, key, col in due:
+        car = reg.by_id.get(key) or reg.by_name.get(key)
+        if car is None:
+            continue
+        date_str = car.get(col)
+        label, days = _days_left_label(date_str, today)
+        if days is None or days > REMIND_BEFORE_DAYS:
+            continue
+        bucket = "overdue" if days < 0 else "today" if days == 0 else "upcoming"
+
+        # смена статуса (скоро -> сегодня -> просрочено) или новая дата — это новый ключ
+        dedup_key = f"{key}|{col}|{date_str}|{bucket}"
+        last = state.get(dedup_key)
+        if last and (today - datetime.date.fromisoformat(last)).days < REMINDER_REPEAT_DAYS:
+            fresh_state[dedup_key] = last
+            continue
+        fresh_state[dedup_key] = today.isoformat()
+        sections[bucket].append("• " + _reminder_text(col, car.name, date_str, days, label))
+
+    chunks = []
+    if any(sections.values()):
+        parts = ["🔔 *Напоминания*"]
+        for name, title in _REMINDER_SECTIONS:
+            if sections[name]:
+                parts.append(title + "\n" + "\n".join(sections[name]))
+        chunks = split_message("\n\n".join(parts))
+    return chunks, fresh_state, today
+
+
+async def check_reminders(context: ContextTypes.DEFAULT_TYPE):
     """
-    Раз в сутки пробегает лист 'Автомобили' и шлёт напоминания по страховке и тех.осмотру.
-    Требуемые заголовки: 'Название', 'Страховка до', 'ТО до'.
+    Задача JobQueue: разослать наступившие напоминания по страховке, ТО и договору
+    и поставить себя на следующий нужный день.
+    Требуемые заголовки: 'Название', 'Страховка до', 'ТО до', 'Договор до'.
     Если заголовков нет — создадим автоматически.
     """
-    REMIND_BEFORE_DAYS = 7  # оповещать за N дней
+    global _REMINDER_RUNNING, _REMINDER_LAST_RUN
+    _REMINDER_RUNNING = True
+    try:
+        chunks, fresh_state, today = await asyncio.to_thread(_collect_reminders)
+    except Exception as e:
+        logger.error(f"Ошибка при проверке напоминаний: {e}")
+        context.job_queue.run_once(check_reminders, 900, name="reminders")   # повторим через 15 минут
+        return
+    finally:
+        _REMINDER_RUNNING = False
+    for chunk in chunks:
+        outbox_send(chunk, parse_mode="Markdown")
+    # ушедшие из списка (продлили, удалили машину) забываем
+    _reminder_state_save(fresh_state)
+    _REMINDER_LAST_RUN = today
+    _schedule_reminders()
+
+
+async def reload_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Ежедневная задача: перечитать лист машин — реестр пересоберёт кучу и расписание."""
+    def reload():
+        _snapshot_drop(CARS_SHEET)
+        car_registry(get_gspread_client())
+
+    try:
+        await asyncio.to_thread(reload)
+    except Exception as e:
+        logger.error(f"reminders: не удалось перечитать реестр машин: {e}")
+
+
+async def reminders_start(app) -> None:
+    global _REMINDER_APP, _REMINDER_LOOP
+    _REMINDER_APP = app
+    _REMINDER_LOOP = asyncio.get_running_loop()
+    if app.job_queue is None:
+        logger.error('JobQueue недоступен: нужен пакет "python-telegram-bot[job-queue]"')
+        return
+    try:
+        await wait_warm()
+        await asyncio.to_thread(lambda: car_registry(get_gspread_client()))
+    except Exception as e:
+        logger.error(f"reminders: не удалось загрузить реестр машин: {e}")
+    _schedule_reminders()
+    app.job_queue.run_daily(
+        reload_reminders, REMINDER_TIME.replace(tzinfo=_reminder_tz()), name="reminders_reload",
+    )
+
+# ---- Прогрев кэшей после старта ----
+WARMUP_SHEETS = ["Категории", "Автомобили", SUMMARY_SHEET, "Доход", "Расход", WORKSHOP_SHEET, WORKSHOP_UNIFIED_SHEET]
+WARMUP_WAIT = float(os.getenv("WARMUP_WAIT", "5"))   # сколько хендлер готов подождать прогрев, сек
+
+_WARM_DONE = asyncio.Event()
+
+
+async def wait_warm() -> None:
+    """Пока идёт прогрев — подождать его (недолго), а не грузить те же листы параллельно."""
+    if _WARM_DONE.is_set():
+        return
+    try:
+        await asyncio.wait_for(_WARM_DONE.wait(), WARMUP_WAIT)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def warm_up() -> None:
+    started = time.monotonic()
+    timings = {}
+
+    def timed(name, fn):
+        t0 = time.monotonic()
+        try:
+            fn()
+        except Exception as e:
+            logger.warning(f"warm-up {name} failed: {e}")
+        timings[name] = time.monotonic() - t0
+
+    try:
+        client = await asyncio.to_thread(get_gspread_client)
+        await asyncio.to_thread(timed, "registry", lambda: _load_worksheets(client))
+
+        await asyncio.to_thread(timed, "disk", lambda: restore_cache(client))
+
+        def load_sheet(title):
+            # поднятое с диска и не изменившееся не перечитываем
+            if title in (INCOME_SHEET, EXPENSE_SHEET):
+                ledger_totals(client, title)
+            elif title == WORKSHOP_UNIFIED_SHEET:
+                workshop_index(client)
+            elif title == CATS_SHEET:
+                category_registry(client)
+            elif title == SUMMARY_SHEET:
+                settings_store(client)
+            else:
+                sheet_snapshot(get_ws(client, title))
+
+        await asyncio.gather(*[
+            asyncio.to_thread(timed, title, lambda title=title: load_sheet(title))
+            for title in WARMUP_SHEETS
+        ])
+    except Exception as e:
+        logger.error(f"warm-up error: {e}")
+    finally:
+        _WARM_DONE.set()
+
+    breakdown = ", ".join(f"{k} {v:.2f}s" for k, v in timings.items())
+    logger.info(f"warm-up done in {time.monotonic() - started:.2f}s: {breakdown}")
+
+
+# ---- Кэш листов на диске: быстрый рестарт ----
+# Агрегаты Доход/Расход и индекс мастерской по машинам сохраняются периодически
+# и при остановке. На старте одним запросом читается только хвост колонок, по которым
+# они посчитаны: последние CACHE_TAIL_ROWS сохранённых строк и всё, что ниже. Совпали
+# число строк и контрольная сумма хвоста — берём с диска, иначе пересчитываем.
+# Правку выше хвоста так не увидеть, но поднятое с диска живёт как обычный снимок,
+# не дольше SHEET_CACHE_TTL. Маленькие листы (Автомобили, Категории, Сводка) с диска
+# не берём: на них держатся реестры и настройки, поэтому тем же запросом они читаются целиком.
+CACHE_PATH = os.getenv("CACHE_PATH", "sheets_cache.json.gz")
+CACHE_SAVE_INTERVAL = float(os.getenv("CACHE_SAVE_INTERVAL", "600"))
+CACHE_TAIL_ROWS = int(os.getenv("CACHE_TAIL_ROWS", "200"))
+CACHE_VERSION = 3
+
+# лист -> (какие производные сохранять, колонки, от которых они зависят)
+CACHE_SHEETS = {
+    INCOME_SHEET: (("totals",), "D:E"),
+    EXPENSE_SHEET: (("totals",), "D:E"),
+    WORKSHOP_UNIFIED_SHEET: (("by_car",), "A:H"),
+}
+CACHE_FULL_SHEETS = (CARS_SHEET, CATS_SHEET, SUMMARY_SHEET)
+_CACHE_DERIVED = {"totals": _ledger_totals, "by_car": _build_workshop_index}
+
+
+def _range_fingerprint(rows, cols: str = "") -> tuple:
+    """
+    (число строк до последней непустой, crc32 последних CACHE_TAIL_ROWS из них)
+    по ячейкам колонок cols ("D:E"). rows — строки листа целиком (cols задан)
+    или уже ответ API по этому диапазону.
+    """
+    if cols:
+        first, last = (gspread.utils.a1_to_rowcol(f"{c}1")[1] for c in cols.split(":"))
+        rows = (r[first - 1:last] for r in rows)
+    lines = []
+    for r in rows:
+        cells = [(v or "").strip() for v in r]
+        while cells and not cells[-1]:
+            cells.pop()
+        lines.append("\x1f".join(cells))
+    while lines and not lines[-1]:
+        lines.pop()
+    return len(lines), zlib.crc32("\n".join(lines[-CACHE_TAIL_ROWS:]).encode("utf-8"))
+
+
+def _tail_range(title: str, cols: str, rows: int) -> tuple:
+    """(A1-диапазон хвоста: последние CACHE_TAIL_ROWS из rows строк и всё ниже, номер первой строки)."""
+    first, last = cols.split(":")
+    start = max(rows - CACHE_TAIL_ROWS + 1, 1)
+    return gspread.utils.absolute_range_name(title, f"{first}{start}:{last}"), start
+
+
+def _cache_encode(o):
+    if isinstance(o, Decimal):
+        return {"$d": str(o)}
+    raise TypeError(f"not serializable: {type(o).__name__}")
+
+
+def _cache_decode(d):
+    if len(d) == 1 and "$d" in d:
+        return Decimal(d["$d"])
+    return d
+
+
+def save_cache() -> None:
+    sheets = {}
+    for title, (derived, cols) in CACHE_SHEETS.items():
+        snap = _SNAPSHOTS.get(title)
+        # после нашей записи снимок уже не отражает лист — такой не сохраняем
+        if snap is None or snap.gen != _sheet_gen(title):
+            continue
+        if snap.rows is None and any(n not in snap.derived for n in derived):
+            continue
+        if snap.fingerprint is None:
+            snap.fingerprint = _range_fingerprint(snap.rows, cols)
+        entry = {"rows": snap.fingerprint[0], "checksum": snap.fingerprint[1], "derived": {}}
+        for name in derived:
+            if name not in snap.derived:
+                _derived_store(title, snap, name, _CACHE_DERIVED[name](snap.rows))
+            entry["derived"][name] = snap.derived[name]
+        sheets[title] = entry
+
+    payload = {
+        "version": CACHE_VERSION,
+        "spreadsheet": SPREADSHEET_ID,
+        "saved_at": datetime.datetime.now().strftime(DATE_FMT),
+        "sheets": sheets,
+    }
+    tmp = CACHE_PATH + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(",", ":"), default=_cache_encode)
+    os.replace(tmp, CACHE_PATH)
+
+
+def restore_cache(client) -> None:
+    """
+    Поднять с диска то, что не изменилось с момента сохранения. Тем же запросом
+    маленькие листы читаются целиком и сразу становятся снимками.
+    """
+    saved = {}
+    try:
+        with gzip.open(CACHE_PATH, "rt", encoding="utf-8") as f:
+            payload = json.load(f, object_hook=_cache_decode)
+    except FileNotFoundError:
+        payload = {}
+    except Exception as e:
+        logger.warning(f"cache file unreadable, ignoring: {e}")
+        payload = {}
+    if payload.get("version") == CACHE_VERSION and payload.get("spreadsheet") == SPREADSHEET_ID:
+        saved = payload.get("sheets") or {}
+
+    checked = [t for t in saved if t in CACHE_SHEETS and t in _WORKSHEETS]
+    full = [t for t in CACHE_FULL_SHEETS if t in _WORKSHEETS]
+    titles = checked + full
+    if not titles:
+        return
+
+    sh = _WORKSHEETS[titles[0]].spreadsheet
+    gens = {t: _sheet_gen(t) for t in titles}
+    tails = {t: _tail_range(t, CACHE_SHEETS[t][1], int(saved[t].get("rows") or 0)) for t in checked}
+    ranges = [tails[t][0] for t in checked]
+    ranges += [gspread.utils.absolute_range_name(t) for t in full]
+    resp = sh.values_batch_get(ranges)
+
+    restored, changed = [], []
+    for title, vr in zip(titles, resp.get("valueRanges", [])):
+        values = vr.get("values", [])
+        if title in full:
+            snap = _Snapshot(gspread.utils.fill_gaps(values) if values else [], gens[title], time.monotonic())
+        else:
+            entry = saved[title]
+            n, crc = _range_fingerprint(values)
+            fp = (tails[title][1] + n - 1 if n else 0, crc)
+            if fp != (entry.get("rows"), entry.get("checksum")):
+                changed.append(title)
+                continue
+            snap = _Snapshot(None, gens[title], time.monotonic())
+            snap.derived.update(entry.get("derived") or {})
+            snap.fingerprint = fp
+            restored.append(title)
+        if _sheet_gen(title) == gens[title] and title not in _SNAPSHOTS:
+            _snapshot_store(title, snap)
+
+    logger.info(
+        f"cache from {payload.get('saved_at') or '-'}: restored {', '.join(restored) or '-'}; "
+        f"changed {', '.join(changed) or '-'}; loaded {', '.join(full) or '-'}"
+    )
+
 
+async def _cache_saver() -> None:
     while True:
+        await asyncio.sleep(CACHE_SAVE_INTERVAL)
         try:
-            client = get_gspread_client()
-            wb = client.open_by_key(SPREADSHEET_ID)
-            ws = wb.worksheet("Автомобили")
-
-            # гарантируем наличие нужных колонок
-            header = ws.row_values(1)
-            if not header:
-                header = []
-            # обеспечим колонки (вернёт индекс 1-based)
-            col_idx_name = _ensure_column(ws, "Название")
-            col_idx_ins  = _ensure_column(ws, "Страховка до")
-            col_idx_tech = _ensure_column(ws, "ТО до")
-            col_idx_contract = _ensure_column(ws, "Договор до")
-
-            # берём все строки
-            rows = ws.get_all_values()
-            body = rows[1:] if len(rows) > 1 else []
-
-            today = datetime.date.today()
-
-            for r in body:
-                name = r[col_idx_name - 1].strip() if len(r) >= col_idx_name else ""
-                ins  = r[col_idx_ins  - 1].strip() if len(r) >= col_idx_ins  else ""
-                tech = r[col_idx_tech - 1].strip() if len(r) >= col_idx_tech else ""
-                contract = r[col_idx_contract - 1].strip() if len(r) >= col_idx_contract else ""
-
-                # --- страховка ---
-                if ins:
-                    label, days = _days_left_label(ins)
-                    if days is not None:
-                        # отправляем, если просрочено / сегодня / в пределах окна
-                        if days < 0:
-                            msg = f"🚨 Страховка на *{name}* просрочена! ({ins}, {label})."
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-                        elif days == 0:
-                            msg = f"⏰ Сегодня истекает страховка на *{name}* ({ins})."
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-                        elif days <= REMIND_BEFORE_DAYS:
-                            msg = f"⏰ Через {days} дней истекает страховка на *{name}* ({ins})."
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-
-                # --- техосмотр ---
-                if tech:
-                    label, days = _days_left_label(tech)
-                    if days is not None:
-                        if days < 0:
-                            msg = f"🚨 Техосмотр на *{name}* просрочен! ({tech}, {label})."
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-                        elif days == 0:
-                            msg = f"⏰ Сегодня истекает техосмотр на *{name}* ({tech})."
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-                        elif days <= REMIND_BEFORE_DAYS:
-                            msg = f"⏰ Через {days} дней истекает техосмотр на *{name}* ({tech})."
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-
-                if contract:
-                    label, days = _days_left_label(contract)
-                    if days is not None:
-                        if days < 0:
-                            msg = (
-                                f"📃🤝 *Договор аренды* по *{name}* истёк!\n"
-                                f"⏱ Был до: {contract} ({label})."
-                            )
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-                        elif days == 0:
-                            msg = (
-                                f"📃🤝 Сегодня истекает *договор аренды* по *{name}*.\n"
-                                f"⏱ Дата: {contract}."
-                            )
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-                        elif days <= REMIND_BEFORE_DAYS:
-                            msg = (
-                                f"📃🤝 Через {days} дней истекает *договор аренды* по *{name}*.\n"
-                                f"⏱ До: {contract}."
-                            )
-                            await app.bot.send_message(chat_id=REMINDER_CHAT_ID, text=msg, parse_mode="Markdown")
-     
+            await asyncio.to_thread(save_cache)
         except Exception as e:
-            logger.error(f"Ошибка при проверке напоминаний: {e}")
+            logger.warning(f"cache save failed: {e}")
 
-        # спим 24 часа (можно уменьшить до 6–12, если хочешь чаще)
-        await asyncio.sleep(86400)
 
 async def on_startup(app):
-    asyncio.create_task(check_reminders(app))
+    _outbox_load()
+    _spawn(_outbox_worker(app.bot))
+    _spawn(_outbox_flusher())
+    _spawn(warm_up())
+    _spawn(_cache_saver())
+    _spawn(reminders_start(app))
+    _spawn(_loop_lag_probe())
+    metrics_server_start()
+
+
+async def on_shutdown(app):
+    _outbox_write(_outbox_dump())
+    try:
+        save_cache()
+    except Exception as e:
+        logger.warning(f"cache save failed: {e}")
 
 
 def main():
-    application = ApplicationBuilder().token(Telegram_Token).build()
-    application.add_handler(CommandHandler("menu", menu_command))
-    application.add_handler(CallbackQueryHandler(handle_button))
-    application.add_handler(MessageHandler(filters.Regex("^(Меню)$"), on_menu_button_pressed))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_amount_description))
+    application = (
+        ApplicationBuilder()
+        .token(Telegram_Token)
+        .request(_TelegramRequest(connection_pool_size=256))
+        .build()
+    )
+    application.add_handler(CommandHandler("menu", instrumented(menu_command)))
+    application.add_handler(CommandHandler("car", instrumented(car_command)))
+    application.add_handler(CommandHandler("stats", instrumented(stats_command)))
+    application.add_handler(CommandHandler("profile", instrumented(profile_command)))
+    application.add_handler(CommandHandler("mem", instrumented(mem_command)))
+    application.add_handler(InlineQueryHandler(instrumented(inline_car_search)))
+    application.add_handler(CallbackQueryHandler(instrumented(handle_button)))
+    application.add_handler(MessageHandler(filters.Regex("^(Меню)$"), instrumented(on_menu_button_pressed)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(handle_amount_description)))
     application.post_init = on_startup
+    application.post_shutdown = on_shutdown
     application.run_polling()
 
 
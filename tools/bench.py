@@ -0,0 +1,255 @@
+"""
+Офлайн-бенчмарк горячих путей бота на синтетических данных (таблица в памяти).
+
+    python tools/bench.py run --sizes 1k,10k,100k,500k --out bench.json
+    python tools/bench.py compare base.json bench.json --threshold 0.10
+
+cold — все кэши бота сброшены перед каждым замером (загрузка листа + разбор),
+warm — повторный вызов на прогретых снимках. Сеть не используется: задержка
+таблицы в бенчмарке нулевая, считается только CPU бота, gspread и JSON.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# состояние бота на диске — во временный каталог, чтобы не трогать рабочие файлы
+_TMP = tempfile.mkdtemp(prefix="bench-")
+os.environ.setdefault("OUTBOX_PATH", os.path.join(_TMP, "outbox.json"))
+os.environ.setdefault("CACHE_PATH", os.path.join(_TMP, "sheets_cache.json.gz"))
+os.environ.setdefault("REMINDER_STATE_PATH", os.path.join(_TMP, "reminders.json"))
+sys.path[:0] = [ROOT, HERE]
+
+import bot  # noqa: E402
+import fakebot  # noqa: E402
+import fakesheets  # noqa: E402
+
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "500k": 500_000}
+
+
+def measure(fn, setup=None, min_time: float = 0.5, min_reps: int = 3, max_reps: int = 200) -> dict:
+    """Повторять fn(), пока не наберётся min_time секунд (но не меньше min_reps раз)."""
+    samples = []
+    spent = 0.0
+    while len(samples) < max_reps and (len(samples) < min_reps or spent < min_time):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        samples.append(dt)
+        spent += dt
+    return _summary(samples)
+
+
+def _summary(samples: list) -> dict:
+    ordered = sorted(samples)
+    return {
+        "reps": len(samples),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.fmean(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+        "max": ordered[-1],
+    }
+
+
+def _cold():
+    fakesheets.reset_caches(bot)
+
+
+def ledger_cases(size_name: str, rows: int, args, results: dict) -> None:
+    store = fakesheets.FakeStore(fakesheets.synthetic_sheets(ledger_rows=rows, seed=args.seed))
+    fakesheets.install(bot, store)
+    client = bot.get_gspread_client()
+
+    def case(name, fn, cold=True, warm=True):
+        if args.only and args.only not in name:
+            return
+        if cold:
+            key = f"{name}[{size_name}]/cold"
+            results[key] = measure(fn, setup=_cold, min_time=args.min_time)
+            _report(key, results[key])
+        if warm:
+            fn()
+            key = f"{name}[{size_name}]/warm"
+            results[key] = measure(fn, min_time=args.min_time)
+            _report(key, results[key])
+
+    case("compute_balance", lambda: bot.compute_balance(client))
+    case("compute_summary", lambda: bot.compute_summary(client))
+    case("_sum_sheet_period:30d", lambda: bot._sum_sheet_period(client, "Доход", 30, exclude_transfers=True))
+    case("_sum_sheet_period:365d", lambda: bot._sum_sheet_period(client, "Расход", 365, exclude_transfers=True))
+
+    _, _, rows30 = bot._sum_sheet_period(client, "Доход", 30, exclude_transfers=True)
+    _, _, rows365 = bot._sum_sheet_period(client, "Доход", 365, exclude_transfers=True)
+    case("_aggregate_by_category:30d", lambda: bot._aggregate_by_category(rows30), cold=False)
+    case("_aggregate_by_category:365d", lambda: bot._aggregate_by_category(rows365), cold=False)
+    case("report_screen:30d", lambda: bot._build_report_screen(30))
+
+
+def workshop_cases(args, results: dict) -> None:
+    store = fakesheets.FakeStore(fakesheets.synthetic_sheets(
+        ledger_rows=1_000, workshop_cars=args.workshop_cars, per_car=args.per_car, seed=args.seed,
+    ))
+    fakesheets.install(bot, store)
+    client = bot.get_gspread_client()
+    tag = f"{args.workshop_cars}x{args.per_car}"
+    car_id = f"ws_{args.workshop_cars // 2}"
+
+    def case(name, fn, cold=True, warm=True):
+        if args.only and args.only not in name:
+            return
+        for mode, setup in (("cold", _cold), ("warm", None)):
+            if (mode == "cold" and not cold) or (mode == "warm" and not warm):
+                continue
+            if setup is None:
+                fn()
+            key = f"{name}[{tag}]/{mode}"
+            results[key] = measure(fn, setup=setup, min_time=args.min_time)
+            _report(key, results[key])
+
+    case("get_frozen_by_car", lambda: bot.get_frozen_by_car(client))
+    case("get_workshop_records_for_car", lambda: bot.get_workshop_records_for_car(client, car_id))
+    case("get_services_recent_for_car", lambda: bot.get_services_recent_for_car(client, car_id))
+    case("workshop_list_screen", lambda: bot._build_workshop_list_screen(0))
+    case("workshop_view_screen", lambda: bot._build_workshop_view_screen(car_id))
+
+    if not args.only or args.only in "ws_finish_apply":
+        results[f"ws_finish_apply[{tag}]"] = asyncio.run(_bench_finish(args))
+        _report(f"ws_finish_apply[{tag}]", results[f"ws_finish_apply[{tag}]"])
+
+
+async def _bench_finish(args) -> dict:
+    """Завершение ремонта через роутер: каждый прогон — новая машина из мастерской."""
+    stub = fakebot.StubBot()
+    op = fakebot.Operator(stub, user_id=1)
+    client = bot.get_gspread_client()
+    samples = []
+    spent = 0.0
+    for i in range(args.workshop_cars):
+        if len(samples) >= 3 and spent >= args.min_time:
+            break
+        car_id = f"ws_{i}"
+        op.user_data.clear()
+        op.user_data.update({
+            "car_name": fakesheets.car_name(i),
+            "dest_frozen": "Карта",
+            "dest_income": "Наличные",
+            "services_total": bot.get_services_total_for_car(client, car_id),
+        })
+        t0 = time.perf_counter()
+        await op.press(bot.route_button, f"ws_finish_apply:{car_id}")
+        dt = time.perf_counter() - t0
+        samples.append(dt)
+        spent += dt
+    await asyncio.gather(*list(bot._BG_TASKS), return_exceptions=True)
+    return _summary(samples)
+
+
+def _report(key: str, r: dict) -> None:
+    print(f"{key:60s} median {r['median'] * 1000:10.3f} ms   p95 {r['p95'] * 1000:10.3f} ms   n={r['reps']}", flush=True)
+
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip()
+    except OSError:
+        return ""
+
+
+def cmd_run(args) -> int:
+    logging.getLogger("bot").setLevel(logging.ERROR)
+    results = {}
+    for name in args.sizes.split(","):
+        name = name.strip()
+        if name not in SIZES:
+            print(f"неизвестный размер {name!r}; есть: {', '.join(SIZES)}", file=sys.stderr)
+            return 2
+        ledger_cases(name, SIZES[name], args, results)
+    if not args.skip_workshop:
+        workshop_cases(args, results)
+
+    doc = {
+        "meta": {
+            "commit": _git_commit(),
+            "when": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "sizes": args.sizes,
+            "min_time": args.min_time,
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(doc, f, ensure_ascii=False, indent=1)
+        print(f"-> {args.out}")
+    return 0
+
+
+def cmd_compare(args) -> int:
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    b, n = base["results"], new["results"]
+    print(f"base {base['meta'].get('commit') or '?'}  ->  new {new['meta'].get('commit') or '?'}  (медианы)")
+    regressions = 0
+    for key in sorted(set(b) | set(n)):
+        if key not in b or key not in n:
+            print(f"{key:60s} {'только в ' + ('base' if key in b else 'new'):>24s}")
+            continue
+        old, cur = b[key]["median"], n[key]["median"]
+        change = (cur - old) / old if old else 0.0
+        mark = ""
+        if change > args.threshold:
+            mark = "  ▲ медленнее"
+            regressions += 1
+        elif change < -args.threshold:
+            mark = "  ▼ быстрее"
+        print(f"{key:60s} {old * 1000:10.3f} -> {cur * 1000:10.3f} ms  {change:+7.1%}{mark}")
+    return 1 if regressions and args.fail else 0
+
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    r = sub.add_parser("run", help="прогнать бенчмарки")
+    r.add_argument("--sizes", default="1k,10k,100k,500k", help="размеры Доход/Расход через запятую")
+    r.add_argument("--workshop-cars", type=int, default=300)
+    r.add_argument("--per-car", type=int, default=8, help="записей Мастерская_Данные на машину")
+    r.add_argument("--skip-workshop", action="store_true")
+    r.add_argument("--min-time", type=float, default=0.5, help="секунд замеров на случай")
+    r.add_argument("--only", default="", help="только случаи, в имени которых есть подстрока")
+    r.add_argument("--seed", type=int, default=1)
+    r.add_argument("--out", default="", help="куда записать JSON")
+    r.set_defaults(func=cmd_run)
+
+    c = sub.add_parser("compare", help="сравнить два JSON-результата")
+    c.add_argument("base")
+    c.add_argument("new")
+    c.add_argument("--threshold", type=float, default=0.10, help="порог изменения медианы (0.10 = 10%%)")
+    c.add_argument("--fail", action="store_true", help="код выхода 1, если есть замедления")
+    c.set_defaults(func=cmd_compare)
+
+    args = p.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+Заглушки Telegram для прогонов хендлеров без сети: Update/CallbackQuery/Message/Context
+с теми методами, которые вызывает бот. Вызовы Bot API считаются в StubBot.
+"""
+
+import asyncio
+import collections
+import itertools
+import re
+
+
+class StubBot:
+    """Считает «вызовы Bot API»; latency — пауза на каждый вызов, как у настоящего API."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._ids = itertools.count(1000)
+
+    async def call(self, method: str) -> None:
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def next_message_id(self) -> int:
+        return next(self._ids)
+
+    async def send_message(self, chat_id, text, **kw):
+        await self.call("sendMessage")
+        return StubMessage(self, chat_id, text, kw.get("reply_markup"))
+
+    async def send_document(self, chat_id, document=None, filename=None, **kw):
+        await self.call("sendDocument")
+
+
+class StubMessage:
+    def __init__(self, bot: StubBot, chat_id: int, text: str = "", reply_markup=None, from_user=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = bot.next_message_id()
+        self.text = text
+        self.reply_markup = reply_markup
+        self.from_user = from_user
+        self.replies = []   # сообщения, которые бот прислал в ответ
+
+    async def reply_text(self, text, reply_markup=None, parse_mode=None, **kw):
+        await self.bot.call("sendMessage")
+        msg = StubMessage(self.bot, self.chat_id, text, reply_markup)
+        self.replies.append(msg)
+        return msg
+
+    async def edit_text(self, text, reply_markup=None, parse_mode=None, **kw):
+        await self.bot.call("editMessageText")
+        self.text = text
+        self.reply_markup = reply_markup
+        return self
+
+
+class StubQuery:
+    def __init__(self, bot: StubBot, user, message: StubMessage, data: str):
+        self.bot = bot
+        self.from_user = user
+        self.message = message
+        self.data = data
+
+    async def answer(self, *args, **kw):
+        await self.bot.call("answerCallbackQuery")
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None, **kw):
+        await self.message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return self.message
+
+
+class StubUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"op{user_id}"
+        self.username = None
+        self.is_bot = False
+
+
+class StubChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+        self.type = "private"
+
+
+class StubUpdate:
+    _ids = itertools.count(1)
+
+    def __init__(self, user: StubUser, message: StubMessage = None, callback_query: StubQuery = None):
+        self.update_id = next(self._ids)
+        self.message = message
+        self.callback_query = callback_query
+        self.inline_query = None
+        self.effective_user = user
+        self.effective_chat = StubChat(user.id)
+        self.effective_message = message if message is not None else (callback_query and callback_query.message)
+
+
+class StubContext:
+    def __init__(self, bot: StubBot, user_data: dict, args=None):
+        self.bot = bot
+        self.user_data = user_data
+        self.chat_data = {}
+        self.bot_data = {}
+        self.args = args or []
+        self.job_queue = None
+
+
+class Operator:
+    """
+    Один оператор в личке с ботом: своё user_data и «экран» — последнее сообщение
+    с кнопками, по которым можно нажимать.
+    """
+
+    def __init__(self, bot: StubBot, user_id: int):
+        self.bot = bot
+        self.user = StubUser(user_id)
+        self.user_data = {}
+        self.screen = StubMessage(bot, user_id, "", None, self.user)
+
+    def _track(self, msg: StubMessage) -> None:
+        # экраном становится последнее сообщение с инлайн-кнопками
+        for m in [msg] + msg.replies:
+            if getattr(m.reply_markup, "inline_keyboard", None):
+                self.screen = m
+        msg.replies.clear()
+
+    def buttons(self) -> list:
+        """[(текст, callback_data)] текущего экрана."""
+        kb = getattr(self.screen.reply_markup, "inline_keyboard", None) or ()
+        return [(b.text, b.callback_data) for row in kb for b in row if b.callback_data]
+
+    def find(self, pattern: str) -> str:
+        """callback_data первой кнопки, чей текст или data подходят под regex."""
+        rx = re.compile(pattern)
+        for text, data in self.buttons():
+            if rx.search(data) or rx.search(text):
+                return data
+        raise LookupError(f"нет кнопки {pattern!r} на экране: {self.screen.text[:80]!r}")
+
+    async def press(self, handler, data: str) -> None:
+        query = StubQuery(self.bot, self.user, self.screen, data)
+        await handler(StubUpdate(self.user, callback_query=query), StubContext(self.bot, self.user_data))
+        self._track(self.screen)
+
+    async def send(self, handler, text: str, args=None) -> None:
+        msg = StubMessage(self.bot, self.user.id, text, None, self.user)
+        await handler(StubUpdate(self.user, message=msg), StubContext(self.bot, self.user_data, args))
+        self._track(msg)
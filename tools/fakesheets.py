@@ -0,0 +1,462 @@
+"""
+Таблица в памяти вместо Google Sheets — для бенчмарков и нагрузочных прогонов.
+
+Подменяется HTTP-сессия gspread, а не сам бот: запросы идут через настоящий
+gspread и _SheetsClient.request, так что учёт записей, метрики и бюджет вызовов
+работают как в проде. Поддержаны те эндпоинты Sheets API v4, которыми пользуется бот:
+метаданные, values get/update/append/clear, values:batchGet/batchUpdate и
+:batchUpdate (appendCells, deleteDimension, addSheet).
+
+    store = FakeStore(synthetic_sheets(ledger_rows=10_000))
+    install(bot, store, latency=0.05)
+"""
+
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from decimal import Decimal
+from urllib.parse import unquote
+
+SPREADSHEET_ID = "fake-spreadsheet"
+_SHEETS_EPOCH = datetime.datetime(1899, 12, 30)
+
+
+# ---- A1 ----
+
+def col_to_num(letters: str) -> int:
+    n = 0
+    for ch in letters.upper():
+        n = n * 26 + ord(ch) - 64
+    return n
+
+
+def num_to_col(n: int) -> str:
+    s = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+_CELL_RE = re.compile(r"([A-Za-z]*)(\d*)")
+
+
+def parse_range(rng: str):
+    """"'Доход'!A2:F" -> ("Доход", 2, 1, None, 6); None — граница открыта."""
+    rng = unquote(rng)
+    if "!" in rng:
+        title, cells = rng.rsplit("!", 1)
+    else:
+        title, cells = rng, ""
+    if len(title) >= 2 and title[0] == "'" and title[-1] == "'":
+        title = title[1:-1].replace("''", "'")
+    if not cells:
+        return title, 1, 1, None, None
+    left, _, right = cells.partition(":")
+    lc, lr = _CELL_RE.fullmatch(left).groups()
+    if right:
+        rc, rr = _CELL_RE.fullmatch(right).groups()
+    else:
+        rc, rr = lc, lr
+    return (
+        title,
+        int(lr) if lr else 1,
+        col_to_num(lc) if lc else 1,
+        int(rr) if rr else None,
+        col_to_num(rc) if rc else None,
+    )
+
+
+def _a1(title: str, r1: int, c1: int, r2: int, c2: int) -> str:
+    quoted = "'" + title.replace("'", "''") + "'"
+    return f"{quoted}!{num_to_col(c1)}{r1}:{num_to_col(c2)}{r2}"
+
+
+# ---- хранилище ----
+
+class FakeSheet:
+    def __init__(self, sheet_id: int, title: str, rows):
+        self.id = sheet_id
+        self.title = title
+        self.rows = [[str(v) for v in r] for r in rows]
+
+    def last_row(self) -> int:
+        n = len(self.rows)
+        while n and not any(self.rows[n - 1]):
+            n -= 1
+        return n
+
+    def width(self) -> int:
+        return max((len(r) for r in self.rows), default=0)
+
+    def read(self, r1, c1, r2, c2) -> list:
+        r2 = self.last_row() if r2 is None else min(r2, self.last_row())
+        out = []
+        for r in self.rows[r1 - 1:r2]:
+            part = r[c1 - 1:c2] if c2 is not None else r[c1 - 1:]
+            while part and part[-1] == "":
+                part = part[:-1]
+            out.append(part)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def write(self, r1, c1, values) -> None:
+        for i, vals in enumerate(values):
+            row_no = r1 + i
+            while len(self.rows) < row_no:
+                self.rows.append([])
+            row = self.rows[row_no - 1]
+            need = c1 - 1 + len(vals)
+            if len(row) < need:
+                row.extend([""] * (need - len(row)))
+            for j, v in enumerate(vals):
+                row[c1 - 1 + j] = "" if v is None else _entered(v)
+
+
+def _entered(v) -> str:
+    """Как значение выглядит после записи (FORMATTED_VALUE) — здесь просто строка."""
+    if isinstance(v, bool):
+        return "TRUE" if v else "FALSE"
+    if isinstance(v, float):
+        return _fmt_number(v)
+    return str(v)
+
+
+def _fmt_number(v: float) -> str:
+    s = f"{v:.10f}".rstrip("0").rstrip(".")
+    return s or "0"
+
+
+def _cell_text(cell: dict) -> str:
+    """Ячейка appendCells -> отображаемое значение."""
+    val = cell.get("userEnteredValue") or {}
+    if "stringValue" in val:
+        return val["stringValue"]
+    if "formulaValue" in val:
+        return val["formulaValue"]
+    if "boolValue" in val:
+        return "TRUE" if val["boolValue"] else "FALSE"
+    if "numberValue" in val:
+        num = val["numberValue"]
+        pattern = (((cell.get("userEnteredFormat") or {}).get("numberFormat")) or {}).get("pattern", "")
+        if "dd" in pattern:
+            dt = _SHEETS_EPOCH + datetime.timedelta(days=num)
+            if "hh" in pattern:
+                # серийное число — float: округляем до минуты
+                return (dt + datetime.timedelta(seconds=30)).strftime("%d.%m.%Y %H:%M")
+            return dt.strftime("%d.%m.%Y")
+        return _fmt_number(num)
+    return ""
+
+
+class FakeStore:
+    """Листы таблицы: title -> FakeSheet. Все операции под одним замком, как атомарный API."""
+
+    def __init__(self, sheets: dict):
+        self.lock = threading.Lock()
+        self.sheets = {}
+        for i, (title, rows) in enumerate(sheets.items()):
+            self.sheets[title] = FakeSheet(1000 + i, title, rows)
+
+    def sheet(self, title: str) -> FakeSheet:
+        try:
+            return self.sheets[title]
+        except KeyError:
+            raise FakeAPIError(400, f"Unable to parse range: {title}")
+
+    def by_id(self, sheet_id) -> FakeSheet:
+        for sh in self.sheets.values():
+            if sh.id == sheet_id:
+                return sh
+        raise FakeAPIError(400, f"No grid with id: {sheet_id}")
+
+
+class FakeAPIError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+# ---- HTTP ----
+
+class FakeResponse:
+    def __init__(self, status_code: int, payload: dict, serialize: bool):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self._payload = payload
+        self._content = json.dumps(payload, ensure_ascii=False).encode("utf-8") if serialize else None
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            self._content = json.dumps(self._payload, ensure_ascii=False).encode("utf-8")
+        return self._content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        if self._content is not None:
+            return json.loads(self._content)
+        return self._payload
+
+
+class FakeSession:
+    """
+    Вместо requests.Session для gspread.Client.
+    latency — секунды на каждый запрос (или callable(method, url) -> секунды);
+    serialize — гонять ответы через JSON, как по сети (честнее по CPU, медленнее).
+    """
+
+    def __init__(self, store: FakeStore, latency=0.0, serialize: bool = True):
+        self.store = store
+        self.latency = latency
+        self.serialize = serialize
+        self.calls = 0
+        self.reads = 0
+        self.writes = 0
+        self._count_lock = threading.Lock()
+
+    def get(self, url, **kw):
+        return self._handle("get", url, kw)
+
+    def post(self, url, **kw):
+        return self._handle("post", url, kw)
+
+    def put(self, url, **kw):
+        return self._handle("put", url, kw)
+
+    def _handle(self, method: str, url: str, kw: dict) -> FakeResponse:
+        with self._count_lock:
+            self.calls += 1
+            if method == "get":
+                self.reads += 1
+            else:
+                self.writes += 1
+        delay = self.latency(method, url) if callable(self.latency) else self.latency
+        if delay:
+            time.sleep(delay)
+        params = kw.get("params") or {}
+        body = kw.get("json")
+        try:
+            with self.store.lock:
+                payload = self._dispatch(method, url, params, body)
+            return FakeResponse(200, payload, self.serialize)
+        except FakeAPIError as e:
+            error = {"error": {"code": e.code, "message": e.message, "status": "INVALID_ARGUMENT"}}
+            return FakeResponse(e.code, error, self.serialize)
+
+    def _dispatch(self, method, url, params, body) -> dict:
+        tail = url.split("/spreadsheets/", 1)[1]
+        sid, _, rest = tail.partition("/")
+        if not rest:
+            if sid.endswith(":batchUpdate"):
+                return self._batch_update(body or {})
+            return self._metadata()
+        if rest == "values:batchGet":
+            ranges = params.get("ranges") or []
+            if isinstance(ranges, str):
+                ranges = [ranges]
+            return {"spreadsheetId": SPREADSHEET_ID, "valueRanges": [self._values_get(r) for r in ranges]}
+        if rest == "values:batchUpdate":
+            for item in (body or {}).get("data", []):
+                self._values_put(item["range"], item.get("values", []))
+            return {"spreadsheetId": SPREADSHEET_ID}
+        if rest.startswith("values/"):
+            rng = rest[len("values/"):]
+            m = re.fullmatch(r"(.*):(append|clear)", rng)
+            if m and m.group(2) == "append":
+                return self._values_append(m.group(1), (body or {}).get("values", []))
+            if m and m.group(2) == "clear":
+                title, r1, c1, r2, c2 = parse_range(m.group(1))
+                sh = self.store.sheet(title)
+                for r in sh.rows[r1 - 1:(r2 or len(sh.rows))]:
+                    for j in range(c1 - 1, min(len(r), c2 or len(r))):
+                        r[j] = ""
+                return {"spreadsheetId": SPREADSHEET_ID}
+            if method == "get":
+                return self._values_get(rng)
+            return self._values_put(rng, (body or {}).get("values", []))
+        raise FakeAPIError(404, f"unsupported endpoint: {method} {url}")
+
+    def _metadata(self) -> dict:
+        sheets = []
+        for i, sh in enumerate(self.store.sheets.values()):
+            sheets.append({"properties": {
+                "sheetId": sh.id,
+                "title": sh.title,
+                "index": i,
+                "sheetType": "GRID",
+                "gridProperties": {"rowCount": max(1000, len(sh.rows)), "columnCount": max(26, sh.width())},
+            }})
+        return {
+            "spreadsheetId": SPREADSHEET_ID,
+            "properties": {"title": "fake", "locale": "ru_RU", "timeZone": "Europe/Moscow"},
+            "sheets": sheets,
+        }
+
+    def _values_get(self, rng: str) -> dict:
+        title, r1, c1, r2, c2 = parse_range(rng)
+        sh = self.store.sheet(title)
+        values = sh.read(r1, c1, r2, c2)
+        end_r = r2 or max(r1, sh.last_row())
+        end_c = c2 or max(c1, sh.width())
+        out = {"range": _a1(title, r1, c1, end_r, end_c), "majorDimension": "ROWS"}
+        if values:
+            out["values"] = values
+        return out
+
+    def _values_put(self, rng: str, values: list) -> dict:
+        title, r1, c1, _, _ = parse_range(rng)
+        self.store.sheet(title).write(r1, c1, values)
+        return {"spreadsheetId": SPREADSHEET_ID, "updatedRange": rng}
+
+    def _values_append(self, rng: str, values: list) -> dict:
+        title, _, c1, _, _ = parse_range(rng)
+        sh = self.store.sheet(title)
+        start = sh.last_row() + 1
+        sh.write(start, c1, values)
+        width = max((len(v) for v in values), default=1)
+        updated = _a1(title, start, c1, start + len(values) - 1, c1 + width - 1)
+        return {"spreadsheetId": SPREADSHEET_ID, "updates": {"updatedRange": updated, "updatedRows": len(values)}}
+
+    def _batch_update(self, body: dict) -> dict:
+        replies = []
+        for req in body.get("requests", []):
+            (kind, spec), = req.items()
+            if kind == "appendCells":
+                sh = self.store.by_id(spec["sheetId"])
+                start = sh.last_row() + 1
+                rows = [[_cell_text(c) for c in row.get("values", [])] for row in spec.get("rows", [])]
+                sh.write(start, 1, rows)
+            elif kind == "deleteDimension":
+                rng = spec["range"]
+                sh = self.store.by_id(rng["sheetId"])
+                if rng.get("dimension", "ROWS") != "ROWS":
+                    raise FakeAPIError(400, "only ROWS deletion is supported")
+                del sh.rows[rng["startIndex"]:rng["endIndex"]]
+            elif kind == "addSheet":
+                props = spec.get("properties", {})
+                title = props["title"]
+                sheet_id = 1000 + len(self.store.sheets)
+                self.store.sheets[title] = FakeSheet(sheet_id, title, [])
+                replies.append({"addSheet": {"properties": {"sheetId": sheet_id, "title": title}}})
+                continue
+            else:
+                raise FakeAPIError(400, f"unsupported request: {kind}")
+            replies.append({})
+        return {"spreadsheetId": SPREADSHEET_ID, "replies": replies}
+
+
+# ---- синтетические данные ----
+
+INCOME_CATS = ["Аренда", "Ремонт", "Продажа запчастей", "Перевод", "Другое"]
+EXPENSE_CATS = ["Бензин", "Запчасти", "Страховка", "Налоги", "Перевод", "Другое"]
+
+
+def _money(rnd: random.Random) -> str:
+    return str(Decimal(rnd.randint(100, 500_000)) / 100)
+
+
+def make_categories() -> list:
+    rows = [["ID", "Тип", "Название", "Активна", "Порядок"]]
+    for kind, names in (("Доход", INCOME_CATS), ("Расход", EXPENSE_CATS)):
+        for i, name in enumerate(names):
+            rows.append([f"cat_{kind[0]}{i}", kind, name, "1", str(i)])
+    return rows
+
+
+def make_ledger(n: int, kind: str, seed: int = 1, days: int = 730) -> list:
+    """[Дата, КатегорияID, Категория, 💳, 💵, 📝] за последние days дней, по дате."""
+    rnd = random.Random(f"{seed}-{kind}-{n}")
+    names = INCOME_CATS if kind == "Доход" else EXPENSE_CATS
+    now = datetime.datetime.now()
+    start = now - datetime.timedelta(days=days)
+    step = (now - start) / max(n, 1)
+    rows = [["Дата", "КатегорияID", "Категория", "💳 Карта", "💵 Наличные", "📝 Описание"]]
+    for i in range(n):
+        dt = start + step * i
+        c = rnd.randrange(len(names))
+        card, cash = (_money(rnd), "") if rnd.random() < 0.6 else ("", _money(rnd))
+        rows.append([dt.strftime("%d.%m.%Y %H:%M"), f"cat_{kind[0]}{c}", names[c], card, cash, f"запись {i}"])
+    return rows
+
+
+def car_name(i: int) -> str:
+    models = ["Mazda 3", "Kia Rio", "Hyundai Solaris", "VW Polo", "Skoda Rapid", "Toyota Camry"]
+    return f"{models[i % len(models)]} #{i}"
+
+
+def make_cars(n: int, seed: int = 1) -> list:
+    rnd = random.Random(f"{seed}-cars")
+    today = datetime.date.today()
+    rows = [["ID", "Название", "VIN", "Номер", "Создано", "Страховка до", "ТО до", "Договор до"]]
+    for i in range(n):
+        def date():
+            return (today + datetime.timedelta(days=rnd.randint(-30, 400))).strftime("%d.%m.%Y")
+        rows.append([
+            f"car_{i}", car_name(i), f"VIN{i:014d}", f"А{i % 1000:03d}ВС77",
+            today.strftime("%d.%m.%Y"), date(), date(), date(),
+        ])
+    return rows
+
+
+def make_workshop(cars: int, per_car: int = 8, seed: int = 1) -> tuple:
+    """(Мастерская, Мастерская_Данные): cars машин в ремонте, у каждой per_car услуг/заморозок."""
+    rnd = random.Random(f"{seed}-ws")
+    now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
+    cars_rows = [["ID", "Название", "VIN", "Создано"]]
+    data = [["Тип", "ID", "CarID", "Название", "VIN", "Дата", "Источник", "Сумма", "Описание"]]
+    rec = 0
+    for i in range(cars):
+        car_id = f"ws_{i}"
+        cars_rows.append([car_id, car_name(i), f"VIN{i:014d}", now])
+        for _ in range(per_car):
+            rec += 1
+            kind = "Услуга" if rnd.random() < 0.5 else "Заморозка"
+            src = "" if kind == "Услуга" else rnd.choice(["Карта", "Наличные"])
+            data.append([kind, f"w{rec}", car_id, car_name(i), f"VIN{i:014d}", now, src, _money(rnd), f"работа {rec}"])
+    return cars_rows, data
+
+
+def synthetic_sheets(ledger_rows: int = 1000, cars: int = 300, workshop_cars: int = 300,
+                     per_car: int = 8, seed: int = 1) -> dict:
+    """Все листы бота с синтетическими данными: title -> строки."""
+    workshop, workshop_data = make_workshop(workshop_cars, per_car, seed)
+    return {
+        "Категории": make_categories(),
+        "Автомобили": make_cars(cars, seed),
+        "Сводка": [["Ключ", "Значение"], ["INITIAL_BALANCE", "100000.00"]],
+        "Доход": make_ledger(ledger_rows, "Доход", seed),
+        "Расход": make_ledger(ledger_rows, "Расход", seed),
+        "Мастерская": workshop,
+        "Мастерская_Данные": workshop_data,
+    }
+
+
+# ---- подключение к боту ----
+
+def install(bot, store: FakeStore, latency=0.0, serialize: bool = True) -> FakeSession:
+    """Подменить клиента таблицы в модуле bot на таблицу в памяти; вернуть сессию (счётчики)."""
+    session = FakeSession(store, latency=latency, serialize=serialize)
+    client = bot._SheetsClient(auth=None, session=session)
+    with bot._CLIENT_LOCK:
+        bot._CLIENT = client
+    bot.SPREADSHEET_ID = SPREADSHEET_ID
+    bot._load_worksheets(client)
+    reset_caches(bot)
+    return session
+
+
+def reset_caches(bot) -> None:
+    """Всё закэшированное в боте считаем устаревшим (как после чужой правки таблицы)."""
+    bot.note_sheet_write(None)
+    bot._SNAPSHOTS.clear()
+    bot._SCREEN_CACHE.clear()
+    bot.CACHES.clear()
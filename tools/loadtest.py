@@ -0,0 +1,326 @@
+"""
+Нагрузочный прогон: много операторов одновременно проходят сценарии через
+handle_button / handle_amount_description (в обёртке instrumented, как в проде)
+против таблицы в памяти с задержкой и заглушки Telegram.
+
+    python tools/loadtest.py --operators 20 --sessions 5 --latency 0.08 --json out.json
+
+Сценарии: income (доход через категорию), report (отчёты и баланс),
+workshop (машина в мастерскую -> услуга -> запчасти -> завершение), car (правка даты).
+Задержка «нажатия» считается до дорисовки экрана (фоновые render_deferred тоже).
+"""
+
+import argparse
+import asyncio
+import collections
+import contextvars
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+_TMP = tempfile.mkdtemp(prefix="loadtest-")
+os.environ.setdefault("OUTBOX_PATH", os.path.join(_TMP, "outbox.json"))
+os.environ.setdefault("CACHE_PATH", os.path.join(_TMP, "sheets_cache.json.gz"))
+os.environ.setdefault("REMINDER_STATE_PATH", os.path.join(_TMP, "reminders.json"))
+sys.path[:0] = [ROOT, HERE]
+
+import bot  # noqa: E402
+import fakebot  # noqa: E402
+import fakesheets  # noqa: E402
+
+# счётчики вызовов таблицы текущей сессии: контекст доходит и до asyncio.to_thread
+_SESSION = contextvars.ContextVar("loadtest_session", default=None)
+
+ERROR_MARKS = ("⚠️", "❌", "🚫")
+
+
+class Session:
+    def __init__(self, scenario: str, operator: int):
+        self.scenario = scenario
+        self.operator = operator
+        self.reads = 0
+        self.writes = 0
+        self.tg_calls = 0
+        self.errors = []
+        self.steps = []      # (маршрут, секунды)
+        self.seconds = 0.0
+
+
+class CountingSession(fakesheets.FakeSession):
+    def _handle(self, method, url, kw):
+        s = _SESSION.get()
+        if s is not None:
+            if method == "get":
+                s.reads += 1
+            else:
+                s.writes += 1
+        return super()._handle(method, url, kw)
+
+
+class CountingBot(fakebot.StubBot):
+    async def call(self, method):
+        s = _SESSION.get()
+        if s is not None:
+            s.tg_calls += 1
+        await super().call(method)
+
+
+BUTTON = bot.instrumented(bot.handle_button)
+TEXT = bot.instrumented(bot.handle_amount_description)
+
+
+async def settle(op: fakebot.Operator, timeout: float = 60.0) -> None:
+    """Дождаться, пока у оператора не останется недорисованных экранов."""
+    deadline = time.monotonic() + timeout
+    while any(key[0] == op.user.id for key in list(bot._CALLBACKS_IN_FLIGHT)):
+        if time.monotonic() > deadline:
+            raise TimeoutError("экран не дорисовался")
+        await asyncio.sleep(0.002)
+
+
+async def press(s: Session, op: fakebot.Operator, data: str) -> None:
+    t0 = time.perf_counter()
+    await op.press(BUTTON, data)
+    await settle(op)
+    s.steps.append(("cb:" + bot.callback_route(data), time.perf_counter() - t0))
+    _check(s, op)
+
+
+async def send(s: Session, op: fakebot.Operator, text: str) -> None:
+    route = f"text:{op.user_data.get('action') or '-'}/{op.user_data.get('step') or '-'}"
+    t0 = time.perf_counter()
+    await op.send(TEXT, text)
+    await settle(op)
+    s.steps.append((route, time.perf_counter() - t0))
+    _check(s, op)
+
+
+def _check(s: Session, op: fakebot.Operator) -> None:
+    text = op.screen.text or ""
+    if text.startswith(ERROR_MARKS):
+        s.errors.append(text.splitlines()[0][:120])
+
+
+# ---- сценарии ----
+
+async def scenario_income(s, op, rnd):
+    kind, prefix = rnd.choice([("income", "income_cat"), ("expense", "expense_cat")])
+    await press(s, op, kind)
+    await press(s, op, op.find(rf"^{prefix}\|"))
+    await press(s, op, rnd.choice(["source_card", "source_cash"]))
+    await send(s, op, f"{rnd.randint(100, 50_000)}.{rnd.randint(0, 99):02d}")
+    await send(s, op, f"loadtest op{op.user.id}")
+
+
+async def scenario_report(s, op, rnd):
+    await press(s, op, rnd.choice(["report_7", "report_30"]))
+    await press(s, op, "balance")
+    await press(s, op, "report_30_details_income_page0")
+
+
+async def scenario_workshop(s, op, rnd):
+    await press(s, op, "workshop_add")
+    await send(s, op, f"Loadtest {op.user.id}-{rnd.randint(0, 10**6)}")
+    await send(s, op, "-")
+    car_data = op.find(r"^workshop_view:")
+    car_id = car_data.split(":", 1)[1]
+    await press(s, op, car_data)
+    await press(s, op, f"workshop_add_service:{car_id}")
+    await send(s, op, str(rnd.randint(500, 20_000)))
+    await send(s, op, "диагностика")
+    await press(s, op, f"workshop_buy_parts:{car_id}")
+    await send(s, op, str(rnd.randint(500, 20_000)))
+    await press(s, op, f"ws_buy_src:{rnd.choice(['card', 'cash'])}:{car_id}")
+    await send(s, op, "фильтр")
+    await press(s, op, f"workshop_finish:{car_id}")
+    await press(s, op, f"ws_finish_src_frozen:{rnd.choice(['card', 'cash'])}:{car_id}")
+    await press(s, op, f"ws_finish_src_income:{rnd.choice(['card', 'cash'])}:{car_id}")
+    await press(s, op, f"ws_finish_apply:{car_id}")
+
+
+async def scenario_car(s, op, rnd):
+    await press(s, op, "cars_edit")
+    cars = [data for _, data in op.buttons() if data.startswith("editcar")]
+    await press(s, op, rnd.choice(cars))
+    await press(s, op, rnd.choice(["editcar_field|insurance", "editcar_field|tech"]))
+    await send(s, op, f"{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.2027")
+
+
+SCENARIOS = {
+    "income": scenario_income,
+    "report": scenario_report,
+    "workshop": scenario_workshop,
+    "car": scenario_car,
+}
+
+
+async def operator_loop(op_no: int, stub: CountingBot, args, mix: list, sessions: list) -> None:
+    rnd = random.Random(args.seed * 1000 + op_no)
+    op = fakebot.Operator(stub, user_id=10_000 + op_no)
+    names, weights = zip(*mix)
+    for _ in range(args.sessions):
+        name = rnd.choices(names, weights)[0]
+        s = Session(name, op_no)
+        token = _SESSION.set(s)
+        t0 = time.perf_counter()
+        try:
+            await press(s, op, "menu")
+            await SCENARIOS[name](s, op, rnd)
+        except Exception as e:
+            s.errors.append(f"{type(e).__name__}: {e}")
+        finally:
+            s.seconds = time.perf_counter() - t0
+            _SESSION.reset(token)
+        sessions.append(s)
+        if args.think:
+            await asyncio.sleep(rnd.uniform(0, 2 * args.think))
+
+
+def _pct(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def summarize(sessions: list, wall: float, store_calls: int) -> dict:
+    steps = [dt for s in sessions for _, dt in s.steps]
+    by_route = collections.defaultdict(list)
+    for s in sessions:
+        for route, dt in s.steps:
+            by_route[route].append(dt)
+    by_scenario = collections.defaultdict(list)
+    for s in sessions:
+        by_scenario[s.scenario].append(s)
+
+    def lat(values):
+        return {
+            "n": len(values),
+            "p50": _pct(values, 0.50),
+            "p95": _pct(values, 0.95),
+            "p99": _pct(values, 0.99),
+            "max": max(values) if values else 0.0,
+        }
+
+    return {
+        "wall_seconds": wall,
+        "sessions": len(sessions),
+        "updates": len(steps),
+        "sessions_per_second": len(sessions) / wall if wall else 0.0,
+        "updates_per_second": len(steps) / wall if wall else 0.0,
+        "sheets_calls_total": store_calls,
+        "latency": lat(steps),
+        "routes": {r: lat(v) for r, v in sorted(by_route.items())},
+        "scenarios": {
+            name: {
+                "sessions": len(ss),
+                "errors": sum(1 for s in ss if s.errors),
+                "seconds": lat([s.seconds for s in ss]),
+                "sheets_reads_mean": statistics.fmean(s.reads for s in ss),
+                "sheets_writes_mean": statistics.fmean(s.writes for s in ss),
+                "sheets_calls_p95": _pct([s.reads + s.writes for s in ss], 0.95),
+                "tg_calls_mean": statistics.fmean(s.tg_calls for s in ss),
+            }
+            for name, ss in sorted(by_scenario.items())
+        },
+        "errors": collections.Counter(e for s in sessions for e in s.errors).most_common(10),
+    }
+
+
+def print_report(r: dict) -> None:
+    ms = lambda v: f"{v * 1000:8.1f}"  # noqa: E731
+    print(
+        f"\n{r['sessions']} сессий, {r['updates']} обновлений за {r['wall_seconds']:.1f} с: "
+        f"{r['sessions_per_second']:.2f} сессий/с, {r['updates_per_second']:.1f} обновлений/с, "
+        f"вызовов таблицы {r['sheets_calls_total']}"
+    )
+    lat = r["latency"]
+    print(f"задержка нажатия, мс: p50 {ms(lat['p50'])}  p95 {ms(lat['p95'])}  p99 {ms(lat['p99'])}  max {ms(lat['max'])}")
+    print("\nсценарий        сессий ошибок  p50 с   p95 с   чтений  записей  p95 вызовов  Bot API")
+    for name, sc in r["scenarios"].items():
+        print(
+            f"{name:14s} {sc['sessions']:6d} {sc['errors']:6d} {sc['seconds']['p50']:6.2f}  {sc['seconds']['p95']:6.2f}"
+            f"  {sc['sheets_reads_mean']:6.1f}  {sc['sheets_writes_mean']:7.1f}  {sc['sheets_calls_p95']:11.0f}"
+            f"  {sc['tg_calls_mean']:7.1f}"
+        )
+    print("\nмаршрут                                   n      p50      p95      p99      max (мс)")
+    for route, v in sorted(r["routes"].items(), key=lambda kv: -kv[1]["p95"]):
+        print(f"{route:38s} {v['n']:6d} {ms(v['p50'])} {ms(v['p95'])} {ms(v['p99'])} {ms(v['max'])}")
+    if r["errors"]:
+        print("\nошибки:")
+        for text, n in r["errors"]:
+            print(f"  {n:4d} × {text}")
+
+
+def _parse_mix(text: str) -> list:
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f"неизвестный сценарий {name!r}; есть: {', '.join(SCENARIOS)}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+async def run(args) -> dict:
+    store = fakesheets.FakeStore(fakesheets.synthetic_sheets(
+        ledger_rows=args.ledger_rows, cars=args.cars, workshop_cars=args.workshop_cars, seed=args.seed,
+    ))
+    rnd = random.Random(args.seed)
+
+    def latency(method, url):
+        return max(0.0, rnd.gauss(args.latency, args.jitter)) if args.latency else 0.0
+
+    session = fakesheets.install(bot, store, latency=latency)
+    session.__class__ = CountingSession
+    stub = CountingBot(latency=args.tg_latency)
+
+    await bot.warm_up()
+    before = session.calls
+    sessions = []
+    t0 = time.perf_counter()
+    await asyncio.gather(*[
+        operator_loop(i, stub, args, _parse_mix(args.mix), sessions) for i in range(args.operators)
+    ])
+    wall = time.perf_counter() - t0
+    await asyncio.gather(*list(bot._BG_TASKS), return_exceptions=True)
+    return summarize(sessions, wall, session.calls - before)
+
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--operators", type=int, default=10, help="одновременных операторов")
+    p.add_argument("--sessions", type=int, default=5, help="сценариев на оператора")
+    p.add_argument("--mix", default="income=4,report=3,workshop=2,car=1", help="веса сценариев")
+    p.add_argument("--latency", type=float, default=0.08, help="задержка запроса к таблице, с")
+    p.add_argument("--jitter", type=float, default=0.03, help="разброс задержки таблицы, с")
+    p.add_argument("--tg-latency", type=float, default=0.03, help="задержка вызова Bot API, с")
+    p.add_argument("--think", type=float, default=0.0, help="средняя пауза между сценариями, с")
+    p.add_argument("--ledger-rows", type=int, default=10_000)
+    p.add_argument("--cars", type=int, default=100)
+    p.add_argument("--workshop-cars", type=int, default=50)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", default="", help="куда записать результат")
+    p.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    args = p.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger("bot").setLevel(logging.ERROR)
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "result": result}, f, ensure_ascii=False, indent=1)
+        print(f"-> {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())